@@ -0,0 +1,90 @@
+import struct
+from typing import List
+
+# -----Binary encoding:
+# clients that ask for it with "binary": true in room-connect get send-message,
+# receive-message and members-changed as binary messages instead of json, every
+# other message stays json
+# a binary message is a single record: a kind byte followed by the fields of that
+# kind, strings are utf-8 prefixed with their length
+#   SEND_MESSAGE     message (u32 length)
+#   RECEIVE_MESSAGE  name (u16 length), message (u32 length)
+#   MEMBERS_CHANGED  member count (u16), then every name (u16 length)
+# integers are big endian
+# the server refuses names and rooms past what the u16 fields hold
+# (MAX_NAME_SIZE, MAX_MEMBERS) at room-connect, so encoding never fails
+
+SEND_MESSAGE = 1
+RECEIVE_MESSAGE = 2
+MEMBERS_CHANGED = 3
+
+# longest name in utf-8 bytes, and most members of a room
+MAX_NAME_SIZE = 0xffff
+MAX_MEMBERS = 0xffff
+
+_KIND = struct.Struct('!B')
+_SHORT = struct.Struct('!H')
+_LONG = struct.Struct('!I')
+_RECEIVE_HEADER = struct.Struct('!BH')
+_MEMBERS_HEADER = struct.Struct('!BH')
+
+
+def encodeSendMessage(message: str) -> bytes:
+    message = message.encode()
+    return _KIND.pack(SEND_MESSAGE) + _LONG.pack(len(message)) + message
+
+
+def encodeReceiveMessage(name: str, message: str) -> bytes:
+    name = name.encode()
+    message = message.encode()
+    return b''.join((_RECEIVE_HEADER.pack(RECEIVE_MESSAGE, len(name)), name,
+                     _LONG.pack(len(message)), message))
+
+
+def encodeMembersChanged(names: List[str]) -> bytes:
+    parts = [_MEMBERS_HEADER.pack(MEMBERS_CHANGED, len(names))]
+    for name in names:
+        name = name.encode()
+        parts.append(_SHORT.pack(len(name)))
+        parts.append(name)
+    return b''.join(parts)
+
+
+def _string(data: bytes, offset: int, prefix: struct.Struct):
+    """Private function to read a length prefixed string, returns it and the offset
+    past it"""
+    (length,) = prefix.unpack_from(data, offset)
+    offset += prefix.size
+    end = offset + length
+    if end > len(data):
+        raise ValueError('truncated record')
+    return data[offset:end].decode(), end
+
+
+def decodeMessage(data: bytes) -> dict:
+    """Decode a binary message into the dict its json form parses to, raises
+    ValueError if it is malformed"""
+    try:
+        (kind,) = _KIND.unpack_from(data)
+        if kind == SEND_MESSAGE:
+            message, end = _string(data, 1, _LONG)
+            result = {"type": "send-message", "message": message}
+        elif kind == RECEIVE_MESSAGE:
+            name, offset = _string(data, 1, _SHORT)
+            message, end = _string(data, offset, _LONG)
+            result = {"type": "receive-message", "message": message, "name": name}
+        elif kind == MEMBERS_CHANGED:
+            (count,) = _SHORT.unpack_from(data, 1)
+            names = []
+            end = 1 + _SHORT.size
+            for _ in range(count):
+                name, end = _string(data, end, _SHORT)
+                names.append(name)
+            result = {"type": "members-changed", "names": names}
+        else:
+            raise ValueError('unknown record kind %d' % kind)
+    except struct.error as e:
+        raise ValueError('truncated record') from e
+    if end != len(data):
+        raise ValueError('trailing bytes after record')
+    return result
@@ -1,10 +1,18 @@
 import sys
 import os
-from typing import Dict, List, Tuple, Union
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple, Union
 sys.path.append('../../websocket-server')
 sys.path.append('./dist')
 import json
 from WebSocketServer import WebSocketConnection, WebSocketServer
+from wssDeflate import DeflateOptions
+from wssPubSub import BrokerPubSub, startBroker
+from room_history import RoomHistory, MAX_PAGE_SIZE
+from message_log import MessageStore
+from chat_binary import decodeMessage, encodeMembersChanged, encodeReceiveMessage, \
+    MAX_MEMBERS, MAX_NAME_SIZE
 import threading
 
 
@@ -12,45 +20,224 @@ import threading
 class Room:
     def __init__(self, id):
         self.id: str = id
-        self.members: List[RoomMember] = []
-        self.messages: List[Message] = []
+        # name -> member, in joining order
+        self.members: Dict[str, RoomMember] = {}
+        # bounded, only the newest messages are kept in memory, with a message log
+        # the whole history is kept on disk
+        self.history = RoomHistory(log=store.open(id) if store else None)
+        # guards the members and messages of this room only
+        self.lock = threading.Lock()
+        # worker id -> names of the members connected to the other workers
+        self.remoteMembers: Dict[int, List[str]] = {}
+
+    def memberNames(self) -> List[str]:
+        """Names of every member, those of the other workers included (ordered by
+        worker so every worker lists them the same way)"""
+        if not self.remoteMembers:
+            return list(self.members)
+        names = dict(self.remoteMembers)
+        names[workerId] = list(self.members)
+        return [name for worker in sorted(names) for name in names[worker]]
         
 
 class RoomMember:
-    def __init__(self, name, wsClient):
+    def __init__(self, name, wsClient, room, binary=False):
         self.name: str = name
         self.wsClient: WebSocketConnection = wsClient
+        self.room: Room = room
+        # gets send-message, receive-message and members-changed in the binary
+        # encoding (see chat_binary.py)
+        self.binary: bool = binary
+        # settles which of two members of different workers keeps a name both
+        # joined with (see evictDuplicateNames)
+        self.joinedAt: float = time.time()
         
 
-class Message:
-    def __init__(self, sender, message):
-        self.sender: RoomMember = sender
-        self.message: str = message
+# persistent message history, only when MESSAGE_LOG_DIR is set, rooms are read back
+# from it when first used
+store = MessageStore(os.environ["MESSAGE_LOG_DIR"]) if os.environ.get("MESSAGE_LOG_DIR") else None
 
+# with several worker processes (WORKERS) each worker has its own rooms, kept in
+# sync through a pub/sub broker: messages and member lists are published on the
+# channel of their room for the other workers (see onRoomEvent)
+# PUBSUB_SOCKET connects to a broker started separately instead
+# (python3 wssPubSub.py PATH), to share rooms between servers started on their own
+WORKERS = int(os.environ.get("WORKERS", "1"))
+pubsub: Optional[BrokerPubSub] = None
+# tells the events of this process from those of the other workers
+workerId = os.getpid()
 
 # global room structure
 rooms: Dict[str, Room] = {}
-lock = threading.Lock()
+# connection -> its member, for every connection in a room
+connections: Dict[WebSocketConnection, RoomMember] = {}
+# only guards the creation of rooms, everything else is guarded by the room locks
+roomsLock = threading.Lock()
 
 def getConnectedRoom(ws: WebSocketConnection) -> Union[Tuple[Room, RoomMember], Tuple[None, None]]:
     """Try to find room associated with this websocket connection"""
-    for roomId in rooms:
-        room = rooms[roomId]
-        
-        for member in room.members:
-            if member.wsClient == ws:
-                return (room, member)
-    return (None, None)
+    member = connections.get(ws)
+    if member is None:
+        return (None, None)
+    return (member.room, member)
+
+
+def getOrCreateRoom(roomId: str) -> Room:
+    """Get the room with the given id, creating it if it doesn't exist yet"""
+    room = rooms.get(roomId)
+    if room is None:
+        with roomsLock:
+            room = rooms.get(roomId)
+            if room is None:
+                room = Room(roomId)
+                rooms[roomId] = room
+                if pubsub is not None:
+                    pubsub.subscribe(roomChannel(roomId), onRoomEvent)
+                    # the other workers answer with their members and latest messages
+                    publishRoomEvent(room, '{"type": "worker-sync"}')
+    return room
     
     
-def checkNameInRoom(roomId: str, name: str) -> bool:
-    """Try to find a user with given name in given room"""
-    if roomId not in rooms:
-        return False
-    room = rooms[roomId]
-    for member in room.members:
-        if member.name == name:
-            return True
+def checkNameInRoom(room: Room, name: str) -> bool:
+    """Try to find a user with given name in given room, must hold the room lock"""
+    return name in room.members or any(name in names for names in room.remoteMembers.values())
+
+
+def evictDuplicateNames(room: Room, origin: int, names: List[str], joined: List[float]
+                        ) -> List[RoomMember]:
+    """Remove the members of this worker that joined after a member of the origin
+    worker with the same name (a worker new to the room can't check the names of the
+    others until they answered it), returns them, must hold the room lock"""
+    evicted = []
+    for name, joinedAt in zip(names, joined):
+        member = room.members.get(name)
+        # every worker compares the same way, the worker id breaks ties
+        if member is not None and (joinedAt, origin) < (member.joinedAt, workerId):
+            removeMember(member)
+            sendError(member.wsClient, f"Name {name} already exists in room {room.id}")
+            evicted.append(member)
+    return evicted
+
+
+def removeMember(member: RoomMember):
+    """Remove a member from its room, must hold the room lock"""
+    del member.room.members[member.name]
+    connections.pop(member.wsClient, None)
+
+
+def splitMembers(room: Room, exclude: Optional[WebSocketConnection] = None
+                 ) -> Tuple[List[WebSocketConnection], List[WebSocketConnection]]:
+    """Connections of the members of this worker, those getting json and those getting
+    binary, must hold the room lock"""
+    textClients = []
+    binaryClients = []
+    for member in room.members.values():
+        if member.wsClient is not exclude:
+            (binaryClients if member.binary else textClients).append(member.wsClient)
+    return textClients, binaryClients
+
+
+def broadcastMembers(room: Room, exclude: Optional[WebSocketConnection] = None):
+    """Send members-changed to the members of this worker, encoded once per encoding
+    in use, must hold the room lock"""
+    textClients, binaryClients = splitMembers(room, exclude)
+    names = room.memberNames()
+    if textClients:
+        membersChangedMsg = {
+            "type": "members-changed",
+            "names": names
+        }
+        WebSocketServer.broadcast(textClients, json.dumps(membersChangedMsg))
+    if binaryClients:
+        WebSocketServer.broadcast(binaryClients, encodeMembersChanged(names))
+
+
+def receiveMessageText(name: str, message: str) -> str:
+    receiveMsg = {
+        "type": "receive-message",
+        "message": message,
+        "name": name
+    }
+    return json.dumps(receiveMsg)
+
+
+def broadcastMessage(room: Room, name: str, message: str, text: Optional[str] = None,
+                     exclude: Optional[WebSocketConnection] = None):
+    """Send receive-message to the members of this worker, text is its json if already
+    serialized, must hold the room lock"""
+    textClients, binaryClients = splitMembers(room, exclude)
+    if textClients:
+        WebSocketServer.broadcast(textClients, text or receiveMessageText(name, message))
+    if binaryClients:
+        WebSocketServer.broadcast(binaryClients, encodeReceiveMessage(name, message))
+
+
+def roomChannel(roomId: str) -> str:
+    return "room:" + roomId
+
+
+def publishRoomEvent(room: Room, text: str):
+    """Send an event (json) to the other workers using the room, serialized once and
+    prefixed with the id of this worker, does nothing with a single worker"""
+    if pubsub is not None:
+        pubsub.publish(roomChannel(room.id), b"%d\n" % workerId + text.encode())
+
+
+def publishMembers(room: Room, withHistory: bool = False):
+    """Let the other workers know the members connected to this one, with the latest
+    messages for a worker that just started using the room, must hold the room lock"""
+    if pubsub is None:
+        return
+    event = {"type": "worker-members", "names": list(room.members),
+             "joined": [member.joinedAt for member in room.members.values()]}
+    if withHistory:
+        records, _ = room.history.page(None, room.history.joinMessages)
+        event["messages"] = [[record.sender, record.message] for record in records]
+    publishRoomEvent(room, json.dumps(event))
+
+
+def onRoomEvent(channel: str, payload: bytes):
+    """Called with the events the other workers publish about a room, on the pub/sub
+    thread"""
+    origin, _, text = payload.partition(b"\n")
+    origin = int(origin)
+    if origin == workerId:
+        return
+    room = rooms.get(channel[len(roomChannel("")):])
+    if room is None:
+        return
+    text = text.decode()
+    event = json.loads(text)
+    with room.lock:
+        if event["type"] == "receive-message":
+            # same text as the members of the other worker got
+            room.history.append(event["name"], event["message"])
+            broadcastMessage(room, event["name"], event["message"], text)
+        elif event["type"] == "worker-members":
+            if event["names"]:
+                room.remoteMembers[origin] = event["names"]
+            else:
+                room.remoteMembers.pop(origin, None)
+            if evictDuplicateNames(room, origin, event["names"], event.get("joined", [])):
+                publishMembers(room)
+            # a worker new to the room starts with the latest messages of the others
+            if event.get("messages") and room.history.nextSeq == 0:
+                for sender, message in event["messages"]:
+                    room.history.append(sender, message)
+            broadcastMembers(room)
+        elif event["type"] == "worker-sync":
+            # another worker started using the room
+            if room.members or len(room.history):
+                publishMembers(room, withHistory=True)
+
+
+def sendError(ws: WebSocketConnection, error: str):
+    """Send an error message to a single connection"""
+    errorMsg = {
+        "type": "error",
+        "error": error
+    }
+    ws.send(json.dumps(errorMsg))
 
 
 def connectionHandler(ws: WebSocketConnection):
@@ -61,141 +248,172 @@ def connectionHandler(ws: WebSocketConnection):
 
 def onClose(ws):
     """Called when websocket connection is about to be closed, cleanup"""
-    with lock:
-        (room, member) = getConnectedRoom(ws)
-        if not room:
-            return
-        room.members.remove(member)
-        membersChangedMsg = {
-            "type": "members-changed",
-            "names": [member.name for member in room.members]
-        }
-        for member in room.members:
-            member.wsClient.send(json.dumps(membersChangedMsg))
+    (room, member) = getConnectedRoom(ws)
+    if not room:
+        return
+    with room.lock:
+        removeMember(member)
+        publishMembers(room)
+        broadcastMembers(room)
     
 
 def onMessage(text: Union[str, bytes], ws: WebSocketConnection):
     """Called on every message sent to the given websocket connection and data"""
-    with lock:
+    # messages of a connection are handled one at a time on its own thread, so only
+    # the room it is in needs locking
+    member = connections.get(ws)
+    if type(text) == bytes and member is not None and member.binary:
+        # a member that opted in to the binary encoding
+        try:
+            message = decodeMessage(text)
+        except ValueError:
+            sendError(ws, "Invalid message")
+            return
+    else:
         try:
             # our application uses json to communicate, parse the json
             message = json.loads(text)
         except:
-            errorMsg = {
-                "type": "error",
-                "error": "Invalid message"
-            }
-            ws.send(json.dumps(errorMsg))
+            sendError(ws, "Invalid message")
+            return
+        
+    if (message["type"] == "room-connect"):
+        # A new user is connecting
+        (room, member) = getConnectedRoom(ws)
+        if room:
+            sendError(ws, "Already in a room")
             return
             
-        if (message["type"] == "room-connect"):
-            # A new user is connecting
-            (room, member) = getConnectedRoom(ws)
-            if room:
-                errorMsg = {
-                    "type": "error",
-                    "error": "Already in a room"
-                }
-                ws.send(json.dumps(errorMsg))
+        roomId = message.get("roomId")
+        name = message.get("name")
+        binary = message.get("binary") is True
+        if type(roomId) != str or type(name) != str:
+            sendError(ws, "Invalid message")
+            return
+        # names and member counts are u16 in the binary encoding
+        if len(name.encode()) > MAX_NAME_SIZE:
+            sendError(ws, "Name too long")
+            return
+        
+        # either get the room if exists or make a new one
+        room = getOrCreateRoom(roomId)
+        with room.lock:
+            if checkNameInRoom(room, name):
+                sendError(ws, f"Name {name} already exists in room {roomId}")
                 return
-                
-            roomId = message["roomId"]
-            name = message["name"]
-            
-            if checkNameInRoom(roomId, name):
-                errorMsg = {
-                    "type": "error",
-                    "error": f"Name {name} already exists in room {roomId}"
-                }
-                ws.send(json.dumps(errorMsg))
+            memberCount = len(room.members) + sum(
+                len(names) for names in room.remoteMembers.values())
+            if memberCount >= MAX_MEMBERS:
+                sendError(ws, f"Room {roomId} is full")
                 return
             
-            # either get the room if exists or make a new one
-            if roomId not in rooms:
-                rooms[roomId] = Room(roomId)
-                
-            room = rooms[roomId]
             # add this new member to the room
-            room.members.append(RoomMember(name, ws))
+            member = RoomMember(name, ws, room, binary)
+            room.members[name] = member
+            connections[ws] = member
+            publishMembers(room)
             
-            # send back join confirmation and entire message history for this room
-            roomConnectedMsg = {
-                "type": "room-connected",
-                "roomId": roomId,
-                "members": [member.name for member in room.members],
-                "messages": [{"sender": msg.sender.name, "message": msg.message}
-                            for msg in room.messages]
-            }
-            ws.send(json.dumps(roomConnectedMsg))
+            # send back join confirmation and the latest messages of this room, older
+            # ones are fetched with fetch-history, the messages part is serialized once
+            # and reused until the next message
+            # binary confirms the binary encoding, servers without it leave it out
+            roomConnectedMsg = '{"type": "room-connected", "roomId": %s, "members": %s, %s%s}' % (
+                json.dumps(roomId), json.dumps(room.memberNames()),
+                '"binary": true, ' if binary else '', room.history.joinSnapshot())
+            ws.send(roomConnectedMsg)
             
             # notify all members of the room of this new member
-            membersChangedMsg = {
-                "type": "members-changed",
-                "names": [member.name for member in room.members]
-            }
-            
-            for member in room.members:
-                if member.wsClient == ws:
-                    continue
-                member.wsClient.send(json.dumps(membersChangedMsg))
+            broadcastMembers(room, exclude=ws)
+    
+    elif (message["type"] == "room-leave"):
+        # someone wants to leave their room
+        (room, myMember) = getConnectedRoom(ws)
+        if not room:
+            sendError(ws, "Not in a room")
+            return
         
-        elif (message["type"] == "room-leave"):
-            # someone wants to leave their room
-            (room, myMember) = getConnectedRoom(ws)
-            if not room:
-                errorMsg = {
-                    "type": "error",
-                    "error": "Not in a room"
-                }
-                ws.send(json.dumps(errorMsg))
-                return
-            
+        with room.lock:
             # remove that user from the room
-            room.members.remove(myMember)
+            removeMember(myMember)
+            publishMembers(room)
                 
             # let everyone know this user left
-            membersChangedMsg = {
-                "type": "members-changed",
-                "names": [member.name for member in room.members]
-            }
-            
-            for member in room.members:
-                member.wsClient.send(json.dumps(membersChangedMsg))
+            broadcastMembers(room)
+    
+    elif (message["type"] == "send-message"):
+        # someone wants to send a message to everyone in their room
+        (room, sender) = getConnectedRoom(ws)
+        if not room:
+            sendError(ws, "Not in a room")
+            return
+        if type(message.get("message")) != str:
+            sendError(ws, "Invalid message")
+            return
         
-        elif (message["type"] == "send-message"):
-            # someone wants to send a message to everyone in their room
-            (room, sender) = getConnectedRoom(ws)
-            if not room:
-                errorMsg = {
-                    "type": "error",
-                    "error": "Not in a room"
-                }
-                ws.send(json.dumps(errorMsg))
-                return
-            
+        with room.lock:
             # add message to the room
-            room.messages.append(Message(sender, message["message"]))
+            room.history.append(sender.name, message["message"])
             
-            # notify everyone in the room of the new message
-            receiveMsg = {
-                "type": "receive-message",
-                "message": message["message"],
-                "name": sender.name
-            }
-            for member in room.members:
-                if member.name != sender.name:
-                    member.wsClient.send(json.dumps(receiveMsg))
-        else:
-            errorMsg = {
-                "type": "error",
-                "error": "Invalid message"
-            }
-            ws.send(json.dumps(errorMsg))
+            # notify the members connected to the other workers, then everyone in the
+            # room on this one, the json is serialized once and only if needed
+            receiveText = None
+            if pubsub is not None:
+                receiveText = receiveMessageText(sender.name, message["message"])
+                publishRoomEvent(room, receiveText)
+            broadcastMessage(room, sender.name, message["message"], receiveText, exclude=ws)
+    elif (message["type"] == "fetch-history"):
+        # someone wants the messages before the given seq, newest if not given
+        (room, member) = getConnectedRoom(ws)
+        if not room:
+            sendError(ws, "Not in a room")
             return
+        
+        before = message.get("before")
+        limit = message.get("limit", MAX_PAGE_SIZE)
+        if (before is not None and type(before) != int) or type(limit) != int:
+            sendError(ws, "Invalid message")
+            return
+        
+        with room.lock:
+            records, hasMore = room.history.page(before, min(limit, MAX_PAGE_SIZE))
+            historyMsg = {
+                "type": "history",
+                "roomId": room.id,
+                "messages": [record.toDict() for record in records],
+                "hasMore": hasMore
+            }
+        ws.send(json.dumps(historyMsg))
+    else:
+        sendError(ws, "Invalid message")
+        return
     
 def get_port() -> int:
     if os.environ.get("PORT", None) is not None:
         return int(os.environ.get("PORT", None))
     return 3052
 
-wss = WebSocketServer(get_port(), connectionHandler)
+def startWorker(worker: int):
+    """Called in every server process before it accepts connections, connects it to
+    the pub/sub broker"""
+    global pubsub, workerId
+    workerId = os.getpid()
+    if store is not None and WORKERS > 1:
+        # every worker keeps its own copy of the history
+        store.directory = os.path.join(store.directory, "worker-%d" % worker)
+    pubsub = BrokerPubSub(brokerPath, onLost=onPubSubLost)
+
+
+def onPubSubLost(lost: BrokerPubSub):
+    """The broker went away, rooms now only reach the members of this worker"""
+    sys.stderr.write("worker process %d lost the pub/sub broker %s, rooms are no longer shared "
+                     "with the other workers\n" % (workerId, lost.path))
+
+
+brokerPath = os.environ.get("PUBSUB_SOCKET")
+if WORKERS > 1 and not brokerPath:
+    brokerPath = os.path.join(tempfile.gettempdir(), "chat-server-%d.sock" % get_port())
+    startBroker(brokerPath)
+
+# room history payloads are large and very compressible json
+wss = WebSocketServer(get_port(), connectionHandler, deflate=DeflateOptions(),
+                      workers=WORKERS, onWorkerStart=startWorker if brokerPath else None)
@@ -0,0 +1,284 @@
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+# local imports:
+from room_history import HistoryRecord
+
+# -----On disk layout:
+# one directory per room (named after the hex of the room id, so any id is a safe
+# file name) holding segment files named after the seq of their first message
+# records are appended to the newest segment, a new segment is started once it
+# reaches SEGMENT_SIZE bytes, segments are never modified afterwards
+# a record is a header (crc32 of the rest of the record, seq, sender length,
+# message length) followed by the utf-8 sender and message
+# every append is written to the OS right away, so it survives the process
+# crashing, fsync (surviving the machine crashing) happens in batches every
+# FSYNC_INTERVAL seconds on a background thread, off the send path
+# only the tail of a room's log is read back, when the room is first used, older
+# messages are read from the segments on demand through mmap
+# the segment being written stays open only for the MAX_OPEN_LOGS rooms written
+# to last, the others are closed and reopened on their next message, so rooms
+# that went quiet don't hold a file descriptor each
+# segments sealed on rollover or closed for an idle room are handed to the sync
+# thread too, which fsyncs and closes them, as it fsyncs the directories new
+# segments were created in, so an append only ever writes
+
+SEGMENT_SIZE = 4 * 1024 * 1024
+FSYNC_INTERVAL = 0.2
+MAX_OPEN_LOGS = 256
+SEGMENT_SUFFIX = '.seg'
+
+_HEADER = struct.Struct('!IQII')
+_CRC = struct.Struct('!I')
+_BODY_HEADER = struct.Struct('!QII')
+
+
+class MessageStore:
+    """
+    Directory of the message logs of every room, syncs the logs with pending
+    writes to disk every fsyncInterval seconds and keeps at most maxOpenLogs of
+    them open
+    """
+
+    def __init__(self, directory: str, fsyncInterval: float = FSYNC_INTERVAL,
+                 segmentSize: int = SEGMENT_SIZE, maxOpenLogs: int = MAX_OPEN_LOGS):
+        assert(maxOpenLogs > 0)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsyncInterval = fsyncInterval
+        self.segmentSize = segmentSize
+        self.maxOpenLogs = maxOpenLogs
+        self.lock = threading.Lock()
+        self.logs: Dict[str, MessageLog] = {}
+        self.dirty = set()
+        # files no log writes to anymore, and directories with new segments, to
+        # fsync (and close) on the next sync
+        self.retired = []
+        self.directories = set()
+        # logs with an open segment, least recently written first
+        self.openLogs: 'OrderedDict[MessageLog, None]' = OrderedDict()
+        self.pid = None
+
+    def open(self, roomId: str) -> 'MessageLog':
+        """Returns the log of the given room, created if it doesn't exist yet"""
+        with self.lock:
+            if self.pid != os.getpid():
+                # first use in this process (the server runs in a forked process)
+                self.pid = os.getpid()
+                threading.Thread(target=self._run, daemon=True).start()
+            log = self.logs.get(roomId)
+            if log is None:
+                path = os.path.join(self.directory, roomId.encode().hex())
+                log = MessageLog(path, self.segmentSize, self)
+                self.logs[roomId] = log
+            return log
+
+    def sync(self):
+        """fsync every log with pending writes, and close the retired files"""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            retired, self.retired = self.retired, []
+            directories, self.directories = self.directories, set()
+        for file in retired:
+            os.fsync(file.fileno())
+            file.close()
+        for directory in directories:
+            _syncDirectory(directory)
+        for log in dirty:
+            log.sync()
+
+    def _markDirty(self, log: 'MessageLog'):
+        """Private method, the given log has writes that aren't synced yet, retires
+        the files of the least recently written logs past maxOpenLogs"""
+        idle = []
+        with self.lock:
+            self.dirty.add(log)
+            self.openLogs[log] = None
+            self.openLogs.move_to_end(log)
+            while len(self.openLogs) > self.maxOpenLogs:
+                idle.append(self.openLogs.popitem(last=False)[0])
+        # outside the store lock, _detach takes the log's
+        for idleLog in idle:
+            self._retire(idleLog._detach())
+
+    def _retire(self, file, directory: Optional[str] = None):
+        """Private method to hand over a file no log writes to anymore (None if
+        there is none) and a directory a segment was created in, both are synced
+        by the next sync"""
+        with self.lock:
+            if file is not None:
+                self.retired.append(file)
+            if directory is not None:
+                self.directories.add(directory)
+
+    def _run(self):
+        """Background sync thread main loop"""
+        while True:
+            time.sleep(self.fsyncInterval)
+            self.sync()
+
+
+class MessageLog:
+    """
+    Append-only log of the messages of one room, split in segment files
+    """
+
+    def __init__(self, directory: str, segmentSize: int = SEGMENT_SIZE,
+                 store: Optional[MessageStore] = None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.store = store
+        self.lock = threading.Lock()
+        # first seq of every segment, in order
+        self.segments: List[int] = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+            if name.endswith(SEGMENT_SUFFIX))
+        self.file = None
+        self.fileSize = 0
+        self.nextSeq = 0
+        if self.segments:
+            self._recover()
+
+    @property
+    def oldestSeq(self) -> int:
+        """seq of the oldest message in the log"""
+        return self.segments[0] if self.segments else self.nextSeq
+
+    def append(self, record: HistoryRecord):
+        """Write a message to the log, records must be appended in seq order"""
+        sender = record.sender.encode()
+        message = record.message.encode()
+        body = _BODY_HEADER.pack(record.seq, len(sender), len(message)) + sender + message
+        data = _CRC.pack(zlib.crc32(body)) + body
+        with self.lock:
+            if not self.segments or self.fileSize >= self.segmentSize:
+                self._startSegment(record.seq)
+            elif self.file is None:
+                # closed while the room was idle
+                self.file = open(self._segmentPath(self.segments[-1]), 'ab', buffering=0)
+            # unbuffered, a single write per record
+            self.file.write(data)
+            self.fileSize += len(data)
+            self.nextSeq = record.seq + 1
+        if self.store:
+            self.store._markDirty(self)
+
+    def tail(self, count: int) -> List[HistoryRecord]:
+        """Returns the last count messages of the log, oldest first, only reads the
+        newest segments"""
+        return self.read(max(self.oldestSeq, self.nextSeq - count), self.nextSeq)
+
+    def read(self, start: int, end: int) -> List[HistoryRecord]:
+        """Returns the messages with start <= seq < end, oldest first, only reads the
+        segments holding them"""
+        records: List[HistoryRecord] = []
+        with self.lock:
+            index = max(0, bisect_right(self.segments, start) - 1)
+            for firstSeq in self.segments[index:]:
+                if firstSeq >= end:
+                    break
+                records.extend(_scan(self._segmentPath(firstSeq), start, end)[0])
+        return records
+
+    def sync(self):
+        """fsync the segment being written"""
+        with self.lock:
+            if self.file is not None:
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        """Sync and close the segment being written, the next append reopens it"""
+        file = self._detach()
+        if file is not None:
+            os.fsync(file.fileno())
+            file.close()
+
+    def _detach(self):
+        """Private method to take the file of the segment being written away from the
+        log, returns it (None if it isn't open), the next append reopens it"""
+        with self.lock:
+            file, self.file = self.file, None
+            return file
+
+    def _segmentPath(self, firstSeq: int) -> str:
+        return os.path.join(self.directory, '%020d%s' % (firstSeq, SEGMENT_SUFFIX))
+
+    def _startSegment(self, firstSeq: int):
+        """Private method to seal the current segment and start a new one, must
+        hold the lock. With a store, the sealed segment and the directory holding the
+        new one are synced by its sync thread"""
+        sealed = self.file
+        self.file = open(self._segmentPath(firstSeq), 'ab', buffering=0)
+        self.fileSize = 0
+        self.segments.append(firstSeq)
+        if self.store is not None:
+            self.store._retire(sealed, self.directory)
+            return
+        if sealed is not None:
+            os.fsync(sealed.fileno())
+            sealed.close()
+        # make the new file itself durable
+        _syncDirectory(self.directory)
+
+    def _recover(self):
+        """Private method to find where the log ends, drops a partially written last
+        record (the process died while writing it), the last segment is reopened by
+        the next append"""
+        firstSeq = self.segments[-1]
+        path = self._segmentPath(firstSeq)
+        # only the end is needed, don't decode any record
+        lastSeq, end = _scan(path, fromSeq=2 ** 64, verify=True)[1:]
+        if end < os.path.getsize(path):
+            os.truncate(path, end)
+        # segments are named after their first seq, an empty one starts at it
+        self.nextSeq = firstSeq if lastSeq is None else lastSeq + 1
+        self.fileSize = end
+
+
+def _syncDirectory(directory: str):
+    """fsync a directory, making the files created in it durable"""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _scan(path: str, fromSeq: int = 0, toSeq: Optional[int] = None, verify: bool = False
+          ) -> Tuple[List[HistoryRecord], Optional[int], int]:
+    """Read a segment file through mmap, returns the records with fromSeq <= seq < toSeq
+    (only those are decoded), the seq of the last record and the offset of the end
+    of the last complete record. verify checks every record's crc"""
+    records: List[HistoryRecord] = []
+    seq = None
+    offset = 0
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            # empty files can't be mapped
+            return records, seq, offset
+        with mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ) as data:
+            headerSize = _HEADER.size
+            unpack = _HEADER.unpack_from
+            while offset + headerSize <= size:
+                crc, recordSeq, senderLength, messageLength = unpack(data, offset)
+                start = offset + headerSize
+                end = start + senderLength + messageLength
+                if end > size or (verify and zlib.crc32(data[offset + 4:end]) != crc):
+                    break
+                if toSeq is not None and recordSeq >= toSeq:
+                    break
+                if recordSeq >= fromSeq:
+                    records.append(HistoryRecord(
+                        recordSeq, data[start:start + senderLength].decode(),
+                        data[start + senderLength:end].decode()))
+                seq = recordSeq
+                offset = end
+    return records, seq, offset
@@ -0,0 +1,92 @@
+import json
+from typing import List, Optional, Tuple
+
+# messages kept per room, older ones are overwritten
+DEFAULT_CAPACITY = 1000
+# messages sent along with room-connected
+DEFAULT_JOIN_MESSAGES = 50
+# upper bound on the messages of one fetch-history page
+MAX_PAGE_SIZE = 100
+
+
+class HistoryRecord:
+    """A message of the room history, seq numbers the messages of a room from 0"""
+    __slots__ = ('seq', 'sender', 'message')
+
+    def __init__(self, seq: int, sender: str, message: str):
+        self.seq = seq
+        self.sender = sender
+        self.message = message
+
+    def toDict(self) -> dict:
+        return {"sender": self.sender, "message": self.message, "seq": self.seq}
+
+
+class RoomHistory:
+    """
+    The last capacity messages of a room, in a ring buffer. Not thread safe, callers
+    hold the room lock.
+    With a log (see message_log.MessageLog) every message is also appended to it,
+    the buffer starts with the newest messages of the log and older pages are read
+    from it
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY,
+                 joinMessages: int = DEFAULT_JOIN_MESSAGES, log=None):
+        assert(capacity > 0)
+        self.capacity = capacity
+        self.joinMessages = min(joinMessages, capacity)
+        self.records: List[Optional[HistoryRecord]] = [None] * capacity
+        # seq of the next message, also the number of messages ever appended
+        self.nextSeq = 0
+        # serialized last joinMessages messages, reset by append
+        self._snapshot: Optional[str] = None
+        self.log = log
+        if log is not None:
+            for record in log.tail(capacity):
+                self.records[record.seq % capacity] = record
+            self.nextSeq = log.nextSeq
+
+    @property
+    def oldestSeq(self) -> int:
+        """seq of the oldest message still kept"""
+        return max(0, self.nextSeq - self.capacity)
+
+    def __len__(self) -> int:
+        return self.nextSeq - self.oldestSeq
+
+    def append(self, sender: str, message: str) -> HistoryRecord:
+        """Add a message, overwriting the oldest one once full"""
+        record = HistoryRecord(self.nextSeq, sender, message)
+        if self.log is not None:
+            self.log.append(record)
+        self.records[self.nextSeq % self.capacity] = record
+        self.nextSeq += 1
+        self._snapshot = None
+        return record
+
+    def page(self, before: Optional[int] = None, limit: int = MAX_PAGE_SIZE
+             ) -> Tuple[List[HistoryRecord], bool]:
+        """Returns up to limit messages older than seq before (the newest ones if None),
+        oldest first, and whether there are even older messages"""
+        inMemory = self.oldestSeq
+        oldest = inMemory if self.log is None else self.log.oldestSeq
+        end = self.nextSeq if before is None else max(oldest, min(before, self.nextSeq))
+        start = max(oldest, end - max(0, limit))
+        records = []
+        if start < inMemory:
+            # older than the buffer, read them from the log
+            records = self.log.read(start, min(end, inMemory))
+        capacity = self.capacity
+        records.extend(self.records[seq % capacity] for seq in range(max(start, inMemory), end))
+        return records, start > oldest
+
+    def joinSnapshot(self) -> str:
+        """JSON of the messages sent on join, {"messages": [...], "hasMore": bool} without
+        the braces so it can be spliced into a bigger object. Serialized only once per
+        new message however many members join"""
+        if self._snapshot is None:
+            records, hasMore = self.page(None, self.joinMessages)
+            self._snapshot = '"messages": %s, "hasMore": %s' % (
+                json.dumps([record.toDict() for record in records]), json.dumps(hasMore))
+        return self._snapshot
@@ -0,0 +1,66 @@
+"""
+The binary encoding of the chat messages, and the limits of its u16 fields.
+
+Run from the testing-app/server directory:
+
+    python3 -m unittest discover tests
+"""
+import asyncio
+import json
+import os
+import sys
+import unittest
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(SERVER_DIR)
+sys.path.append(os.path.join(SERVER_DIR, '..', '..', 'websocket-server', 'benchmarks'))
+
+from chat_binary import decodeMessage, encodeMembersChanged, encodeReceiveMessage, \
+    encodeSendMessage, MAX_NAME_SIZE
+from bench_server import HOST, ServerProcess
+from loadgen import Client, waitForPort
+
+
+class ChatBinaryTest(unittest.TestCase):
+
+    def test_round_trips(self):
+        self.assertEqual(decodeMessage(encodeSendMessage('héllo')),
+                         {"type": "send-message", "message": 'héllo'})
+        self.assertEqual(decodeMessage(encodeReceiveMessage('ä', 'hi')),
+                         {"type": "receive-message", "message": 'hi', "name": 'ä'})
+        self.assertEqual(decodeMessage(encodeMembersChanged(['a', 'b' * MAX_NAME_SIZE])),
+                         {"type": "members-changed", "names": ['a', 'b' * MAX_NAME_SIZE]})
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            decodeMessage(encodeMembersChanged(['a', 'b'])[:-1])
+
+
+class RoomConnectLimitsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ServerProcess(['chat_server.py'], cwd=SERVER_DIR,
+                                    env={'WORKERS': None, 'MESSAGE_LOG_DIR': None})
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_name_too_long(self):
+        async def run():
+            await waitForPort(HOST, self.server.port)
+            client = await Client.connect(HOST, self.server.port)
+            replies = []
+            for name in ('x' * (MAX_NAME_SIZE + 1), 'x'):
+                client.send(json.dumps({"type": "room-connect", "roomId": "r1",
+                                        "name": name, "binary": True}))
+                replies.append(json.loads((await client.recv())[1]))
+            await client.close()
+            return replies
+
+        refused, joined = asyncio.run(run())
+        self.assertEqual(refused, {"type": "error", "error": "Name too long"})
+        # the connection is still usable
+        self.assertEqual(joined['type'], 'room-connected')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+Two chat servers sharing rooms through a pub/sub broker, as workers do.
+
+Run from the testing-app/server directory:
+
+    python3 -m unittest discover tests
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+WEBSOCKET_SERVER_DIR = os.path.join(SERVER_DIR, '..', '..', 'websocket-server')
+sys.path.append(os.path.join(WEBSOCKET_SERVER_DIR, 'benchmarks'))
+
+from bench_server import HOST, ServerProcess
+from loadgen import Client, waitForPort
+
+# how long to wait for the servers to settle a duplicate name
+SETTLE_TIME = 1.0
+
+
+async def join(port: int, roomId: str, name: str) -> Client:
+    client = await Client.connect(HOST, port)
+    client.send(json.dumps({"type": "room-connect", "roomId": roomId, "name": name}))
+    return client
+
+
+async def received(client: Client, duration: float) -> list:
+    """Every message the client gets within duration seconds"""
+    messages = []
+    deadline = time.monotonic() + duration
+    while True:
+        try:
+            _, payload = await asyncio.wait_for(client.recv(), deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            return messages
+        messages.append(json.loads(payload))
+
+
+class WorkersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.brokerPath = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+        self.processes = [ServerProcess(
+            [os.path.join(WEBSOCKET_SERVER_DIR, 'wssPubSub.py'), self.brokerPath],
+            cwd=WEBSOCKET_SERVER_DIR)]
+        deadline = time.monotonic() + 10
+        while not os.path.exists(self.brokerPath) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        for _ in range(2):
+            self.processes.append(ServerProcess(
+                ['chat_server.py'], cwd=SERVER_DIR,
+                env={'PUBSUB_SOCKET': self.brokerPath, 'WORKERS': None,
+                     'MESSAGE_LOG_DIR': None}))
+
+    def tearDown(self):
+        for process in reversed(self.processes):
+            process.stop()
+
+    def test_same_name_on_two_workers(self):
+        first, second = [process.port for process in self.processes[1:]]
+
+        async def run():
+            for port in (first, second):
+                await waitForPort(HOST, port)
+            a = await join(first, 'r1', 'x')
+            self.assertEqual((await received(a, SETTLE_TIME))[0]['type'], 'room-connected')
+            # the second server doesn't know the room yet when the name arrives
+            b = await join(second, 'r1', 'x')
+            secondMessages = await received(b, SETTLE_TIME)
+            firstMessages = await received(a, 0.2)
+            c = await join(second, 'r1', 'y')
+            joined = (await received(c, SETTLE_TIME))[0]
+            for client in (a, b, c):
+                await client.close()
+            return secondMessages, firstMessages, joined
+
+        secondMessages, firstMessages, joined = asyncio.run(run())
+        self.assertEqual(secondMessages[-1], {
+            "type": "error", "error": "Name x already exists in room r1"})
+        # the member who joined first keeps the name, alone under it
+        memberLists = [message['names'] for message in firstMessages
+                       if message['type'] == 'members-changed']
+        self.assertEqual(memberLists[-1], ['x'])
+        self.assertEqual(joined['type'], 'room-connected')
+        self.assertEqual(sorted(joined['members']), ['x', 'y'])
+
+
+if __name__ == '__main__':
+    unittest.main()
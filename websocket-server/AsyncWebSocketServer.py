@@ -0,0 +1,702 @@
+import asyncio
+import inspect
+import signal
+import struct
+import time
+from functools import partial
+from typing import Callable, List, Optional, Set, Tuple
+# local imports:
+from WebSocketServer import splitData, prepareFrame, prepareFrames, prepareCompressed
+from wssFrame import FrameDecoder, MessageAssembler, ProtocolError, Rechunker, \
+    encodeFrame, encodeFrameParts, checkControlFrame, iterChunks, \
+    OP_CONTINUATION, OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG, \
+    CLOSE_NORMAL, CLOSE_GOING_AWAY, CLOSE_POLICY_VIOLATION, DEFAULT_MAX_MESSAGE_SIZE, \
+    DEFAULT_CHUNK_SIZE
+from wssWriter import setNoDelay, DEFAULT_HIGH_WATERMARK, DEFAULT_LOW_WATERMARK, \
+    POLICY_DROP, POLICY_DISCONNECT, POLICIES
+from wssDeflate import DeflateOptions, PerMessageDeflate
+from wssWorkers import reusePortSupported, startWorkers
+from wssMetrics import Metrics, getMetrics
+from wssHandshake import answerHandshake, parseRequest, HANDSHAKE_TIMEOUT, MAX_HANDSHAKE_SIZE, \
+    SERVICE_UNAVAILABLE
+from wssTimers import Keepalive, KeepaliveOptions, TimerWheel, \
+    DEFAULT_KEEPALIVE, ACTION_PING, ACTION_ABORT, ACTION_IDLE
+from wssLimits import Limiter, LimitOptions, MessageLimit
+from wssShutdown import DrainOptions, closeSchedule, DEFAULT_DRAIN
+
+# -----High level flow overview (asyncio engine):
+# one event loop accepts every TCP connection
+# each connection is a coroutine, not a thread, so an idle connection parked on
+# a read costs about 11 KB of memory (its transport, stream reader and a 4 KB
+# receive buffer), against about 31 KB for a threaded one, as measured by the
+# memory scenario of benchmarks/bench_server.py
+# the coroutine reads the HTTP upgrade request and sends back the response
+# then it loops reading websocket frames until the connection closes
+
+# how much to ask the stream for on each read
+READ_SIZE = 65536
+# coalesced frames are written early once they add up to this many bytes
+COALESCE_LIMIT = 65536
+
+
+class AsyncWebSocketServer:
+    """The asyncio equivalent of WebSocketServer, takes a port to serve on and a
+    connection callback function which will be called on a new connection and
+    given the connection as argument. The callback may be a plain function or a
+    coroutine function. Every connection is served on a single event loop, use
+    run(workers=N) to serve on N processes sharing the port (see wssWorkers).
+    closeServer and SIGTERM drain the connections gracefully (see wssShutdown)"""
+
+    def __init__(self, port, connectionCb, host='', highWatermark=DEFAULT_HIGH_WATERMARK,
+                 lowWatermark=DEFAULT_LOW_WATERMARK, slowConsumerPolicy=POLICY_DISCONNECT,
+                 deflate: Optional[DeflateOptions] = None,
+                 maxMessageSize=DEFAULT_MAX_MESSAGE_SIZE,
+                 keepalive: Optional[KeepaliveOptions] = DEFAULT_KEEPALIVE,
+                 metrics: Optional[Metrics] = getMetrics(), metricsPath: Optional[str] = None,
+                 flushInterval: Optional[float] = None, maxFrameSize: Optional[int] = None,
+                 limits: Optional[LimitOptions] = None,
+                 drain: Optional[DrainOptions] = DEFAULT_DRAIN, zeroCopy: bool = False):
+        self.port = port
+        self.host = host or None
+        self.connectionCb = connectionCb
+        # permessage-deflate settings, None disables compression
+        self.deflate = deflate
+        # larger incoming messages close the connection with 1009, as do frames
+        # larger than maxFrameSize, checked before their payload is read (None to
+        # only check the message size)
+        self.maxMessageSize = maxMessageSize
+        self.maxFrameSize = maxFrameSize
+        # hand messages to the message handlers as views over the receive buffer
+        # (see AsyncWebSocketConnection.onMessage)
+        self.zeroCopy = zeroCopy
+        # ping, idle and close timeouts, None disables them
+        self.keepalive = keepalive
+        # where to record metrics, None disables them, and the path of a plain GET
+        # serving them (None to not serve them)
+        self.metrics = metrics
+        self.metricsPath = metricsPath
+        # connection count and message rate limits, None disables them (see wssLimits)
+        self.limiter = Limiter(limits, metrics) if limits else None
+        if metrics is not None:
+            metrics.gauge('wss_send_queue_bytes', 'Bytes waiting in the send queues',
+                          self.queuedBytes)
+            metrics.gauge('wss_send_queues_pending', 'Send queues with data waiting',
+                          lambda: sum(1 for conn in list(self.connections) if conn.queuedBytes))
+        # drives the timers of every connection, advanced by a single task on the loop
+        self.timerWheel = TimerWheel()
+        self.timerTask: Optional[asyncio.Task] = None
+        # outbound buffer settings of every connection (see wssWriter.SendQueue)
+        self.highWatermark = highWatermark
+        self.lowWatermark = lowWatermark
+        self.slowConsumerPolicy = slowConsumerPolicy
+        # write coalescing, None writes every frame straight away
+        self.flushInterval = flushInterval
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.connections: Set[AsyncWebSocketConnection] = set()
+        # bind with SO_REUSEPORT, set when running several workers
+        self.reusePort = False
+        # graceful shutdown settings, None makes closeServer drop the connections
+        self.drain = drain
+        # set once closeServer started, drained once no connection is left
+        self.draining = False
+        self.drained: Optional[asyncio.Event] = None
+        # set by closeServer, ends serveForever
+        self.stopped: Optional[asyncio.Event] = None
+
+    async def start(self):
+        """Start listening for connections on the running event loop"""
+        self.server = await asyncio.start_server(
+            self._newConnection, self.host, self.port,
+            reuse_port=self.reusePort or None)
+        if self.keepalive and self.timerTask is None:
+            self.timerTask = asyncio.ensure_future(self._runTimers())
+
+    async def _runTimers(self):
+        """Private method, advance the timer wheel every tick"""
+        wheel = self.timerWheel
+        while True:
+            await asyncio.sleep(wheel.tick)
+            wheel.advance()
+
+    async def serveForever(self):
+        """Start the server (if needed) and serve until closeServer is called or the task
+        is cancelled. On the main thread SIGTERM calls closeServer"""
+        if not self.server:
+            await self.start()
+        loop = asyncio.get_event_loop()
+        self.stopped = asyncio.Event()
+        try:
+            loop.add_signal_handler(signal.SIGTERM,
+                                    lambda: asyncio.ensure_future(self.closeServer()))
+        except (NotImplementedError, RuntimeError, ValueError):
+            # no signals here (other thread, or a loop that can't handle them)
+            pass
+        try:
+            await self.stopped.wait()
+        finally:
+            if self.server:
+                self.server.close()
+
+    def run(self, workers: int = 1, onWorkerStart: Optional[Callable[[int], None]] = None):
+        """Blocking helper, run the server on a new event loop until interrupted.
+        With workers > 1 the server runs in that many forked processes sharing the
+        port, each with its own event loop, onWorkerStart is called in each of them
+        with the worker id before it starts accepting connections"""
+        assert(workers >= 1)
+        if workers == 1:
+            try:
+                asyncio.run(self.serveForever())
+            except KeyboardInterrupt:
+                pass
+            return
+        if not reusePortSupported():
+            raise OSError('SO_REUSEPORT is not supported, can\'t run several workers')
+        self.reusePort = True
+        processes = startWorkers(partial(self._runWorker, onWorkerStart), workers)
+
+        def forwardTerminate(signum, frame):
+            # the workers drain on SIGTERM
+            for process in processes:
+                process.terminate()
+
+        signal.signal(signal.SIGTERM, forwardTerminate)
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+
+    def _runWorker(self, onWorkerStart: Optional[Callable[[int], None]], workerId: int):
+        """Private method, main function of a worker process"""
+        if onWorkerStart:
+            onWorkerStart(workerId)
+        self.run()
+
+    @staticmethod
+    async def broadcast(connections, data):
+        """Send the same data to every given connection, accepts bytes or string.
+        The frame is encoded once and the same bytes are written to every stream
+        (connections compressing with context takeover compress their own copy),
+        each connection applies its own slow consumer policy"""
+        blocked = []
+        # nothing but control frames may follow a close frame (RFC 6455 5.5.1)
+        connections = [conn for conn in connections if not conn.closeSent]
+        for conn, frame in prepareFrames(connections, data):
+            # connections streaming a message or congested with the blocking
+            # policy get their frame once they are ready for it
+            if conn.messageLock.locked() or conn._writeNowait(frame) is None:
+                blocked.append(conn._sendFrame(frame))
+        if blocked:
+            await asyncio.gather(*blocked)
+
+    async def closeServer(self):
+        """Stop accepting connections, with drain options close every connection with
+        1001 and wait for the clients to answer up to the drain timeout first"""
+        if self.draining:
+            return
+        self.draining = True
+        if self.server:
+            self.server.close()
+        if self.drain is not None and self.connections:
+            await self._drainConnections()
+        if self.timerTask:
+            self.timerTask.cancel()
+            self.timerTask = None
+        if self.server:
+            await self.server.wait_closed()
+            self.server = None
+        if self.stopped is not None:
+            self.stopped.set()
+
+    async def _drainConnections(self):
+        """Private method, close the connections at jittered times and wait for them"""
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        deadline = start + self.drain.timeout
+        self.drained = asyncio.Event()
+        for delay, conn in closeSchedule(list(self.connections), self.drain.jitter):
+            wait = start + delay - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if not conn.closed:
+                await conn.close(CLOSE_GOING_AWAY)
+        if self.connections:
+            try:
+                await asyncio.wait_for(self.drained.wait(), max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                # clients that didn't answer in time
+                for conn in list(self.connections):
+                    conn.writer.transport.abort()
+                # let their close handlers run
+                try:
+                    await asyncio.wait_for(self.drained.wait(), 1)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _newConnection(self, reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter):
+        """Private method called by asyncio for each new TCP connection, does the
+        handshake then runs the websocket connection main loop"""
+        address = writer.get_extra_info('peername')[0]
+        try:
+            upgraded, deflate = await self._handshake(reader, writer, address)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError, ConnectionError):
+            upgraded = False
+        if not upgraded:
+            writer.close()
+            return
+        limiter = self.limiter
+        newConn = AsyncWebSocketConnection(
+            reader, writer, self.highWatermark, self.lowWatermark, self.slowConsumerPolicy,
+            deflate, self.maxMessageSize, self.keepalive, self.timerWheel, self.metrics,
+            self.flushInterval, self.maxFrameSize,
+            limiter.messageLimit(address) if limiter else None, self.zeroCopy)
+        self.connections.add(newConn)
+        if self.metrics is not None:
+            self.metrics.connectionsOpen.inc()
+        try:
+            # call the given connection callback function with the new connection
+            await _maybeAwait(self.connectionCb(newConn))
+            # start the loop listening to the TCP stream
+            await newConn._listen()
+        finally:
+            self.connections.discard(newConn)
+            if self.metrics is not None:
+                self.metrics.connectionsOpen.dec()
+            if limiter is not None:
+                limiter.release(address)
+            if self.drained is not None and not self.connections:
+                self.drained.set()
+
+    def queuedBytes(self) -> int:
+        """Number of bytes waiting in the write buffers of every connection"""
+        return sum(conn.queuedBytes for conn in list(self.connections))
+
+    async def _handshake(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                         address: str) -> Tuple[bool, Optional[PerMessageDeflate]]:
+        """Private method to do the websocket handshake, returns whether the connection
+        was upgraded (and admitted for the client IP address) and the negotiated
+        compression"""
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), HANDSHAKE_TIMEOUT)
+        if len(request) > MAX_HANDSHAKE_SIZE:
+            return False, None
+        response, upgraded, deflate = answerHandshake(
+            parseRequest(request[:-4]), self.deflate, self.metrics, self.metricsPath)
+        if upgraded and self.draining:
+            # shutting down, the client should try again elsewhere
+            response, upgraded = SERVICE_UNAVAILABLE, False
+            if self.metrics is not None:
+                self.metrics.handshakesFailed.inc()
+        limiter = self.limiter
+        if upgraded and limiter is not None:
+            # admission control, the connection is counted until it closes
+            refusal = limiter.admit(address)
+            if refusal is not None:
+                response, upgraded = refusal, False
+        writer.write(response)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            if upgraded and limiter is not None:
+                limiter.release(address)
+            raise
+        if upgraded and self.metrics is not None:
+            self.metrics.handshakes.inc()
+        return upgraded, deflate
+
+
+class AsyncWebSocketConnection:
+    """
+    Stores the stream pair of a tcp connection, and is used to
+    send & receive data under the WebSocket communication protocol
+    from an asyncio event loop.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 highWatermark=DEFAULT_HIGH_WATERMARK, lowWatermark=DEFAULT_LOW_WATERMARK,
+                 slowConsumerPolicy=POLICY_DISCONNECT, deflate: Optional[PerMessageDeflate] = None,
+                 maxMessageSize=DEFAULT_MAX_MESSAGE_SIZE,
+                 keepalive: Optional[KeepaliveOptions] = None,
+                 timerWheel: Optional[TimerWheel] = None, metrics: Optional[Metrics] = None,
+                 flushInterval: Optional[float] = None, maxFrameSize: Optional[int] = None,
+                 messageLimit: Optional[MessageLimit] = None, zeroCopy: bool = False):
+        assert(slowConsumerPolicy in POLICIES)
+        assert(keepalive is None or timerWheel is not None)
+        self.reader = reader
+        self.writer = writer
+        # negotiated permessage-deflate state, None if not compressing
+        self.deflate = deflate
+        # where frames, bytes and timings are recorded, None if not recording
+        self.metrics = metrics
+        # reassembles fragmented incoming messages
+        self.assembler = MessageAssembler(maxMessageSize, deflate, zeroCopy)
+        self.maxFrameSize = maxFrameSize
+        self.zeroCopy = zeroCopy
+        # message rate limit, None if not limited
+        self.messageLimit = messageLimit
+        # held while streaming a message, so its fragments don't interleave with
+        # other messages
+        self.messageLock = asyncio.Lock()
+        self.msgHandler = None
+        self.fragmentHandler = None
+        self.closeHandler = None
+        self.closed = False
+        # set once a close frame was sent, nothing can be sent after it
+        self.closeSent = False
+        # pings and timeouts, driven by the server's timer wheel
+        self.keepalive = Keepalive(keepalive) if keepalive else None
+        self.timerWheel = timerWheel
+        self.timer = None
+        # the transport's write buffer is the send queue, asyncio writes without
+        # blocking and pauses drain() between the watermarks
+        self.highWatermark = highWatermark
+        self.lowWatermark = lowWatermark
+        self.slowConsumerPolicy = slowConsumerPolicy
+        writer.transport.set_write_buffer_limits(highWatermark, lowWatermark)
+        self.congested = False
+        setNoDelay(writer.get_extra_info('socket'))
+        # write coalescing: frames gathered until the loop runs _flush, flushInterval
+        # seconds after the first one (0 for the next loop iteration), then handed
+        # to the transport in one writelines call, None writes frames straight away
+        self.flushInterval = flushInterval
+        self.coalesced: List[bytes] = []
+        self.coalescedBytes = 0
+        self.flushHandle: Optional[asyncio.Handle] = None
+        # metrics
+        self.droppedMessages = 0
+
+    @property
+    def queuedBytes(self) -> int:
+        """Number of bytes waiting to be written to the socket"""
+        return self.writer.transport.get_write_buffer_size() + self.coalescedBytes
+
+    async def send(self, data) -> bool:
+        """Send data on this websocket connection, accepts a string, bytes or any other
+        buffer (a received TextView or memoryview included), returns False if the
+        message was dropped by the slow consumer policy. Large payloads are written
+        after their header instead of being copied into the frame, buffers other than
+        bytes are still copied once since the transport may hold on to them"""
+        deflate = self.deflate
+        metrics = self.metrics
+        if deflate is None:
+            if metrics is None:
+                return await self._sendFrame(prepareFrame(data))
+            return await self._sendFrame(metrics.encodeSeconds.time(prepareFrame, data))
+        opcode, payload = splitData(data)
+        if len(payload) < deflate.minSize:
+            return await self._sendFrame(encodeFrameParts(opcode, payload))
+        # compress only once the message is written, so the compression context
+        # sees messages in the order they go out and never a dropped one
+        return await self._sendFrame(prepareCompressed(deflate, opcode, payload, metrics))
+
+    async def sendStream(self, source, binary: bool = True, chunkSize: int = DEFAULT_CHUNK_SIZE) -> bool:
+        """Send a message read from a file object, an iterable or an async iterable of
+        bytes (or str) pieces, the message is sent as chunkSize byte fragments as it is
+        read so it is never held whole in memory. Waits for the stream to drain after
+        every fragment, returns False if the connection closed (or started closing)
+        before the whole message was sent.
+        NOTE: streamed messages are never compressed"""
+        opcode = OP_BINARY if binary else OP_TEXT
+        async with self.messageLock:
+            async for chunk in _aiterChunks(source, chunkSize):
+                # nothing but control frames may follow a close frame
+                if self.closeSent:
+                    return False
+                if not self._writeNowait(encodeFrame(opcode, chunk, fin=0), True):
+                    return False
+                opcode = OP_CONTINUATION
+                # don't read ahead of what the client takes
+                self._flush()
+                try:
+                    await self.writer.drain()
+                except ConnectionError:
+                    return False
+            if self.closeSent:
+                return False
+            # an empty final fragment ends the message
+            return bool(self._writeNowait(encodeFrame(opcode, b''), True))
+
+    async def _sendFrame(self, payload) -> bool:
+        """Private method to send the bytes of already encoded frames (or a callable
+        returning them), after any message being streamed"""
+        if self.closeSent:
+            return False
+        if self.messageLock.locked():
+            async with self.messageLock:
+                return await self._write(payload)
+        return await self._write(payload)
+
+    async def _write(self, payload, force: bool = False) -> bool:
+        """Private method to write bytes (or a callable returning them) to the stream,
+        force bypasses the slow consumer policy (used for control frames)"""
+        result = self._writeNowait(payload, force)
+        if result is None:
+            # blocking policy, wait for the buffer to drain below the low watermark
+            self._flush()
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                return False
+            if self.closeSent and not force:
+                # closed meanwhile, the message can't follow the close frame
+                return False
+            result = self._writeNowait(payload, True)
+        return result
+
+    def _writeNowait(self, payload, force: bool = False) -> Optional[bool]:
+        """Private method to write bytes (or a tuple of buffers written one after the
+        other) to the stream without waiting, returns None if the connection is
+        congested and the slow consumer policy is to block"""
+        if self.closed or self.writer.transport.is_closing():
+            return False
+        queued = self.writer.transport.get_write_buffer_size() + self.coalescedBytes
+        if self.congested and queued <= self.lowWatermark:
+            self.congested = False
+        if self.congested and not force:
+            if self.slowConsumerPolicy == POLICY_DROP:
+                self.droppedMessages += 1
+                return False
+            elif self.slowConsumerPolicy == POLICY_DISCONNECT:
+                # the listen loop sees the aborted stream and closes the connection
+                self.writer.transport.abort()
+                return False
+            return None
+        if callable(payload):
+            payload = payload()
+        if self.metrics is not None:
+            self.metrics.frameOut(payload)
+        if type(payload) is tuple:
+            # header and payload, the transport keeps what the socket doesn't take
+            # as is, views over a buffer the caller reuses must be copied
+            parts = [part if type(part) is bytes else bytes(part) for part in payload]
+        else:
+            parts = (payload,)
+        for part in parts:
+            if self.flushInterval is None:
+                self.writer.write(part)
+            else:
+                self._coalesce(part)
+            queued += len(part)
+        if queued > self.highWatermark:
+            self.congested = True
+        return True
+
+    def _coalesce(self, payload):
+        """Private method to gather a buffer until the next flush"""
+        self.coalesced.append(payload)
+        self.coalescedBytes += len(payload)
+        if self.coalescedBytes >= COALESCE_LIMIT:
+            self._flush()
+        elif self.flushHandle is None:
+            loop = asyncio.get_event_loop()
+            if self.flushInterval:
+                self.flushHandle = loop.call_later(self.flushInterval, self._flush)
+            else:
+                self.flushHandle = loop.call_soon(self._flush)
+
+    def _flush(self):
+        """Private method to hand every coalesced frame to the transport at once"""
+        if self.flushHandle is not None:
+            self.flushHandle.cancel()
+            self.flushHandle = None
+        if not self.coalesced:
+            return
+        if not self.writer.transport.is_closing():
+            # gathered into a single sendmsg by the transport on Python 3.12+
+            self.writer.writelines(self.coalesced)
+        self.coalesced = []
+        self.coalescedBytes = 0
+
+    async def _sendPong(self, data: bytes = b''):
+        """Private method to send pong message on websocket, will be sent in response to
+        ping from client"""
+        await self._write(encodeFrame(OP_PONG, data), force=True)
+
+    async def _sendClose(self, code: Optional[int] = None):
+        """Private message to send close frame on websocket, sent in response to close
+        message from client or with a status code when closing on an error"""
+        self._sendCloseNowait(code)
+
+    def _sendCloseNowait(self, code: Optional[int] = None):
+        """Private method, _sendClose for the timer callback, which can't wait"""
+        if self.closeSent:
+            return
+        self.closeSent = True
+        body = struct.pack("!H", code) if code else b''
+        self._writeNowait(encodeFrame(OP_CLOSE, body), True)
+
+    async def close(self, code: int = CLOSE_NORMAL):
+        """Start the close handshake, the connection is closed once the client answers
+        the close frame, or dropped if it doesn't within the close timeout"""
+        self._startClose(code)
+
+    def _startClose(self, code: int):
+        """Private method to send the close frame and start the close timeout"""
+        if self.closeSent:
+            return
+        self._sendCloseNowait(code)
+        if self.keepalive is not None:
+            deadline = self.keepalive.closing(time.monotonic())
+            if deadline is not None:
+                self._schedule(deadline)
+            elif self.timer is not None:
+                # no close timeout, and no more pings after the close frame
+                self.timer.cancel()
+
+    def _schedule(self, deadline: float):
+        """Private method to (re)schedule the connection's timer"""
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.timerWheel.schedule(deadline, self._onTimer)
+
+    def _onTimer(self, now: float) -> Optional[float]:
+        """Private method called by the timer wheel (on the event loop), returns when to
+        be called again"""
+        if self.closed:
+            return None
+        action, deadline = self.keepalive.check(now)
+        if action == ACTION_PING:
+            self._writeNowait(encodeFrame(OP_PING), True)
+        elif action == ACTION_IDLE:
+            self._startClose(CLOSE_GOING_AWAY)
+        elif action == ACTION_ABORT:
+            # the listen loop sees the aborted stream and closes the connection
+            self.writer.transport.abort()
+        return deadline
+
+    def onMessage(self, msgHandler):
+        """Register message handler for this websocket connection, the given function will
+        be called anytime a message is received on the websocket, will be given message
+        and the AsyncWebSocketConnection instance as arguments. The handler may be a
+        coroutine function, in which case it is awaited before the next frame is read.
+        With zeroCopy the message is a memoryview (binary) or a wssFrame.TextView (text)
+        over the receive buffer, only valid until the handler returns (or its coroutine
+        finishes): copy it (bytes(), str()) to keep it"""
+        self.msgHandler = msgHandler
+
+    def onClose(self, closeHandler):
+        """Register close handler for this connection, the given function (or coroutine
+        function) will be called when the connection is closed"""
+        self.closeHandler = closeHandler
+
+    def onFragment(self, fragmentHandler):
+        """Register fragment handler for this connection, once registered binary messages
+        are no longer reassembled and given to the message handler, instead the given
+        function (or coroutine function) is called with every fragment as it arrives,
+        will be given the fragment bytes, whether it is the last fragment of the message
+        and the AsyncWebSocketConnection instance as arguments"""
+        self.fragmentHandler = fragmentHandler
+        self.assembler.streamBinary = fragmentHandler is not None
+
+    async def _close(self, code: Optional[int] = None):
+        """Private method to send the close frame, notify the close handler and
+        close the stream"""
+        if self.closed:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        try:
+            await self._sendClose(code)
+        except ConnectionError:
+            pass
+        self.closed = True
+        self._flush()
+        if self.closeHandler:
+            await _maybeAwait(self.closeHandler(self))
+        self.writer.close()
+
+    async def _listen(self):
+        """Websocket connection main loop, read frames off the stream, decode them and
+        decide what to do next depending on the frame"""
+        decoder = FrameDecoder(metrics=self.metrics, maxFrameSize=self.maxFrameSize,
+                               zeroCopy=self.zeroCopy,
+                               maxMessageSize=self.assembler.maxMessageSize,
+                               assembler=self.assembler, readSize=READ_SIZE)
+        read = self.reader.read
+        keepalive = self.keepalive
+        limit = self.messageLimit
+        if keepalive is not None:
+            deadline = keepalive.firstDeadline()
+            if deadline is not None:
+                self._schedule(deadline)
+        try:
+            while not self.closed:
+                data = await read(READ_SIZE)
+                if not data:
+                    break
+                if keepalive is not None:
+                    # the timer compares timestamps when it fires, nothing to reschedule
+                    keepalive.lastReceived = time.monotonic()
+                decoder.feed(data)
+                # a single read may hold several frames, or only part of one
+                for fin, rsv, opcode, payload in decoder:
+                    # call the right handler depending on message type
+                    if opcode & 0x8:
+                        checkControlFrame(fin, rsv, payload)
+                        if opcode == OP_CLOSE:
+                            await self._close()
+                            return
+                        elif opcode == OP_PING:
+                            if limit is None or await self._throttle(limit):
+                                await self._sendPong(payload)
+                        continue
+                    # data frame, wait for the whole message unless streaming
+                    message = self.assembler.add(fin, rsv, opcode, payload)
+                    if message is None:
+                        continue
+                    if limit is not None and not await self._throttle(limit):
+                        continue
+                    if keepalive is not None:
+                        keepalive.lastMessage = keepalive.lastReceived
+                    opcode, data, final, streamed = message
+                    if streamed:
+                        await _maybeAwait(self.fragmentHandler(data, final, self))
+                    elif self.msgHandler:
+                        await _maybeAwait(self.msgHandler(data, self))
+        except ProtocolError as e:
+            await self._close(e.code)
+            return
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        await self._close()
+
+    async def _throttle(self, limit: MessageLimit) -> bool:
+        """Private method to account for a message against the rate limit, waits while
+        the connection is over it, returns False if the message must be dropped
+        because the connection is being closed for it"""
+        if limit.closes and self.closeSent:
+            return False
+        wait = limit.take()
+        if wait:
+            if limit.closes:
+                # the close handshake lets the client read the close frame, closing the
+                # stream with its messages unread would reset the connection
+                await self.close(CLOSE_POLICY_VIOLATION)
+                return False
+            # nothing is read meanwhile, the client's writes back up
+            await asyncio.sleep(wait)
+        return True
+
+
+async def _aiterChunks(source, chunkSize: int):
+    """Async version of wssFrame.iterChunks that also takes async iterables"""
+    if not hasattr(source, '__aiter__'):
+        for chunk in iterChunks(source, chunkSize):
+            yield chunk
+        return
+    rechunker = Rechunker(chunkSize)
+    async for piece in source:
+        for chunk in rechunker.feed(piece):
+            yield chunk
+    rest = rechunker.finish()
+    if rest:
+        yield rest
+
+
+async def _maybeAwait(result):
+    """Await the result of a user callback if it is awaitable, lets handlers be
+    either plain functions or coroutine functions"""
+    if inspect.isawaitable(result):
+        await result
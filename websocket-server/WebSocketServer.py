@@ -1,17 +1,35 @@
 from functools import partial
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from hashlib import sha1
-import base64
+import os
+import signal
+import socketserver
 import struct
-import sys
-import multiprocessing
+import threading
+import time
+import socket as sockets
 from socket import socket as Socket
+from typing import Callable, Optional, Tuple
 # local imports:
-from wssUtils import s2bs, b2bs, bs2s, bs2b
+from wssFrame import FrameDecoder, MessageAssembler, ProtocolError, TextView, encodeFrame, \
+    encodeFrameParts, headerSize, packHeader, checkControlFrame, iterChunks, \
+    OP_CONTINUATION, OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG, \
+    CLOSE_NORMAL, CLOSE_GOING_AWAY, CLOSE_POLICY_VIOLATION, \
+    DEFAULT_MAX_MESSAGE_SIZE, DEFAULT_CHUNK_SIZE
+from wssWriter import SendQueue, getWriter, setNoDelay, DEFAULT_HIGH_WATERMARK, \
+    DEFAULT_LOW_WATERMARK, POLICY_DISCONNECT
+from wssMetrics import Metrics, getMetrics
+from wssDeflate import DeflateOptions, PerMessageDeflate
+from wssWorkers import ReusePortServer, reusePortSupported, startWorkers
+from wssHandshake import HandshakeServer, answerHandshake, parseRequest, recvRequest, \
+    HANDSHAKE_TIMEOUT, SERVICE_UNAVAILABLE
+from wssTimers import Keepalive, KeepaliveOptions, TimerWheel, getTimerWheel, \
+    DEFAULT_KEEPALIVE, ACTION_PING, ACTION_ABORT, ACTION_IDLE
+from wssLimits import Limiter, LimitOptions, MessageLimit
+from wssShutdown import DrainOptions, HandoffListener, closeSchedule, confirmHandoff, \
+    takeListeners, DEFAULT_DRAIN
 
 # -----High level flow overview:
-# HTTP server listening for requests
-# websocket handshake start
+# TCP server listening for connections, one thread per connection
+# websocket handshake start (see wssHandshake)
 # client creates TCP connection with server
 # client sends upgrade HTTP GET request to the server
 # server sends back HTTP response
@@ -20,50 +38,307 @@ from wssUtils import s2bs, b2bs, bs2s, bs2b
 # client sends websocket close frame
 # websocket and TCP connection closed
 
-GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
-OP_CONTINUATION = 0x0
-OP_TEXT = 0x1
-OP_BINARY = 0x2
-OP_CLOSE = 0x8
-OP_PING = 0x9
-OP_PONG = 0xa
+# NOTE: the opcodes (OP_*) and close status codes (CLOSE_*) are defined in wssFrame,
+# the handshake (acceptToken, GUID...) in wssHandshake
+
+
+def splitData(data) -> Tuple[int, bytes]:
+    """Returns the opcode and payload bytes to send data with, accepts a string, a
+    TextView (sent as text without decoding it) or bytes and any other buffer"""
+    # text is sent as text, anything else as binary
+    if type(data) == str:
+        return OP_TEXT, data.encode()
+    if type(data) is bytes:
+        return OP_BINARY, data
+    if type(data) is TextView:
+        return OP_TEXT, data.data
+    # any buffer (memoryview, bytearray, array...), seen as plain bytes without copying
+    return OP_BINARY, memoryview(data).cast('B')
+
+
+def prepareFrame(data):
+    """Encode data into a complete uncompressed frame, accepts the same data as
+    splitData. Large payloads aren't copied, the frame is then a (header, payload)
+    pair (see wssFrame.encodeFrameParts). The result can be written as is to any
+    number of connections"""
+    opcode, payload = splitData(data)
+    return encodeFrameParts(opcode, payload)
+
+
+def prepareFrames(connections, data):
+    """Generate (connection, frame) pairs to send the same data to every given connection.
+    The uncompressed frame is encoded once, compressed frames are shared between
+    connections that compress identically. Connections that keep compression context
+    get a callable that compresses the message once the send queue takes it"""
+    opcode, payload = splitData(data)
+    frame = None
+    compressed = {}
+    for conn in connections:
+        deflate = conn.deflate
+        if deflate is None or len(payload) < deflate.minSize:
+            if frame is None:
+                # encoded for the first connection, timed into its metrics
+                if conn.metrics is None:
+                    frame = encodeFrame(opcode, payload)
+                else:
+                    frame = conn.metrics.encodeSeconds.time(encodeFrame, opcode, payload)
+            yield conn, frame
+            continue
+        key = deflate.shareKey
+        if key is None:
+            yield conn, prepareCompressed(deflate, opcode, payload, conn.metrics)
+            continue
+        if key not in compressed:
+            compressed[key] = prepareCompressed(deflate, opcode, payload, conn.metrics)()
+        yield conn, compressed[key]
+
+
+def prepareCompressed(deflate: PerMessageDeflate, opcode: int, payload: bytes,
+                   metrics: Optional[Metrics] = None):
+    """Returns a callable encoding a compressed frame, timed into the given metrics"""
+    if metrics is None:
+        return partial(deflate.encodeFrame, opcode, payload)
+    return partial(metrics.encodeSeconds.time, deflate.encodeFrame, opcode, payload)
 
 
 class WebSocketServer:
     """The server that handles starting web socket connections,
-    wrapper around HTTP server with threading, takes a port to serve on
+    wrapper around a TCP server with threading, takes a port to serve on
     and a connection callback function which will be called on a new connection
-    and given the connection as argument"""
-
-    def __init__(self, port, connectionCb):
+    and given the connection as argument.
+    With workers > 1 the server runs in that many processes sharing the port
+    (see wssWorkers), onWorkerStart is then called in each of them with the
+    worker id before it starts accepting connections. Use wssWorkers.currentWorker
+    to tell which worker runs the code.
+    closeServer and SIGTERM drain the connections gracefully (see wssShutdown), with
+    a handoffPath a server started later with the same path takes the listening
+    sockets over and this one drains"""
+
+    def __init__(self, port, connectionCb, highWatermark=DEFAULT_HIGH_WATERMARK,
+                 lowWatermark=DEFAULT_LOW_WATERMARK, slowConsumerPolicy=POLICY_DISCONNECT,
+                 deflate: Optional[DeflateOptions] = None,
+                 maxMessageSize=DEFAULT_MAX_MESSAGE_SIZE, workers: int = 1,
+                 onWorkerStart: Optional[Callable[[int], None]] = None,
+                 keepalive: Optional[KeepaliveOptions] = DEFAULT_KEEPALIVE,
+                 metrics: Optional[Metrics] = getMetrics(), metricsPath: Optional[str] = None,
+                 flushInterval: Optional[float] = None, maxFrameSize: Optional[int] = None,
+                 limits: Optional[LimitOptions] = None,
+                 drain: Optional[DrainOptions] = DEFAULT_DRAIN, handoffPath: Optional[str] = None,
+                 zeroCopy: bool = False):
+        assert(workers >= 1)
+        if workers > 1 and not reusePortSupported():
+            raise OSError('SO_REUSEPORT is not supported, can\'t run several workers')
         self.connectionCb = connectionCb
+        # permessage-deflate settings, None disables compression
+        self.deflate = deflate
+        # larger incoming messages close the connection with 1009, as do frames
+        # larger than maxFrameSize, checked before their payload is read (None to
+        # only check the message size)
+        self.maxMessageSize = maxMessageSize
+        self.maxFrameSize = maxFrameSize
+        # hand messages to the message handlers as views over the receive buffer
+        # (see WebSocketConnection.onMessage)
+        self.zeroCopy = zeroCopy
+        # ping, idle and close timeouts, None disables them
+        self.keepalive = keepalive
+        # where to record metrics, None disables them, and the path of a plain GET
+        # serving them (None to not serve them)
+        self.metrics = metrics
+        self.metricsPath = metricsPath
+        # connection count and message rate limits, None disables them (see wssLimits)
+        self.limiter = Limiter(limits, metrics) if limits else None
+        if metrics is not None:
+            writer = getWriter()
+            metrics.gauge('wss_send_queue_bytes', 'Bytes waiting in the send queues',
+                          writer.queuedBytes)
+            metrics.gauge('wss_send_queues_pending', 'Send queues with data waiting',
+                          lambda: len(writer.waitingQueues()))
+        # outbound queue settings of every connection (see wssWriter.SendQueue)
+        self.highWatermark = highWatermark
+        self.lowWatermark = lowWatermark
+        self.slowConsumerPolicy = slowConsumerPolicy
+        # write coalescing, None writes every frame straight away
+        self.flushInterval = flushInterval
+        # open connections, only populated in the server process
+        self.connections = set()
+        self.workers = workers
+        self.onWorkerStart = onWorkerStart
+        # graceful shutdown settings, None makes SIGTERM and closeServer kill the
+        # workers right away
+        self.drain = drain
+        # set in a worker once it started draining, drained once it has no connection
+        self.draining = False
+        self.drained = threading.Event()
+        self.drainThread: Optional[threading.Thread] = None
         # pass an instance of this object to the HTTP server so it
         # call methods of this class
         handler = partial(Server, self)
-        server = ThreadingHTTPServer(('', port), handler)
-        # the HTTP server runs in its own thread and spawns a new
-        # thread for each connection (request)
-        self.server_process = multiprocessing.Process(
-            target=server.serve_forever, args=())
-        self.server_process.start()
-
-    def _newConnection(self, socket: Socket):
+        # take the listening sockets of the server running on the handoff path if
+        # any, otherwise bind every listening socket here so errors (port in use)
+        # are raised to the caller, each worker then serves one of them
+        handoff = takeListeners(handoffPath, workers) if handoffPath else None
+        # with a handoff path the next server may run more workers, it then binds
+        # more sockets next to these ones
+        reusePort = workers > 1 or (handoffPath is not None and reusePortSupported())
+        serverClass = ReusePortServer if reusePort else HandshakeServer
+        self.servers = []
+        for _ in range(workers):
+            if handoff and handoff[0]:
+                self.servers.append(_inheritServer(serverClass, handoff[0].pop(0), handler))
+            else:
+                self.servers.append(serverClass(('', port), handler))
+        # the TCP server runs in its own process and spawns a new
+        # thread for each connection
+        self.server_processes = startWorkers(self._serveWorker, workers)
+        self.server_process = self.server_processes[0]
+        if handoff:
+            confirmHandoff(handoff[1])
+        if handoffPath:
+            # keep the sockets open for the next server
+            HandoffListener(handoffPath, [server.socket for server in self.servers],
+                            self._handedOff)
+        else:
+            # the workers hold the sockets now
+            for server in self.servers:
+                server.server_close()
+        if drain is not None:
+            try:
+                # forward SIGTERM to the workers
+                signal.signal(signal.SIGTERM, self._onParentTerminate)
+            except ValueError:
+                # not the main thread, leave signals alone
+                pass
+
+    def _serveWorker(self, workerId: int):
+        """Private method, main function of a worker process"""
+        server = self.servers[workerId]
+        for other in self.servers:
+            if other is not server:
+                other.server_close()
+        if self.drain is not None:
+            signal.signal(signal.SIGTERM, lambda signum, frame: self._startDrain(server))
+        if self.onWorkerStart:
+            self.onWorkerStart(workerId)
+        server.serve_forever()
+        # stopped by a drain, the process exits once it is over
+        if self.drainThread is not None:
+            self.drainThread.join()
+
+    def _startDrain(self, server: HandshakeServer):
+        """Private method, SIGTERM in a worker, the drain runs on its own thread since
+        the main thread is the one to stop accepting"""
+        if self.drainThread is None:
+            self.drainThread = threading.Thread(target=self._drainWorker, args=(server,))
+            self.drainThread.start()
+
+    def _drainWorker(self, server: HandshakeServer):
+        """Private method to stop accepting, close every connection with 1001 and wait
+        for the clients to answer up to the drain timeout"""
+        deadline = time.monotonic() + self.drain.timeout
+        # takes up to the poll interval of the accept loop
+        server.shutdown()
+        server.server_close()
+        # upgrades still in their handshake are refused from now on
+        self.draining = True
+        start = time.monotonic()
+        for delay, conn in closeSchedule(list(self.connections), self.drain.jitter):
+            wait = start + delay - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            conn.close(CLOSE_GOING_AWAY)
+        if self.connections:
+            self.drained.wait(max(0.0, deadline - time.monotonic()))
+        if self.connections:
+            # clients that didn't answer in time
+            for conn in list(self.connections):
+                conn._abort()
+            # let their close handlers run
+            self.drained.wait(1)
+
+    def _onParentTerminate(self, signum, frame):
+        """Private method, SIGTERM in the parent process, drain the workers then die of
+        the signal as if it wasn't handled"""
+        self.closeServer()
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def _handedOff(self):
+        """Private method, a new server took over the listening sockets"""
+        for server in self.servers:
+            server.server_close()
+        self.closeServer()
+
+    def _newConnection(self, socket: Socket, deflate: Optional[PerMessageDeflate] = None,
+                       received: bytes = b'', address: Optional[str] = None):
         """Private method to create a new websocket connection using the given
-        TCP socket"""
-        newConn = WebSocketConnection(socket)
-        # call the given connection callback function with the new connection
-        self.connectionCb(newConn)
-        # start the loop listenting to TCP socket
-        newConn._listen()
+        TCP socket and negotiated compression, received holds bytes the client sent
+        right after the upgrade request, address is the client IP the limiter
+        admitted the connection for"""
+        limiter = self.limiter
+        newConn = WebSocketConnection(
+            socket, self.highWatermark, self.lowWatermark, self.slowConsumerPolicy,
+            deflate, self.maxMessageSize, self.keepalive, metrics=self.metrics,
+            flushInterval=self.flushInterval, maxFrameSize=self.maxFrameSize,
+            messageLimit=limiter.messageLimit(address) if limiter else None,
+            zeroCopy=self.zeroCopy)
+        self.connections.add(newConn)
+        if self.metrics is not None:
+            self.metrics.connectionsOpen.inc()
+        try:
+            # call the given connection callback function with the new connection
+            self.connectionCb(newConn)
+            # start the loop listenting to TCP socket
+            newConn._listen(received)
+        finally:
+            self.connections.discard(newConn)
+            if self.metrics is not None:
+                self.metrics.connectionsOpen.dec()
+            if limiter is not None:
+                limiter.release(address)
+            if self.draining and not self.connections:
+                self.drained.set()
+
+    def queuedBytes(self) -> int:
+        """Number of bytes waiting in the send queues of this process' connections"""
+        return sum(conn.sendQueue.queuedBytes for conn in list(self.connections))
+
+    @staticmethod
+    def broadcast(connections, data):
+        """Send the same data to every given connection, accepts bytes or string.
+        The frame is encoded once and the same bytes are written to every socket,
+        so the cost grows with the number of sockets only (connections compressing
+        with context takeover compress their own copy). Each connection applies
+        its own slow consumer policy"""
+        for conn, frame in prepareFrames(connections, data):
+            conn._sendFrame(frame)
 
     def closeServer(self):
-        if self.server_process:
-            self.server_process.terminate()
+        """Stop the workers, with drain options they close their connections gracefully
+        and this waits for them to exit, up to the drain timeout"""
+        for process in self.server_processes:
+            process.terminate()
+        if self.drain is None:
+            return
+        # a little slack for the workers to exit once the deadline passed
+        deadline = time.monotonic() + self.drain.timeout + 2
+        for process in self.server_processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+
+
+def _inheritServer(serverClass, listener: Socket, handler) -> HandshakeServer:
+    """Private function to make a server accepting on an already listening socket"""
+    server = serverClass(listener.getsockname(), handler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = listener
+    server.server_address = listener.getsockname()
+    return server
 
 
-class Server(BaseHTTPRequestHandler):
-    """Web server used to do the websocket handshake, the underlying TCP socket is then
-    used for the websocket connection"""
+class Server(socketserver.BaseRequestHandler):
+    """Handler of a new TCP connection, does the websocket handshake then the
+    underlying TCP socket is used for the websocket connection"""
 
     def __init__(self, wss: WebSocketServer, *args, **kwargs):
         # we get an instance of websocket server
@@ -71,38 +346,43 @@ class Server(BaseHTTPRequestHandler):
         super().__init__(*args, **kwargs)
 
     # Handshake for WebSocket
-    def do_GET(self):
-        """This server only accepts GET requests to start websocket connections"""
-        upgrade = self.headers.get('Upgrade')
-        connection = self.headers.get('Connection')
-        sec = self.headers.get('Sec-WebSocket-Key')
-        version = self.headers.get('Sec-WebSocket-Version')
-        # validate headers
-        if (not upgrade or upgrade != "websocket") \
-                or (not connection or connection != "Upgrade") \
-                or (not sec) or (not version or version != "13"):
-            self.send_response(400)
-            return
-
-        # part of the protocol, add the global value to the nonce
-        # hash and send back to client in response, it will verify it
-        hash = sha1(sec.encode() + GUID).digest()
-        token = base64.b64encode(hash).decode()
-
-        self.protocol_version = 'HTTP/1.1'
-        self.close_connection = False
-        # get the socket from this HTTP connection to use for websocket
+    def handle(self):
+        """This server only accepts GET requests to start websocket connections, and
+        plain GET requests to the metrics path if set"""
         socket: Socket = self.request
-        # send back switching protocols response
-        self.send_response(101)
-        self.send_header('Upgrade', 'websocket')
-        self.send_header('Connection', 'Upgrade')
-        self.send_header('Sec-WebSocket-Accept', token)
-        self.end_headers()
-        # notify the websocket server of a new connection
-        # at this point we will enter an infinite loop until this websocket closes
-        self.wss._newConnection(socket)
-        sys.exit(0)
+        wss = self.wss
+        address = self.client_address[0]
+        upgraded = False
+        try:
+            # don't let a client that never finishes its request hold the thread
+            socket.settimeout(HANDSHAKE_TIMEOUT)
+            head, received = recvRequest(socket)
+            if head is None:
+                return
+            response, upgraded, deflate = answerHandshake(
+                parseRequest(head), wss.deflate, wss.metrics, wss.metricsPath)
+            if upgraded and wss.draining:
+                # shutting down, the client should try again elsewhere
+                response, upgraded = SERVICE_UNAVAILABLE, False
+                if wss.metrics is not None:
+                    wss.metrics.handshakesFailed.inc()
+            if upgraded and wss.limiter is not None:
+                # admission control, the connection is counted until it closes
+                refusal = wss.limiter.admit(address)
+                if refusal is not None:
+                    response, upgraded = refusal, False
+            socket.sendall(response)
+            socket.settimeout(None)
+            if upgraded and wss.metrics is not None:
+                wss.metrics.handshakes.inc()
+        except OSError:
+            if upgraded and wss.limiter is not None:
+                wss.limiter.release(address)
+            return
+        if upgraded:
+            # notify the websocket server of a new connection
+            # at this point we will enter an infinite loop until this websocket closes
+            wss._newConnection(socket, deflate, received, address)
 
 
 class WebSocketConnection:
@@ -111,47 +391,165 @@ class WebSocketConnection:
     send & receive data under the WebSocket communication protocol.
     """
 
-    def __init__(self, socket):
+    def __init__(self, socket, highWatermark=DEFAULT_HIGH_WATERMARK,
+                 lowWatermark=DEFAULT_LOW_WATERMARK, slowConsumerPolicy=POLICY_DISCONNECT,
+                 deflate: Optional[PerMessageDeflate] = None,
+                 maxMessageSize=DEFAULT_MAX_MESSAGE_SIZE,
+                 keepalive: Optional[KeepaliveOptions] = None,
+                 timerWheel: Optional[TimerWheel] = None, metrics: Optional[Metrics] = None,
+                 flushInterval: Optional[float] = None, maxFrameSize: Optional[int] = None,
+                 messageLimit: Optional[MessageLimit] = None, zeroCopy: bool = False):
         self.socket: Socket = socket
-
-    def send(self, data):
-        "Send data on this websocket connection, accepts bytes or string"
-        frame = WSFrame(b'')
-        # two cases for data: str or bytes
-        if type(data) == str:
-            # create new frame and fill out based on length and type
-            frame.set_opcode(OP_TEXT)
-            data_bytelen = len(data.encode())
-        elif type(data) == bytes:
-            frame.set_opcode(OP_BINARY)
-            data_bytelen = len(data)
-
-        frame.set_payload_len(data_bytelen)
-        frame.set_payload_data(data)
-        payload = frame.get_bytes()
-        # use the TCP socket to send the final payload
-        self.socket.send(payload)
-
-    def _sendPong(self):
+        setNoDelay(socket)
+        # outgoing frames go through a bounded queue, writes never block on a slow
+        # client unless the slow consumer policy says so, with a flush interval the
+        # frames are coalesced (see wssWriter)
+        self.sendQueue = SendQueue(socket, highWatermark, lowWatermark, slowConsumerPolicy,
+                                   metrics=metrics, flushInterval=flushInterval)
+        # where frames, bytes and timings are recorded, None if not recording
+        self.metrics = metrics
+        # held while sending a message, so the fragments of a streamed message
+        # don't interleave with other messages
+        self.messageLock = threading.Lock()
+        # negotiated permessage-deflate state, None if not compressing
+        self.deflate = deflate
+        # reassembles fragmented incoming messages
+        self.assembler = MessageAssembler(maxMessageSize, deflate, zeroCopy)
+        self.maxFrameSize = maxFrameSize
+        self.zeroCopy = zeroCopy
+        self.fragmentHandler = None
+        # message rate limit, None if not limited
+        self.messageLimit = messageLimit
+        # pings and timeouts, driven by the timer wheel shared by every connection
+        self.keepalive = Keepalive(keepalive) if keepalive else None
+        self.timerWheel = timerWheel
+        self.timer = None
+        # set once a close frame was sent, nothing can be sent after it, under
+        # closeLock since the listen thread and the timer thread may both close
+        self.closeSent = False
+        self.closeLock = threading.Lock()
+
+    @property
+    def queuedBytes(self) -> int:
+        """Number of bytes waiting to be written to the socket"""
+        return self.sendQueue.queuedBytes
+
+    def send(self, data) -> bool:
+        """Send data on this websocket connection, accepts a string, bytes or any other
+        buffer (a received TextView or memoryview included), returns False if the
+        message was dropped by the slow consumer policy. Large payloads are written
+        without being copied, the buffer may be reused once send returns"""
+        deflate = self.deflate
+        metrics = self.metrics
+        if deflate is None:
+            if metrics is None:
+                return self._sendFrame(prepareFrame(data))
+            return self._sendFrame(metrics.encodeSeconds.time(prepareFrame, data))
+        opcode, payload = splitData(data)
+        if len(payload) < deflate.minSize:
+            return self._sendFrame(encodeFrameParts(opcode, payload))
+        # compress only once the queue takes the message, so the compression context
+        # sees messages in the order they go out and never a dropped one
+        return self._sendFrame(prepareCompressed(deflate, opcode, payload, metrics))
+
+    def sendStream(self, source, binary: bool = True, chunkSize: int = DEFAULT_CHUNK_SIZE) -> bool:
+        """Send a message read from a file object or an iterable of bytes (or str) pieces,
+        the message is sent as chunkSize byte fragments as it is read so it is never
+        held whole in memory. Blocks while the send queue is congested, returns False if
+        the connection closed (or started closing) before the whole message was sent.
+        NOTE: streamed messages are never compressed"""
+        opcode = OP_BINARY if binary else OP_TEXT
+        with self.messageLock:
+            for chunk in iterChunks(source, chunkSize):
+                # nothing but control frames may follow a close frame
+                if self.closeSent:
+                    return False
+                if not self.sendQueue.push(encodeFrame(opcode, chunk, fin=0), force=True):
+                    return False
+                opcode = OP_CONTINUATION
+                # don't read ahead of what the client takes
+                if not self.sendQueue.waitForDrain():
+                    return False
+            if self.closeSent:
+                return False
+            # an empty final fragment ends the message
+            return self.sendQueue.push(encodeFrame(opcode, b''), force=True)
+
+    def _sendFrame(self, payload) -> bool:
+        """Private method to send the bytes of already encoded frames, or a callable
+        returning them"""
+        if self.closeSent:
+            return False
+        # use the send queue of the TCP socket to send the final payload
+        with self.messageLock:
+            return self.sendQueue.push(payload)
+
+    def _sendPong(self, data: bytes = b''):
         """Private method to send pong message on websocket, will be sent in response to
-        ping from client"""
-        frame = WSFrame(b'')
-        frame.set_opcode(OP_PONG)
-        payload = frame.get_bytes()
-        self.socket.send(payload)
-
-    def _sendClose(self):
-        """Private message to send close frame on websocket, only sent in response to close
-        message from client"""
-        frame = WSFrame(b'')
-        frame.set_opcode(OP_CLOSE)
-        payload = frame.get_bytes()
-        self.socket.send(payload)
+        ping from client and echoes the ping's application data"""
+        self.sendQueue.push(encodeFrame(OP_PONG, data), force=True)
+
+    def _sendPing(self):
+        """Private method to send a ping, the client must answer with a pong"""
+        self.sendQueue.push(encodeFrame(OP_PING), force=True)
+
+    def _sendClose(self, code: Optional[int] = None) -> bool:
+        """Private message to send close frame on websocket, sent in response to close
+        message from client or with a status code when closing on an error, returns
+        False if a close frame was already sent"""
+        with self.closeLock:
+            if self.closeSent:
+                return False
+            self.closeSent = True
+        body = struct.pack("!H", code) if code else b''
+        self.sendQueue.push(encodeFrame(OP_CLOSE, body), force=True)
+        return True
+
+    def close(self, code: int = CLOSE_NORMAL):
+        """Start the close handshake, the connection is closed once the client answers
+        the close frame, or dropped if it doesn't within the close timeout"""
+        if not self._sendClose(code):
+            return
+        if self.keepalive is not None:
+            deadline = self.keepalive.closing(time.monotonic())
+            if deadline is not None:
+                self._schedule(deadline)
+            elif self.timer is not None:
+                # no close timeout, and no more pings after the close frame
+                self.timer.cancel()
+
+    def _schedule(self, deadline: float):
+        """Private method to (re)schedule the connection's timer"""
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.timerWheel.schedule(deadline, self._onTimer)
+
+    def _onTimer(self, now: float) -> Optional[float]:
+        """Private method called by the timer wheel, returns when to be called again"""
+        action, deadline = self.keepalive.check(now)
+        if action == ACTION_PING:
+            self._sendPing()
+        elif action == ACTION_IDLE:
+            self.close(CLOSE_GOING_AWAY)
+        elif action == ACTION_ABORT:
+            self._abort()
+        return deadline
+
+    def _abort(self):
+        """Private method to drop the connection without a close handshake, the listen
+        loop wakes up and closes it"""
+        try:
+            self.socket.shutdown(sockets.SHUT_RDWR)
+        except OSError:
+            pass
 
     def onMessage(self, msgHandler):
         """Register message handler for this websocket connection, the given function will
         be called anytime a message is received on the websocket, will be given message
-        and the WebSocketConnection instance as arguments"""
+        and the WebSocketConnection instance as arguments.
+        With zeroCopy the message is a memoryview (binary) or a wssFrame.TextView (text)
+        over the receive buffer, only valid until the handler returns: copy it (bytes(),
+        str()) to keep it"""
         self.msgHandler = msgHandler
 
     def onClose(self, closeHandler):
@@ -160,54 +558,114 @@ class WebSocketConnection:
         response sent back to the client"""
         self.closeHandler = closeHandler
 
-    def _listen(self):
-        """Websocket connection main loop, listen for messages, decode the frame and
-        decide what to do next depending on the frame"""
+    def onFragment(self, fragmentHandler):
+        """Register fragment handler for this connection, once registered binary messages
+        are no longer reassembled and given to the message handler, instead the given
+        function is called with every fragment as it arrives, will be given the fragment
+        bytes, whether it is the last fragment of the message and the WebSocketConnection
+        instance as arguments"""
+        self.fragmentHandler = fragmentHandler
+        self.assembler.streamBinary = fragmentHandler is not None
+
+    def _close(self, code: Optional[int] = None):
+        """Private method to send the close frame (unless already sent), notify the
+        close handler and close the TCP socket"""
+        if self.timer is not None:
+            self.timer.cancel()
+        self._sendClose(code)
+        # write what the socket takes without blocking, coalesced frames and the
+        # close frame included, the rest is discarded
+        self.sendQueue.flush()
+        self.sendQueue.close()
+        self.closeHandler(self)
+        self.socket.close()
+
+    def _listen(self, received: bytes = b''):
+        """Websocket connection main loop, read data from the socket into the frame
+        decoder and decide what to do next depending on each complete frame.
+        received holds bytes already read from the socket, handled first"""
+        decoder = FrameDecoder(metrics=self.metrics, maxFrameSize=self.maxFrameSize,
+                               zeroCopy=self.zeroCopy,
+                               maxMessageSize=self.assembler.maxMessageSize,
+                               assembler=self.assembler)
+        keepalive = self.keepalive
+        if keepalive is not None:
+            if self.timerWheel is None:
+                self.timerWheel = getTimerWheel()
+            deadline = keepalive.firstDeadline()
+            if deadline is not None:
+                self._schedule(deadline)
+        if received:
+            decoder.feed(received)
+            if not self._handleFrames(decoder):
+                return
         while True:
-            # read data from socket into buffer
-            wsMsg = self.socket.recv(1024)
-            if not wsMsg:
-                self._sendClose()
-                self.closeHandler(self)
-                self.socket.close()
-                break
-            # get data from websocket header
-            finFlag = (wsMsg[0] & 0x80) >> 7
-            opcode = wsMsg[0] & 0xf
-            maskFlag = (wsMsg[1] & 0x80) >> 7
-            payloadLen = wsMsg[1] & 0x7f
-            nextByte = 2
-            if (payloadLen == 126):
-                (payloadLen,) = struct.unpack("!H", wsMsg[2:4])
-                nextByte = 4
-            elif (payloadLen == 127):
-                (payloadLen,) = struct.unpack("!I", wsMsg[2:6])
-                nextByte = 6
-            # get the masking key to do unmasking
-            if maskFlag:
-                maskbytes = wsMsg[nextByte:nextByte + 4]
-                nextByte += 4
-            # call the right handler depending on message type
-            if (opcode == OP_CLOSE):
-                self._sendClose()
-                self.closeHandler(self)
-                self.socket.close()
+            # read data from socket into the decoder's buffer
+            try:
+                nbytes = decoder.recvInto(self.socket)
+            except OSError:
+                nbytes = 0
+            if not nbytes:
+                self._close()
                 break
-            elif (opcode == OP_PING):
-                self._sendPong()
-            elif (opcode == OP_TEXT or opcode == OP_BINARY):
-                unmasked = b''
-                # unmask the message if needed following websocket protocol
-                if maskFlag:
-                    for i, b in enumerate(wsMsg[nextByte:]):
-                        obyte = b ^ maskbytes[i % 4]
-                        unmasked += obyte.to_bytes(1, byteorder='big')
+            if keepalive is not None:
+                # the timer compares timestamps when it fires, nothing to reschedule
+                keepalive.lastReceived = time.monotonic()
+            if not self._handleFrames(decoder):
+                return
+
+    def _handleFrames(self, decoder: FrameDecoder) -> bool:
+        """Private method to handle every complete frame in the decoder, returns False
+        once the connection is closed"""
+        keepalive = self.keepalive
+        limit = self.messageLimit
+        # a single read may hold several frames, or only part of one
+        try:
+            for fin, rsv, opcode, payload in decoder:
+                # call the right handler depending on message type
+                if opcode & 0x8:
+                    checkControlFrame(fin, rsv, payload)
+                    if (opcode == OP_CLOSE):
+                        self._close()
+                        return False
+                    elif (opcode == OP_PING):
+                        if limit is None or self._throttle(limit):
+                            self._sendPong(payload)
+                    continue
+                # data frame, wait for the whole message unless streaming
+                message = self.assembler.add(fin, rsv, opcode, payload)
+                if message is None:
+                    continue
+                if limit is not None and not self._throttle(limit):
+                    continue
+                if keepalive is not None:
+                    keepalive.lastMessage = keepalive.lastReceived
+                opcode, data, final, streamed = message
+                if streamed:
+                    self.fragmentHandler(data, final, self)
                 else:
-                    unmasked = wsMsg[nextByte:]
-                # send the unmasked data to the message handler
-                if opcode == OP_TEXT:
-                    unmasked = unmasked.decode()
-                self.msgHandler(unmasked, self)
+                    self.msgHandler(data, self)
+        except ProtocolError as e:
+            self._close(e.code)
+            return False
+        return True
+
+    def _throttle(self, limit: MessageLimit) -> bool:
+        """Private method to account for a message against the rate limit, waits while
+        the connection is over it, returns False if the message must be dropped
+        because the connection is being closed for it"""
+        if limit.closes and self.closeSent:
+            return False
+        wait = limit.take()
+        if wait:
+            if limit.closes:
+                # the close handshake lets the client read the close frame, closing the
+                # socket with its messages unread would reset the connection
+                self.close(CLOSE_POLICY_VIOLATION)
+                return False
+            # nothing is read meanwhile, the client's writes back up
+            time.sleep(wait)
+        return True
 
 
 class WSFrame:
@@ -217,45 +675,49 @@ class WSFrame:
 
     bytes: placeholder bytes data for pre-filling WSFrame object with bytes (for receiving WS Protocol messages)
 
-    NOTE: this class does not convert payload_data to bitstring representations
-    so that it can save on unnecessary computation
+    NOTE: header fields are kept as plain integers and packed with struct straight into
+    a buffer preallocated to the size of the frame, WebSocketConnection.send skips this
+    object entirely and uses wssFrame.encodeFrameParts, get_parts is the equivalent
+    here: the header alone, to write before the payload instead of copying both
 
     Consult link for more info about WebSocket Frames: https://datatracker.ietf.org/doc/html/rfc6455#section-5
     """
 
+    __slots__ = ('bytes', 'fin', 'rsv', 'opcode', 'mask',
+                 'payload_len', 'masking_key', 'payload_data')
+
     def __init__(self, bytes):
         self.bytes = bytes if bytes else b''
-        self.fin = '1'  # 1 is True, 0 is False, denotes the final frame as part of one msg
+        self.fin = 1  # 1 is True, 0 is False, denotes the final frame as part of one msg
         # 3 filler bits, reserved for "special" websocket use (these will remain as 0)
-        self.rsv = '000'
+        self.rsv = 0
         # 4 bits, 1 is text, 2 is binary data etc.. (See predefined opcodes above)
-        self.opcode = '0000'
+        self.opcode = 0
         # 1 bit, true if payload is masked (this server implementation does not mask outgoing messages)
-        self.mask = '0'
-        self.payload_len = '0000000'  # 7 bits, or 7+16 bits or 7+64 bits
-        # if first 7 bits are 0-125, that is the length of payload
-        # if first 7 bits are 126, we interpret the following 16 bits as the actual payload length
-        # if first 7 bits are 127, we interpret the following 64 bits as the actual payload length
-        # NOTE: these cases ^ for bitlength are handled in the setter method for this variable
+        self.mask = 0
+        # number of bytes in the payload, encoded on 7, 7+16 or 7+64 bits
+        # if 0-125, that is the length of payload
+        # otherwise the first 7 bits are 126 (16 bit length follows) or 127 (64 bit length follows)
+        # NOTE: these cases ^ are handled when packing the header
+        self.payload_len = 0
 
-        self.masking_key = ''  # this server implementation does not mask outgoing messages
+        self.masking_key = b''  # this server implementation does not mask outgoing messages
 
         # payload_data is kept as bytes to save on unecessary computation
         self.payload_data = b''
 
+    def _pack_header(self, buf) -> int:
+        """Private method to pack the header into the start of buf, returns the header size"""
+        b0 = (self.fin << 7) | (self.rsv << 4) | self.opcode
+        return packHeader(buf, 0, b0, self.payload_len)
+
     def get_frame(self) -> str:
         """
         Returns the bistring representation of the entire frame header (so it excludes the payload data)
         """
-
-        return (
-            self.fin +
-            self.rsv +
-            self.opcode +
-            self.mask +
-            self.payload_len +
-            self.masking_key
-        )
+        header = bytearray(headerSize(self.payload_len))
+        self._pack_header(header)
+        return format(int.from_bytes(header, 'big'), '0%db' % (len(header) * 8))
 
     def get_bytes(self, refresh: bool = False) -> bytes:
         """
@@ -263,19 +725,27 @@ class WSFrame:
         NOTE: This server does not mask anything sent out!
         """
         if (not self.bytes) or refresh:
-            # set first bit of ws header
-            prefix = 0x80 ^ int(self.opcode, 2)
-            # concatenate prefix bytes with payload length and payload data bytes
-            self.bytes = prefix.to_bytes(
-                1, 'big') + bs2b(self.payload_len) + self.payload_data
+            buf = bytearray(headerSize(self.payload_len) + len(self.payload_data))
+            offset = self._pack_header(buf)
+            buf[offset:] = self.payload_data
+            self.bytes = bytes(buf)
         return self.bytes
 
+    def get_parts(self) -> Tuple[bytes, bytes]:
+        """
+        get the frame as its header bytes and its payload data, written one after the
+        other (socket.sendmsg) the payload is never copied
+        """
+        header = bytearray(headerSize(self.payload_len))
+        self._pack_header(header)
+        return bytes(header), self.payload_data
+
     def set_fin(self, fin: bool):
         """
-        Setter method for the fin bit of the frame.
-        NOTE: this implementation currently only supports sending data in one singular frame
+        Setter method for the fin bit of the frame, cleared on every fragment of a
+        fragmented message but the last one (see WebSocketConnection.sendStream)
         """
-        self.fin = '1' if fin else '0'
+        self.fin = 1 if fin else 0
 
     # opcode: int, sets the opcode variable accordingly
     def set_opcode(self, opcode: int):
@@ -283,30 +753,17 @@ class WSFrame:
         Setter method for the 4 opcode bits tof the frame.
         NOTE: to be used with the predefined opcode integers
         """
-        s = bin(opcode)[2:]  # will be 4 bits if opcode is one hexadecimal char
-        padding = '0' * (4 - len(s))
-        assert(len(s) <= 4)
-        self.opcode = padding + s
+        assert(0 <= opcode <= 0xf)
+        self.opcode = opcode
 
     # plen: int, number of bytes that our payload takes up
     def set_payload_len(self, plen: int):
         """
-        Setter method for the variable amount of bits to represent the payload length
-        This setter takes the number of bytes in the payload, and determines the 
-        WebSocket Frame compliant bitstring needed to represent the length
+        Setter method for the payload length, takes the number of bytes in the payload,
+        the WebSocket Frame compliant encoding is chosen when the header is packed
         """
-        # NOTE: assumes payload length doesn't exceed 2*64 bytes
-        plen_bits = bin(plen)[2:]
-        if plen <= 125:
-            self.payload_len = plen_bits
-        elif plen < 65536:
-            # case where we hard code the first 7 bits to be = 126 and append plen_bits
-            prefix = bin(126)[2:]
-            self.payload_len = prefix + '0' * (16 - len(plen_bits)) + plen_bits
-        else:
-            # case where we hard code the first 7 bits to be = 127 and append plen_bits
-            prefix = bin(127)[2:]
-            self.payload_len = prefix + '0' * (64 - len(plen_bits)) + plen_bits
+        assert(0 <= plen < 2**64)
+        self.payload_len = plen
 
     # data: str or bytes data to be sent. Will be encoded to bytes if is str.
     def set_payload_data(self, data):
@@ -318,9 +775,8 @@ class WSFrame:
         if not data:
             self.payload_data = b''
             return
-        # if data is text, we convert to bytes, and then convert to bin
+        # if data is text, we convert to bytes
         if type(data) == str:
             self.payload_data = data.encode()
-        # if data is bytes:
-        if type(data) == bytes:
+        else:
             self.payload_data = data
@@ -0,0 +1,383 @@
+"""
+End to end benchmarks over loopback, a local asyncio load generator (loadgen.py)
+drives the servers in separate processes and the results are written as JSON so
+runs can be compared.
+
+Scenarios:
+    handshake   handshakes per second (and handshake latency) on the echo server
+    echo        round trip latency percentiles for payloads from 16 B to 256 KB
+    fanout      chat_server room broadcast to 10, 100 and 1000 members
+    memory      resident memory of the echo server per idle connection
+
+The echo server (echo_server.py) runs with each engine, chat_server only has a
+threaded version. Payloads are generated from a fixed seed so every run sends
+the same bytes.
+
+Run from the websocket-server directory:
+
+    python3 benchmarks/bench_server.py --output results.json
+    python3 benchmarks/bench_server.py --quick --compare results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+from loadgen import Client, HandshakeError, closeAll, connectMany, maskedFrame, \
+    percentiles, raiseFileLimit, waitForPort, OP_BINARY, OP_TEXT
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+CHAT_SERVER_DIR = os.path.join(BENCHMARKS_DIR, '..', '..', 'testing-app', 'server')
+HOST = '127.0.0.1'
+SEED = 6455
+ENGINES = ['sync', 'async']
+SCENARIOS = ['handshake', 'echo', 'fanout', 'memory']
+
+HANDSHAKES = 2000
+HANDSHAKE_CONCURRENCY = 50
+ECHO_SIZES = [16, 1024, 16 * 1024, 256 * 1024]
+# round trips per payload size, fewer for large payloads
+ECHO_MESSAGES = 2000
+ECHO_BYTES = 64 * 1024 * 1024
+FANOUT_MEMBERS = [10, 100, 1000]
+# deliveries (messages times receivers) per room size
+FANOUT_DELIVERIES = 20000
+FANOUT_MESSAGE_SIZE = 64
+IDLE_CONNECTIONS = 1000
+# --quick divides the amount of work by this
+QUICK_FACTOR = 10
+WARMUP = 20
+
+
+class ServerProcess:
+    """A server under test, in its own process group so forked workers go with it"""
+
+    def __init__(self, args: List[str], cwd: Optional[str] = None,
+                 env: Optional[Dict[str, str]] = None, reportsPid: bool = False):
+        self.port = freePort()
+        self.process = subprocess.Popen(
+            [sys.executable] + [arg.format(port=self.port) for arg in args], cwd=cwd,
+            env=environment(PORT=str(self.port), **(env or {})),
+            stdout=subprocess.PIPE if reportsPid else subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, start_new_session=True)
+        # the process serving the connections, the threaded engine forks it
+        self.pid = int(self.process.stdout.readline()) if reportsPid else self.process.pid
+
+    def rss(self) -> Optional[int]:
+        """Resident memory of the serving process in bytes, None if unknown"""
+        try:
+            with open('/proc/%d/status' % self.pid) as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def stop(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+
+
+def environment(**changes: Optional[str]) -> Dict[str, str]:
+    """This process' environment with the given changes, None removes a variable"""
+    env = dict(os.environ, **changes)
+    return {key: value for key, value in env.items() if value is not None}
+
+
+def freePort() -> int:
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def payloadOf(size: int, rng: random.Random) -> bytes:
+    return rng.getrandbits(size * 8).to_bytes(size, 'big') if size else b''
+
+
+async def benchHandshake(port: int, count: int, concurrency: int) -> dict:
+    """Connect, handshake and close count times, concurrency at a time"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    failures = 0
+
+    async def handshake(record: bool):
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                client = await Client.connect(HOST, port)
+            except (HandshakeError, OSError):
+                failures += 1
+                return
+            if record:
+                latencies.append(time.perf_counter() - start)
+            await client.close()
+
+    await asyncio.gather(*(handshake(False) for _ in range(WARMUP)))
+    failures = 0
+    start = time.perf_counter()
+    await asyncio.gather(*(handshake(True) for _ in range(count)))
+    elapsed = time.perf_counter() - start
+    return {'handshakes': count, 'concurrency': concurrency, 'failures': failures,
+            'handshakesPerSecond': len(latencies) / elapsed,
+            'latencyMs': percentiles(latencies)}
+
+
+async def benchEcho(port: int, sizes: List[int], maxMessages: int, rng: random.Random) -> dict:
+    """Round trips of binary messages of each size, one at a time on one connection"""
+    client = await Client.connect(HOST, port)
+    results = {}
+    try:
+        for size in sizes:
+            payload = payloadOf(size, rng)
+            frame = maskedFrame(OP_BINARY, payload)
+            for _ in range(WARMUP):
+                client.sendFrame(frame)
+                opcode, echoed = await client.recv()
+                assert echoed == payload, 'echo mismatch for %d bytes' % size
+            messages = max(WARMUP, min(maxMessages, ECHO_BYTES // max(size, 1)))
+            latencies = []
+            start = time.perf_counter()
+            for _ in range(messages):
+                sent = time.perf_counter()
+                client.sendFrame(frame)
+                await client.recv()
+                latencies.append(time.perf_counter() - sent)
+            elapsed = time.perf_counter() - start
+            results[str(size)] = {'messages': messages, 'messagesPerSecond': messages / elapsed,
+                                  'megabytesPerSecond': 2 * messages * size / elapsed / 1e6,
+                                  'latencyMs': percentiles(latencies)}
+    finally:
+        await client.close()
+    return results
+
+
+async def benchFanout(port: int, members: int, deliveries: int) -> dict:
+    """Join members connections to one chat room, then one of them sends messages
+    one at a time, each is timed until every other member received it"""
+    clients = await connectMany(HOST, port, members)
+    room = 'fanout-%d' % members
+    try:
+        # joining sends members-changed to everyone already in the room, every
+        # client reads its share while the others join
+        joined = [asyncio.Event() for _ in clients]
+
+        async def drain(index: int):
+            for frame in range(members - index):
+                await clients[index].recvFrame()
+                if frame == 0:
+                    joined[index].set()
+
+        start = time.perf_counter()
+        draining = [asyncio.ensure_future(drain(index)) for index in range(members)]
+        for index, client in enumerate(clients):
+            client.send(json.dumps({'type': 'room-connect', 'roomId': room,
+                                    'name': 'm%d' % index}))
+            await joined[index].wait()
+        await asyncio.gather(*draining)
+        joinSeconds = time.perf_counter() - start
+
+        sender, receivers = clients[0], clients[1:]
+        messages = max(WARMUP, deliveries // len(receivers))
+        received = [0] * (WARMUP + messages)
+        lastArrival = [0.0] * len(received)
+        done = [asyncio.Event() for _ in received]
+
+        async def receive(client: Client):
+            for index in range(len(received)):
+                await client.recvFrame()
+                received[index] += 1
+                if received[index] == len(receivers):
+                    lastArrival[index] = time.perf_counter()
+                    done[index].set()
+
+        receiving = [asyncio.ensure_future(receive(client)) for client in receivers]
+        frame = maskedFrame(OP_TEXT, json.dumps({'type': 'send-message',
+                                           'message': 'x' * FANOUT_MESSAGE_SIZE}).encode())
+        latencies = []
+        for index in range(len(received)):
+            if index == WARMUP:
+                start = time.perf_counter()
+            sent = time.perf_counter()
+            sender.sendFrame(frame)
+            await done[index].wait()
+            if index >= WARMUP:
+                latencies.append(lastArrival[index] - sent)
+        elapsed = time.perf_counter() - start
+        await asyncio.gather(*receiving)
+        return {'members': members, 'messages': messages, 'joinSeconds': joinSeconds,
+                'deliveriesPerSecond': messages * len(receivers) / elapsed,
+                'latencyToLastMs': percentiles(latencies)}
+    finally:
+        await closeAll(clients)
+
+
+async def benchIdleMemory(server: ServerProcess, count: int) -> dict:
+    """Resident memory of the server before and after opening count idle connections"""
+    await asyncio.sleep(0.5)
+    before = server.rss()
+    clients = await connectMany(HOST, server.port, count)
+    try:
+        # let every connection settle (threads started, buffers allocated)
+        await asyncio.sleep(1)
+        after = server.rss()
+    finally:
+        await closeAll(clients)
+    if before is None or after is None:
+        return {'connections': count, 'bytesPerConnection': None}
+    perConnection = (after - before) / count
+    return {'connections': count, 'rssBeforeBytes': before, 'rssAfterBytes': after,
+            'bytesPerConnection': perConnection, 'kilobytesPerConnection': perConnection / 1024}
+
+
+def echoServer(engine: str) -> ServerProcess:
+    return ServerProcess([os.path.join(BENCHMARKS_DIR, 'echo_server.py'), '{port}', engine],
+                         reportsPid=True)
+
+
+def chatServer() -> ServerProcess:
+    # rooms in memory only, the message log has its own costs
+    return ServerProcess(['chat_server.py'], cwd=CHAT_SERVER_DIR, env={'MESSAGE_LOG_DIR': None})
+
+
+async def runEngine(engine: str, scenarios: List[str], scale: int, rng: random.Random) -> dict:
+    """Every echo server scenario against one engine"""
+    results = {}
+    if 'handshake' in scenarios or 'echo' in scenarios:
+        server = echoServer(engine)
+        try:
+            await waitForPort(HOST, server.port)
+            if 'handshake' in scenarios:
+                results['handshake'] = await benchHandshake(
+                    server.port, HANDSHAKES // scale, HANDSHAKE_CONCURRENCY)
+                report(engine, 'handshake', results['handshake'])
+            if 'echo' in scenarios:
+                results['echo'] = await benchEcho(server.port, ECHO_SIZES,
+                                                  ECHO_MESSAGES // scale, rng)
+                for size, result in results['echo'].items():
+                    report(engine, 'echo %s B' % size, result)
+        finally:
+            server.stop()
+    if 'memory' in scenarios:
+        # a fresh server, so nothing is left over from the other scenarios
+        server = echoServer(engine)
+        try:
+            await waitForPort(HOST, server.port)
+            results['idleMemory'] = await benchIdleMemory(server, IDLE_CONNECTIONS // scale)
+            report(engine, 'idle memory', results['idleMemory'])
+        finally:
+            server.stop()
+    return results
+
+
+async def runChat(scale: int) -> dict:
+    results = {}
+    server = chatServer()
+    try:
+        await waitForPort(HOST, server.port)
+        for members in FANOUT_MEMBERS:
+            result = await benchFanout(server.port, members, FANOUT_DELIVERIES // scale)
+            results[str(members)] = result
+            report('chat', 'fanout %d' % members, result)
+    finally:
+        server.stop()
+    return {'fanout': results}
+
+
+def report(engine: str, name: str, result: dict):
+    """One line summary of a scenario result"""
+    parts = []
+    for key, value in result.items():
+        if isinstance(value, dict):
+            parts.append('%s p50=%.3f p99=%.3f' % (key, value.get('p50', 0), value.get('p99', 0)))
+        elif isinstance(value, float):
+            parts.append('%s=%.1f' % (key, value))
+    print('%-6s %-16s %s' % (engine, name, '  '.join(parts)), flush=True)
+
+
+def flatten(results: dict, prefix: str = '') -> Dict[str, float]:
+    """Numeric leaves of a results tree, keyed by their dotted path"""
+    flat = {}
+    for key, value in results.items():
+        path = prefix + str(key)
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def compare(baseline: dict, results: dict):
+    """Print every measurement next to its baseline value"""
+    old = flatten(baseline['results'])
+    new = flatten(results['results'])
+    print('\n%-58s %14s %14s %8s' % ('measurement', 'baseline', 'current', 'change'))
+    for key in sorted(new):
+        if key not in old:
+            continue
+        change = '%+7.1f%%' % ((new[key] - old[key]) / old[key] * 100) if old[key] else '-'
+        print('%-58s %14.3f %14.3f %8s' % (key, old[key], new[key], change))
+
+
+async def run(engines: List[str], scenarios: List[str], scale: int) -> dict:
+    rng = random.Random(SEED)
+    results = {'engines': {}}
+    for engine in engines:
+        results['engines'][engine] = await runEngine(engine, scenarios, scale, rng)
+    if 'fanout' in scenarios:
+        results['chatServer'] = await runChat(scale)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End to end websocket server benchmarks')
+    parser.add_argument('--engines', default=','.join(ENGINES),
+                        help='comma separated engines to run the echo scenarios against')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated scenarios among ' + ', '.join(SCENARIOS))
+    parser.add_argument('--quick', action='store_true',
+                        help='%dx less work, for a quick check' % QUICK_FACTOR)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+    engines = [engine for engine in args.engines.split(',') if engine]
+    scenarios = [scenario for scenario in args.scenarios.split(',') if scenario]
+    for name in engines + scenarios:
+        if name not in ENGINES + SCENARIOS:
+            parser.error('unknown engine or scenario: ' + name)
+    scale = QUICK_FACTOR if args.quick else 1
+    # every connection is a file descriptor, the fan-out rooms need the most
+    raiseFileLimit(max(FANOUT_MEMBERS + [IDLE_CONNECTIONS]) + 1024)
+
+    results = {
+        'version': 1,
+        'startedAt': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'seed': SEED,
+        'quick': args.quick,
+    }
+    results['results'] = asyncio.run(run(engines, scenarios, scale))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(json.load(baseline), results)
+
+
+if __name__ == '__main__':
+    main()
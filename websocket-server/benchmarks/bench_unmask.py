@@ -0,0 +1,77 @@
+"""
+Microbenchmark for payload unmasking, prints MB/s for each implementation
+over payload sizes from 100 B to 16 MB.
+
+Run from the websocket-server directory:
+
+    python3 benchmarks/bench_unmask.py
+"""
+import os
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import wssUtils
+from wssUtils import unmask, unmaskBytewise
+
+SIZES = [100, 1024, 16 * 1024, 256 * 1024, 1024 * 1024, 16 * 1024 * 1024]
+# the byte-at-a-time reference is too slow to be worth timing past this
+BYTEWISE_MAX_SIZE = 1024 * 1024
+# roughly how long to spend timing each implementation and size
+TARGET_SECONDS = 0.2
+
+
+def unmaskInt(data, mask):
+    """unmask with the NumPy path disabled"""
+    numpy = wssUtils.numpy
+    wssUtils.numpy = None
+    try:
+        return unmask(data, mask)
+    finally:
+        wssUtils.numpy = numpy
+
+
+def unmaskQuadratic(data, mask):
+    """The original implementation, builds the result one byte at a time"""
+    unmasked = b''
+    for i, b in enumerate(data):
+        obyte = b ^ mask[i % 4]
+        unmasked += obyte.to_bytes(1, byteorder='big')
+    return unmasked
+
+
+def timeIt(fn, data, mask) -> float:
+    """Returns the throughput of fn over data in MB/s"""
+    runs = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < TARGET_SECONDS:
+        fn(data, mask)
+        runs += 1
+        elapsed = time.perf_counter() - start
+    return len(data) * runs / elapsed / 1e6
+
+
+def main():
+    mask = os.urandom(4)
+    impls = [('quadratic', unmaskQuadratic, 16 * 1024),
+             ('bytewise', unmaskBytewise, BYTEWISE_MAX_SIZE),
+             ('int', unmaskInt, None)]
+    if wssUtils.numpy is not None:
+        impls.append(('unmask (numpy)', unmask, None))
+    print('%-10s' % 'size' + ''.join('%16s' % name for name, _, _ in impls) + '   (MB/s)')
+    for size in SIZES:
+        data = os.urandom(size)
+        expected = unmaskBytewise(data, mask) if size <= BYTEWISE_MAX_SIZE else None
+        row = '%-10d' % size
+        for name, fn, maxSize in impls:
+            if maxSize is not None and size > maxSize:
+                row += '%16s' % '-'
+                continue
+            if expected is not None:
+                assert fn(data, mask) == expected, name
+            row += '%16.1f' % timeIt(fn, data, mask)
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Echo server driven by bench_server.py, every message is sent back as is.
+Prints the pid of the process serving the connections once it is listening.
+
+Run from the websocket-server directory:
+
+    python3 benchmarks/echo_server.py PORT [sync|async] [zerocopy]
+
+zerocopy relays the messages as views over the receive buffer (see the README).
+"""
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def printPid(workerId: int = 0):
+    print(os.getpid(), flush=True)
+
+
+def runSync(port: int, zeroCopy: bool = False):
+    from WebSocketServer import WebSocketServer
+
+    def connectionHandler(ws):
+        ws.onMessage(lambda message, ws: ws.send(message))
+        ws.onClose(lambda ws: None)
+
+    # the connections are served by a forked process, it reports its pid
+    WebSocketServer(port, connectionHandler, onWorkerStart=printPid, zeroCopy=zeroCopy)
+
+
+def runAsync(port: int, zeroCopy: bool = False):
+    from AsyncWebSocketServer import AsyncWebSocketServer
+
+    async def onMessage(message, ws):
+        await ws.send(message)
+
+    async def connectionHandler(ws):
+        ws.onMessage(onMessage)
+        ws.onClose(lambda ws: None)
+
+    printPid()
+    AsyncWebSocketServer(port, connectionHandler, zeroCopy=zeroCopy).run()
+
+
+if __name__ == '__main__':
+    engine = sys.argv[2] if len(sys.argv) > 2 else 'sync'
+    zeroCopy = len(sys.argv) > 3 and sys.argv[3] == 'zerocopy'
+    {'sync': runSync, 'async': runAsync}[engine](int(sys.argv[1]), zeroCopy)
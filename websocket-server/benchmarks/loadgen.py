@@ -0,0 +1,175 @@
+"""
+Asyncio websocket client used to generate load for the benchmarks, a single
+process drives thousands of connections over loopback.
+
+Frames sent by the client are masked with a fixed mask, so the same encoded
+frame can be written any number of times and the client side cost stays out of
+the server measurements.
+"""
+import asyncio
+import base64
+import os
+import resource
+import struct
+import sys
+import time
+from typing import List, Tuple
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from wssFrame import OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG
+from wssUtils import unmask
+
+# the masking key of every client frame, the server unmasks whatever it is
+MASK = b'\x5a\xa5\x3c\xc3'
+# generous, a full listen backlog makes the kernel retry connects after 1s, 3s, 7s...
+CONNECT_TIMEOUT = 30
+
+
+class HandshakeError(Exception):
+    pass
+
+
+def maskedFrame(opcode: int, payload=b'', fin: int = 1) -> bytes:
+    """Returns the bytes of a complete masked client frame"""
+    payloadLen = len(payload)
+    b0 = (fin << 7) | opcode
+    if payloadLen <= 125:
+        header = struct.pack('!BB', b0, 0x80 | payloadLen)
+    elif payloadLen < 65536:
+        header = struct.pack('!BBH', b0, 0x80 | 126, payloadLen)
+    else:
+        header = struct.pack('!BBQ', b0, 0x80 | 127, payloadLen)
+    return header + MASK + unmask(payload, MASK)
+
+
+CLOSE_FRAME = maskedFrame(OP_CLOSE, struct.pack('!H', 1000))
+
+
+class Client:
+    """One websocket connection to the server under test"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+
+    @classmethod
+    async def connect(cls, host: str, port: int, path: str = '/') -> 'Client':
+        """Open a connection and do the websocket handshake"""
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), CONNECT_TIMEOUT)
+        key = base64.b64encode(os.urandom(16))
+        writer.write(b'GET ' + path.encode() + b' HTTP/1.1\r\nHost: ' + host.encode() +
+                     b'\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                     b'Sec-WebSocket-Key: ' + key + b'\r\nSec-WebSocket-Version: 13\r\n\r\n')
+        try:
+            response = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), CONNECT_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            writer.close()
+            raise HandshakeError('no handshake response')
+        if not response.startswith(b'HTTP/1.1 101'):
+            writer.close()
+            raise HandshakeError(response.split(b'\r\n', 1)[0].decode(errors='replace'))
+        return cls(reader, writer)
+
+    def sendFrame(self, frame: bytes):
+        """Write an already encoded frame (see maskedFrame)"""
+        self.writer.write(frame)
+
+    def send(self, data):
+        """Send a message, accepts bytes or string"""
+        if type(data) == str:
+            self.writer.write(maskedFrame(OP_TEXT, data.encode()))
+        else:
+            self.writer.write(maskedFrame(OP_BINARY, data))
+
+    async def recvFrame(self) -> Tuple[int, int, bytes]:
+        """Returns the next (fin, opcode, payload) sent by the server, answers pings"""
+        while True:
+            header = await self.reader.readexactly(2)
+            payloadLen = header[1] & 0x7f
+            if payloadLen == 126:
+                payloadLen = struct.unpack('!H', await self.reader.readexactly(2))[0]
+            elif payloadLen == 127:
+                payloadLen = struct.unpack('!Q', await self.reader.readexactly(8))[0]
+            payload = await self.reader.readexactly(payloadLen) if payloadLen else b''
+            opcode = header[0] & 0xf
+            if opcode == OP_PING:
+                self.writer.write(maskedFrame(OP_PONG, payload))
+                continue
+            return header[0] >> 7, opcode, payload
+
+    async def recv(self) -> Tuple[int, bytes]:
+        """Returns the next (opcode, payload) message, reassembling fragments"""
+        fin, opcode, payload = await self.recvFrame()
+        if fin:
+            return opcode, payload
+        parts = [payload]
+        while not fin:
+            fin, _, payload = await self.recvFrame()
+            parts.append(payload)
+        return opcode, b''.join(parts)
+
+    async def close(self):
+        """Send a close frame and drop the connection without waiting for the answer"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.writer.write(CLOSE_FRAME)
+            self.writer.close()
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+
+async def connectMany(host: str, port: int, count: int, concurrency: int = 20,
+                      path: str = '/') -> List[Client]:
+    """Open count connections, at most concurrency handshakes at a time"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def connectOne():
+        async with semaphore:
+            return await Client.connect(host, port, path)
+
+    return list(await asyncio.gather(*(connectOne() for _ in range(count))))
+
+
+async def closeAll(clients: List[Client]):
+    await asyncio.gather(*(client.close() for client in clients))
+
+
+def percentiles(samples: List[float], scale: float = 1e3) -> dict:
+    """Summary of the given durations (seconds), in milliseconds by default"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def at(fraction: float) -> float:
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * scale
+
+    return {'count': len(ordered), 'min': ordered[0] * scale, 'p50': at(0.50),
+            'p90': at(0.90), 'p99': at(0.99), 'max': ordered[-1] * scale,
+            'mean': sum(ordered) / len(ordered) * scale}
+
+
+def raiseFileLimit(needed: int):
+    """Raise the open files limit of this process as far as allowed, each connection
+    uses a file descriptor"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+
+
+async def waitForPort(host: str, port: int, timeout: float = 10):
+    """Wait until something accepts connections on the given port"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
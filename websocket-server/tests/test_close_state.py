@@ -0,0 +1,113 @@
+"""
+Once a connection sent its close frame nothing but control frames may follow it
+(RFC 6455 5.5.1), whatever path the data takes.
+
+Run from the websocket-server directory:
+
+    python3 -m unittest discover tests
+"""
+import asyncio
+import os
+import socket
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from wssFrame import OP_BINARY, OP_CLOSE, OP_TEXT
+from wssTimers import Keepalive, KeepaliveOptions, getTimerWheel
+
+
+def readFrames(sock: socket.socket, timeout: float = 0.2) -> list:
+    """Opcodes of the (unmasked, short) server frames received within timeout"""
+    sock.settimeout(timeout)
+    data = b''
+    try:
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    except socket.timeout:
+        pass
+    opcodes = []
+    while len(data) >= 2:
+        opcodes.append(data[0] & 0xf)
+        data = data[2 + (data[1] & 0x7f):]
+    return opcodes
+
+
+class CloseStateTest(unittest.TestCase):
+
+    def test_stream_stops_at_close(self):
+        from WebSocketServer import WebSocketConnection
+        server, client = socket.socketpair()
+        conn = WebSocketConnection(server)
+
+        def chunks():
+            yield b'first'
+            conn.close(1001)
+            yield b'second'
+
+        self.assertFalse(conn.sendStream(chunks(), chunkSize=5))
+        self.assertEqual(readFrames(client), [OP_BINARY, OP_CLOSE])
+
+
+    def test_no_pings_after_close_without_timeout(self):
+        keepalive = Keepalive(KeepaliveOptions(pingInterval=1, closeTimeout=None), now=0)
+        self.assertIsNone(keepalive.closing(0.5))
+        self.assertEqual(keepalive.check(10), (None, None))
+
+    def test_close_cancels_keepalive_timer(self):
+        from WebSocketServer import WebSocketConnection
+        server, client = socket.socketpair()
+        options = KeepaliveOptions(pingInterval=0.05, closeTimeout=None)
+        conn = WebSocketConnection(server, keepalive=options, timerWheel=getTimerWheel())
+        conn._schedule(conn.keepalive.firstDeadline())
+        timer = conn.timer
+        conn.close(1001)
+        self.assertTrue(timer.cancelled)
+        self.assertEqual(readFrames(client), [OP_CLOSE])
+
+
+class AsyncCloseStateTest(unittest.TestCase):
+
+    def test_broadcast_skips_closing_connections(self):
+        from AsyncWebSocketServer import AsyncWebSocketConnection, AsyncWebSocketServer
+
+        async def run():
+            pairs = [socket.socketpair() for _ in range(2)]
+            conns = []
+            for server, _ in pairs:
+                reader, writer = await asyncio.open_connection(sock=server)
+                conns.append(AsyncWebSocketConnection(reader, writer))
+            await conns[0].close(1001)
+            await AsyncWebSocketServer.broadcast(conns, 'hello')
+            await asyncio.sleep(0.05)
+            return [readFrames(client) for _, client in pairs]
+
+        closing, open_ = asyncio.run(run())
+        self.assertEqual(closing, [OP_CLOSE])
+        self.assertEqual(open_, [OP_TEXT])
+
+    def test_stream_stops_at_close(self):
+        from AsyncWebSocketServer import AsyncWebSocketConnection
+
+        async def run():
+            server, client = socket.socketpair()
+            reader, writer = await asyncio.open_connection(sock=server)
+            conn = AsyncWebSocketConnection(reader, writer)
+
+            async def chunks():
+                yield b'first'
+                await conn.close(1001)
+                yield b'second'
+
+            sent = await conn.sendStream(chunks(), chunkSize=5)
+            await asyncio.sleep(0.05)
+            return sent, readFrames(client)
+
+        self.assertEqual(asyncio.run(run()), (False, [OP_BINARY, OP_CLOSE]))
+
+
+if __name__ == '__main__':
+    unittest.main()
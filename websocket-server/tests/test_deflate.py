@@ -0,0 +1,153 @@
+"""
+permessage-deflate negotiation and compressed round trips.
+
+Run from the websocket-server directory:
+
+    python3 -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+import zlib
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from wssDeflate import DeflateOptions, PerMessageDeflate, parseExtensions
+from wssFrame import FrameDecoder, MessageTooBigError, OP_TEXT, RSV1
+
+MESSAGE = b'{"type": "receive-message", "name": "x", "message": "hello hello"}' * 8
+
+
+def clientCompressor(windowBits: int = 15):
+    return zlib.compressobj(6, zlib.DEFLATED, -windowBits)
+
+
+def clientCompress(compressor, data: bytes) -> bytes:
+    """A message compressed the way a client does it, the sync flush tail removed"""
+    out = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    assert out.endswith(b'\x00\x00\xff\xff')
+    return out[:-4]
+
+
+def clientDecompress(decompressor, data: bytes) -> bytes:
+    return decompressor.decompress(data + b'\x00\x00\xff\xff')
+
+
+class NegotiationTest(unittest.TestCase):
+
+    def test_parse_extensions(self):
+        self.assertEqual(
+            parseExtensions('permessage-deflate; client_max_window_bits, '
+                            'x-foo;bar="1", Permessage-Deflate ;server_max_window_bits=10'),
+            [('permessage-deflate', {'client_max_window_bits': None}),
+             ('x-foo', {'bar': '1'}),
+             ('permessage-deflate', {'server_max_window_bits': '10'})])
+
+    def test_plain_offer(self):
+        deflate, header = DeflateOptions().negotiate('permessage-deflate')
+        self.assertEqual(header, 'permessage-deflate')
+        self.assertFalse(deflate.serverNoContextTakeover)
+        self.assertIsNone(deflate.shareKey)
+
+    def test_no_offer(self):
+        self.assertIsNone(DeflateOptions().negotiate('x-webkit-deflate-frame'))
+        self.assertIsNone(DeflateOptions().negotiate(''))
+
+    def test_first_acceptable_offer(self):
+        # unknown parameters and invalid window bits decline the offer, not the header
+        deflate, header = DeflateOptions().negotiate(
+            'permessage-deflate; x=1, permessage-deflate; server_max_window_bits=8, '
+            'permessage-deflate; server_max_window_bits=10; client_max_window_bits')
+        self.assertEqual(header, 'permessage-deflate; server_max_window_bits=10')
+        self.assertEqual(deflate.serverMaxWindowBits, 10)
+
+    def test_no_context_takeover(self):
+        deflate, header = DeflateOptions().negotiate(
+            'permessage-deflate; server_no_context_takeover; client_no_context_takeover')
+        self.assertEqual(header, 'permessage-deflate; server_no_context_takeover')
+        self.assertTrue(deflate.serverNoContextTakeover)
+        self.assertIsNotNone(deflate.shareKey)
+        # the server can ask for it without the client offering it
+        deflate, header = DeflateOptions(serverNoContextTakeover=True,
+                                         clientNoContextTakeover=True).negotiate(
+            'permessage-deflate')
+        self.assertEqual(
+            header, 'permessage-deflate; server_no_context_takeover; client_no_context_takeover')
+        self.assertTrue(deflate.serverNoContextTakeover)
+        self.assertIsNone(DeflateOptions().negotiate(
+            'permessage-deflate; server_no_context_takeover=1'))
+
+    def test_client_max_window_bits(self):
+        options = DeflateOptions(clientMaxWindowBits=12)
+        self.assertEqual(options.negotiate('permessage-deflate; client_max_window_bits')[1],
+                         'permessage-deflate; client_max_window_bits=12')
+        self.assertEqual(options.negotiate('permessage-deflate; client_max_window_bits=10')[1],
+                         'permessage-deflate; client_max_window_bits=10')
+        # not announced by the client, so not sent
+        self.assertEqual(options.negotiate('permessage-deflate')[1], 'permessage-deflate')
+
+
+class RoundTripTest(unittest.TestCase):
+
+    def test_server_to_client(self):
+        deflate = PerMessageDeflate()
+        decompressor = zlib.decompressobj(-15)
+        sizes = []
+        for _ in range(3):
+            frame = deflate.encodeFrame(OP_TEXT, MESSAGE)
+            decoder = FrameDecoder()
+            decoder.feed(frame)
+            ((fin, rsv, opcode, payload),) = list(decoder)
+            self.assertEqual((fin, rsv, opcode), (1, RSV1, OP_TEXT))
+            self.assertEqual(clientDecompress(decompressor, bytes(payload)), MESSAGE)
+            sizes.append(len(payload))
+        # with context takeover a repeated message costs a few bytes
+        self.assertLess(sizes[1], sizes[0] // 4)
+
+    def test_small_messages_uncompressed(self):
+        frame = PerMessageDeflate(minSize=256).encodeFrame(OP_TEXT, b'hi')
+        self.assertEqual(frame, b'\x81\x02hi')
+
+    def test_server_no_context_takeover(self):
+        deflate = PerMessageDeflate(serverNoContextTakeover=True)
+        frames = [deflate.encodeFrame(OP_TEXT, MESSAGE) for _ in range(3)]
+        # every message compressed alone, so broadcasts can share the frame
+        self.assertEqual(len(set(frames)), 1)
+        self.assertEqual(frames[0], PerMessageDeflate(serverNoContextTakeover=True)
+                         .encodeFrame(OP_TEXT, MESSAGE))
+        for frame in frames:
+            decoder = FrameDecoder()
+            decoder.feed(frame)
+            payload = bytes(list(decoder)[0][3])
+            self.assertEqual(clientDecompress(zlib.decompressobj(-15), payload), MESSAGE)
+
+    def test_client_to_server(self):
+        # the client keeps its context across messages, the server must too
+        deflate = PerMessageDeflate()
+        compressor = clientCompressor(10)
+        for _ in range(3):
+            self.assertEqual(deflate.decompress(clientCompress(compressor, MESSAGE)), MESSAGE)
+
+    def test_client_no_context_takeover(self):
+        deflate = PerMessageDeflate()
+        for _ in range(3):
+            self.assertEqual(deflate.decompress(clientCompress(clientCompressor(), MESSAGE)),
+                             MESSAGE)
+
+    def test_fragments(self):
+        deflate = PerMessageDeflate()
+        data = clientCompress(clientCompressor(), MESSAGE)
+        middle = len(data) // 2
+        out = deflate.decompress(data[:middle], final=False)
+        out += deflate.decompress(data[middle:])
+        self.assertEqual(out, MESSAGE)
+
+    def test_inflate_limit(self):
+        deflate = PerMessageDeflate()
+        data = clientCompress(clientCompressor(), b'x' * 100000)
+        with self.assertRaises(MessageTooBigError):
+            deflate.decompress(data, maxSize=65536)
+        self.assertEqual(PerMessageDeflate().decompress(data, maxSize=100000), b'x' * 100000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+FrameDecoder yields the same frames however the bytes are split across reads,
+and keeps its receive buffer small between busy periods.
+
+Run from the websocket-server directory:
+
+    python3 -m unittest discover tests
+"""
+import os
+import socket
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+from wssFrame import FrameDecoder, MessageAssembler, MessageTooBigError, DEFAULT_BUFFER_SIZE, \
+    DEFAULT_READ_SIZE, OP_BINARY, OP_CLOSE, OP_CONTINUATION, OP_PING, OP_TEXT
+from loadgen import maskedFrame
+
+
+class DecoderTest(unittest.TestCase):
+
+    def decode(self, data: bytes, step: int) -> list:
+        """Frames decoded from data fed step bytes at a time"""
+        decoder = FrameDecoder()
+        frames = []
+        for offset in range(0, len(data), step):
+            decoder.feed(data[offset:offset + step])
+            frames.extend(decoder)
+        self.assertEqual(decoder.end - decoder.start, 0)
+        return frames
+
+    def test_split_anywhere(self):
+        # 7, 16 and 64 bit lengths, fed whole and one byte at a time (partial headers,
+        # partial masking keys, partial payloads)
+        payloads = [b'', b'a' * 125, b'b' * 126, b'c' * 65535, b'd' * 65536, b'e' * 70000]
+        data = b''.join(maskedFrame(OP_BINARY, payload) for payload in payloads)
+        for step in (len(data), 65536, 1000, 7, 1):
+            frames = self.decode(data, step)
+            self.assertEqual([frame[3] for frame in frames], payloads, step)
+            self.assertEqual({frame[:3] for frame in frames}, {(1, 0, OP_BINARY)})
+
+    def test_header_lengths(self):
+        decoder = FrameDecoder()
+        for payload in (b'x' * 126, b'y' * 65536):
+            frame = maskedFrame(OP_TEXT, payload)
+            # 2 bytes then the extended length and the masking key
+            self.assertEqual(len(frame) - len(payload), 8 if len(payload) < 65536 else 14)
+            decoder.feed(frame[:3])
+            self.assertEqual(list(decoder), [])
+            decoder.feed(frame[3:])
+            self.assertEqual(list(decoder), [(1, 0, OP_TEXT, payload)])
+
+    def test_control_frames_between_fragments(self):
+        data = b''.join((maskedFrame(OP_TEXT, b'hel', fin=0), maskedFrame(OP_PING, b'p'),
+                         maskedFrame(OP_CONTINUATION, b'lo', fin=0),
+                         maskedFrame(OP_CLOSE, b'\x03\xe8'),
+                         maskedFrame(OP_CONTINUATION, b'!')))
+        for step in (len(data), 3):
+            frames = self.decode(data, step)
+            self.assertEqual([frame[2] for frame in frames],
+                             [OP_TEXT, OP_PING, OP_CONTINUATION, OP_CLOSE, OP_CONTINUATION])
+            assembler = MessageAssembler()
+            messages = [assembler.add(*frame) for frame in frames if not frame[2] & 0x8]
+            self.assertEqual(messages[-1][1], 'hello!')
+
+    def test_unmasked_frame(self):
+        decoder = FrameDecoder()
+        decoder.feed(b'\x82\x03abc')
+        self.assertEqual(list(decoder), [(1, 0, OP_BINARY, b'abc')])
+
+    def test_oversize_frame(self):
+        decoder = FrameDecoder(maxFrameSize=1000)
+        decoder.feed(maskedFrame(OP_BINARY, b'x' * 1000)[:2 + 2 + 4])
+        self.assertEqual(list(decoder), [])
+        decoder = FrameDecoder(maxFrameSize=1000)
+        # refused from its header, before any of the payload arrives
+        decoder.feed(maskedFrame(OP_BINARY, b'x' * 1001)[:4])
+        with self.assertRaises(MessageTooBigError):
+            list(decoder)
+
+
+class DecoderBufferTest(unittest.TestCase):
+
+    def test_starts_small(self):
+        self.assertEqual(len(FrameDecoder().buffer), DEFAULT_BUFFER_SIZE)
+
+    def test_shrinks_after_large_frame(self):
+        decoder = FrameDecoder()
+        decoder.feed(maskedFrame(OP_BINARY, b'x' * 200000) + maskedFrame(OP_TEXT, b'hi')[:3])
+        (frame,) = list(decoder)
+        self.assertEqual(len(frame[3]), 200000)
+        # the start of the next frame is kept
+        self.assertEqual(len(decoder.buffer), DEFAULT_BUFFER_SIZE)
+        decoder.feed(maskedFrame(OP_TEXT, b'hi')[3:])
+        self.assertEqual([frame[3] for frame in decoder], [b'hi'])
+
+    def test_reads_grow_then_shrink(self):
+        server, client = socket.socketpair()
+        decoder = FrameDecoder()
+        data = b''.join(maskedFrame(OP_BINARY, b'x' * 1000) for _ in range(300))
+        client.sendall(data[:200000])
+        sizes = []
+        received = 0
+        while received < 200000:
+            received += decoder.recvInto(server)
+            sizes.append(len(decoder.buffer))
+            list(decoder)
+        # full reads double the buffer up to the read size
+        self.assertEqual(max(sizes), DEFAULT_READ_SIZE)
+        client.sendall(data[200000:])
+        while received < len(data):
+            received += decoder.recvInto(server)
+            list(decoder)
+        client.sendall(maskedFrame(OP_TEXT, b'hi'))
+        decoder.recvInto(server)
+        list(decoder)
+        # a small read on an empty buffer means the burst is over
+        self.assertEqual(len(decoder.buffer), DEFAULT_BUFFER_SIZE)
+        server.close()
+        client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""
+The struct based encoders build the same bytes as the bit-string WSFrame they
+replaced.
+
+Run from the websocket-server directory:
+
+    python3 -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from wssFrame import encodeFrame, encodeFrameParts, OP_BINARY, OP_CLOSE, OP_CONTINUATION, \
+    OP_PING, OP_PONG, OP_TEXT
+from wssUtils import bs2b
+
+# around every boundary of the 7, 16 and 64 bit payload lengths
+SIZES = [0, 1, 125, 126, 127, 16383, 16384, 65535, 65536, 70000]
+OPCODES = [OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG]
+
+
+def oldFrame(opcode: int, payload: bytes) -> bytes:
+    """The frame the bit-string WSFrame built: fin set, the length as a bit string
+    turned into bytes"""
+    plen = len(payload)
+    bits = bin(plen)[2:]
+    if plen <= 125:
+        lengthBits = bits
+    elif plen < 65536:
+        lengthBits = bin(126)[2:] + '0' * (16 - len(bits)) + bits
+    else:
+        lengthBits = bin(127)[2:] + '0' * (64 - len(bits)) + bits
+    return (0x80 ^ opcode).to_bytes(1, 'big') + bs2b(lengthBits) + payload
+
+
+class FrameEncodingTest(unittest.TestCase):
+
+    def test_encode_frame(self):
+        for opcode in OPCODES:
+            for size in SIZES:
+                payload = bytes(range(256)) * (size // 256) + bytes(range(size % 256))
+                expected = oldFrame(opcode, payload)
+                self.assertEqual(encodeFrame(opcode, payload), expected, (opcode, size))
+                parts = encodeFrameParts(opcode, payload)
+                if type(parts) is tuple:
+                    parts = b''.join(parts)
+                self.assertEqual(parts, expected, (opcode, size))
+
+    def test_wsframe(self):
+        from WebSocketServer import WSFrame
+        for size in SIZES:
+            payload = b'x' * size
+            frame = WSFrame(b'')
+            frame.set_opcode(OP_BINARY)
+            frame.set_payload_len(size)
+            frame.set_payload_data(payload)
+            self.assertEqual(frame.get_bytes(), oldFrame(OP_BINARY, payload))
+            self.assertEqual(b''.join(frame.get_parts()), oldFrame(OP_BINARY, payload))
+
+    def test_fin_and_rsv(self):
+        # the old encoder always set fin and never rsv, fragments and compressed
+        # frames only differ in the first byte
+        payload = b'x' * 300
+        rest = oldFrame(OP_TEXT, payload)[1:]
+        self.assertEqual(encodeFrame(OP_TEXT, payload, fin=0), b'\x01' + rest)
+        self.assertEqual(encodeFrame(OP_CONTINUATION, payload, rsv=4), b'\xc0' + rest)
+        self.assertEqual(encodeFrame(OP_TEXT, payload, fin=0, rsv=4), b'\x41' + rest)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+"""
+Frames announcing more than the server accepts must be refused as soon as their
+header arrives, before anything is allocated for their payload.
+
+Run from the websocket-server directory:
+
+    python3 -m unittest discover tests
+"""
+import asyncio
+import os
+import socket
+import struct
+import sys
+import threading
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+from wssFrame import FrameDecoder, MessageAssembler, MessageTooBigError, \
+    CLOSE_MESSAGE_TOO_BIG, OP_BINARY, OP_CONTINUATION, OP_CLOSE
+from loadgen import maskedFrame, MASK
+
+# a masked binary frame header announcing 2^62 bytes of payload
+HUGE_HEADER = struct.pack('!BBQ', 0x80 | OP_BINARY, 0x80 | 127, 1 << 62) + MASK
+
+
+def recvCloseCode(sock: socket.socket) -> int:
+    """Read server frames off a blocking socket until the close frame, returns its code"""
+    data = b''
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise AssertionError('connection closed without a close frame')
+        data += chunk
+        while len(data) >= 2:
+            length = data[1] & 0x7f
+            offset = 2
+            if length == 126:
+                (length,) = struct.unpack_from('!H', data, 2)
+                offset = 4
+            if len(data) < offset + length:
+                break
+            if data[0] & 0xf == OP_CLOSE:
+                return struct.unpack_from('!H', data, offset)[0]
+            data = data[offset + length:]
+
+
+class DecoderLimitsTest(unittest.TestCase):
+
+    def test_huge_header_without_frame_limit(self):
+        assembler = MessageAssembler(maxMessageSize=1000)
+        decoder = FrameDecoder(maxMessageSize=1000, assembler=assembler)
+        decoder.feed(HUGE_HEADER)
+        with self.assertRaises(MessageTooBigError):
+            list(decoder)
+        self.assertEqual(len(decoder.buffer), decoder.bufferSize)
+
+    def test_fragment_past_message_size(self):
+        assembler = MessageAssembler(maxMessageSize=1000)
+        decoder = FrameDecoder(maxMessageSize=1000, assembler=assembler)
+        decoder.feed(maskedFrame(OP_BINARY, b'x' * 600, fin=0))
+        for frame in decoder:
+            self.assertIsNone(assembler.add(*frame))
+        # only the header of the continuation frame is sent
+        decoder.feed(struct.pack('!BBH', 0x80 | OP_CONTINUATION, 0x80 | 126, 500) + MASK)
+        with self.assertRaises(MessageTooBigError):
+            list(decoder)
+
+    def test_message_at_limit(self):
+        assembler = MessageAssembler(maxMessageSize=1000)
+        decoder = FrameDecoder(maxMessageSize=1000, assembler=assembler)
+        decoder.feed(maskedFrame(OP_BINARY, b'x' * 1000))
+        (frame,) = list(decoder)
+        self.assertEqual(assembler.add(*frame)[1], b'x' * 1000)
+
+    def test_buffer_growth_is_capped(self):
+        decoder = FrameDecoder(maxMessageSize=1000)
+        with self.assertRaises(MessageTooBigError):
+            decoder._reserve(1 << 40)
+
+    def test_frames_at_limit_fed_in_reads(self):
+        # reads hold the tail of a frame and the start of the next ones
+        assembler = MessageAssembler(maxMessageSize=100000)
+        decoder = FrameDecoder(maxMessageSize=100000, assembler=assembler)
+        stream = b''.join(maskedFrame(OP_BINARY, bytes([i]) * 100000) for i in range(5))
+        messages = []
+        for offset in range(0, len(stream), 65536):
+            decoder.feed(stream[offset:offset + 65536])
+            messages.extend(assembler.add(*frame)[1] for frame in decoder)
+        self.assertEqual(messages, [bytes([i]) * 100000 for i in range(5)])
+        self.assertLessEqual(len(decoder.buffer), decoder.maxBufferSize)
+
+
+class ConnectionLimitsTest(unittest.TestCase):
+
+    def test_threaded_connection_closes_with_1009(self):
+        from WebSocketServer import WebSocketConnection
+        server, client = socket.socketpair()
+        conn = WebSocketConnection(server, maxMessageSize=1000)
+        closed = threading.Event()
+        conn.onMessage(lambda message, conn: None)
+        conn.onClose(lambda conn: closed.set())
+        thread = threading.Thread(target=conn._listen, daemon=True)
+        thread.start()
+        client.settimeout(5)
+        client.sendall(HUGE_HEADER)
+        self.assertEqual(recvCloseCode(client), CLOSE_MESSAGE_TOO_BIG)
+        self.assertTrue(closed.wait(5))
+        thread.join(5)
+        client.close()
+
+    def test_asyncio_connection_closes_with_1009(self):
+        from AsyncWebSocketServer import AsyncWebSocketConnection
+
+        async def run():
+            server, client = socket.socketpair()
+            reader, writer = await asyncio.open_connection(sock=server)
+            conn = AsyncWebSocketConnection(reader, writer, maxMessageSize=1000)
+            closed = asyncio.Event()
+            conn.onMessage(lambda message, conn: None)
+            conn.onClose(lambda conn: closed.set())
+            client.sendall(HUGE_HEADER)
+            listening = asyncio.ensure_future(conn._listen())
+            client.settimeout(5)
+            code = await asyncio.get_event_loop().run_in_executor(None, recvCloseCode, client)
+            await asyncio.wait_for(closed.wait(), 5)
+            await asyncio.wait_for(listening, 5)
+            client.close()
+            return code
+
+        self.assertEqual(asyncio.run(run()), CLOSE_MESSAGE_TOO_BIG)
+
+
+if __name__ == '__main__':
+    unittest.main()
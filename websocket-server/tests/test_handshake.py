@@ -0,0 +1,132 @@
+"""
+Parsing and answering the HTTP upgrade request.
+
+Run from the websocket-server directory:
+
+    python3 -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from wssDeflate import DeflateOptions
+from wssHandshake import acceptToken, answerHandshake, hasToken, parseRequest, validKey, \
+    BAD_REQUEST, UPGRADE_REQUIRED
+from wssMetrics import Metrics
+
+# the sample handshake of RFC 6455 section 1.3
+KEY = 'dGhlIHNhbXBsZSBub25jZQ=='
+ACCEPT = 's3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+
+
+def head(*headers: str, requestLine: str = 'GET /chat HTTP/1.1') -> bytes:
+    return '\r\n'.join((requestLine, 'Host: example.com') + headers).encode()
+
+
+def upgradeHead(*extra: str, **kwargs) -> bytes:
+    return head('Upgrade: websocket', 'Connection: Upgrade', 'Sec-WebSocket-Key: ' + KEY,
+                'Sec-WebSocket-Version: 13', *extra, **kwargs)
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_parse(self):
+        request = parseRequest(upgradeHead('Origin: http://example.com'))
+        self.assertEqual((request.method, request.path), ('GET', '/chat'))
+        # only the handshake headers are kept
+        self.assertEqual(request.headers, {'upgrade': 'websocket', 'connection': 'Upgrade',
+                                           'key': KEY, 'version': '13'})
+
+    def test_header_names_any_case(self):
+        request = parseRequest(head('UPGRADE: websocket', 'sec-websocket-KEY:  ' + KEY))
+        self.assertEqual(request.headers, {'upgrade': 'websocket', 'key': KEY})
+
+    def test_repeated_headers_joined(self):
+        request = parseRequest(head('Sec-WebSocket-Extensions: permessage-deflate',
+                                    'Sec-WebSocket-Extensions: x-foo'))
+        self.assertEqual(request.headers['extensions'], 'permessage-deflate, x-foo')
+
+    def test_malformed_request_line(self):
+        self.assertIsNone(parseRequest(b'GET /chat'))
+        self.assertIsNone(parseRequest(b'GET /chat FTP/1.0'))
+        self.assertIsNone(parseRequest(b'\x16\x03\x01\x02\x00'))
+
+    def test_tokens(self):
+        self.assertTrue(hasToken('keep-alive, Upgrade', 'upgrade'))
+        self.assertTrue(hasToken('WebSocket', 'websocket'))
+        self.assertFalse(hasToken('keep-alive', 'upgrade'))
+        self.assertFalse(hasToken('upgrades', 'upgrade'))
+        self.assertFalse(hasToken(None, 'upgrade'))
+
+    def test_keys(self):
+        self.assertTrue(validKey(KEY))
+        self.assertFalse(validKey(None))
+        self.assertFalse(validKey('dGhlIHNhbXBsZSBub25jZQ='))
+        # 24 characters, but not base64 of 16 bytes
+        self.assertFalse(validKey('dGhlIHNhbXBsZSBub25jZ!=='))
+        self.assertFalse(validKey('dGhlIHNhbXBsZSBub25jZXh4'))
+
+
+class AnswerTest(unittest.TestCase):
+
+    def answer(self, data: bytes, deflate=None, metrics=None):
+        return answerHandshake(parseRequest(data), deflate, metrics)
+
+    def test_accept_token(self):
+        self.assertEqual(acceptToken(KEY), ACCEPT)
+
+    def test_switching_protocols(self):
+        response, upgraded, negotiated = self.answer(upgradeHead())
+        self.assertTrue(upgraded)
+        self.assertIsNone(negotiated)
+        self.assertEqual(response, b'HTTP/1.1 101 Switching Protocols\r\n'
+                                   b'Upgrade: websocket\r\n'
+                                   b'Connection: Upgrade\r\n'
+                                   b'Sec-WebSocket-Accept: ' + ACCEPT.encode() + b'\r\n\r\n')
+
+    def test_browser_headers(self):
+        # Firefox sends "keep-alive, Upgrade", tokens are case insensitive
+        data = head('upgrade: WebSocket', 'connection: keep-alive, Upgrade',
+                    'Sec-WebSocket-Key: ' + KEY, 'Sec-WebSocket-Version: 13')
+        self.assertTrue(self.answer(data)[1])
+
+    def test_rejected(self):
+        self.assertEqual(self.answer(b'not http'), (BAD_REQUEST, False, None))
+        requests = [
+            upgradeHead(requestLine='POST /chat HTTP/1.1'),
+            head('Connection: Upgrade', 'Sec-WebSocket-Key: ' + KEY, 'Sec-WebSocket-Version: 13'),
+            head('Upgrade: websocket', 'Connection: keep-alive', 'Sec-WebSocket-Key: ' + KEY,
+                 'Sec-WebSocket-Version: 13'),
+            head('Upgrade: websocket', 'Connection: Upgrade', 'Sec-WebSocket-Key: nope',
+                 'Sec-WebSocket-Version: 13'),
+            head('Upgrade: websocket', 'Connection: Upgrade', 'Sec-WebSocket-Version: 13'),
+        ]
+        metrics = Metrics()
+        for data in requests:
+            self.assertEqual(self.answer(data, metrics=metrics), (BAD_REQUEST, False, None), data)
+        self.assertEqual(metrics.handshakesFailed.value, len(requests))
+        self.assertEqual(metrics.handshakes.value, 0)
+
+    def test_wrong_version(self):
+        data = head('Upgrade: websocket', 'Connection: Upgrade', 'Sec-WebSocket-Key: ' + KEY,
+                    'Sec-WebSocket-Version: 8')
+        self.assertEqual(self.answer(data), (UPGRADE_REQUIRED, False, None))
+
+    def test_deflate(self):
+        data = upgradeHead('Sec-WebSocket-Extensions: permessage-deflate; '
+                           'client_max_window_bits')
+        response, upgraded, negotiated = self.answer(data, DeflateOptions())
+        self.assertTrue(upgraded)
+        self.assertIsNotNone(negotiated)
+        self.assertTrue(response.endswith(
+            b'\r\nSec-WebSocket-Extensions: permessage-deflate\r\n\r\n'))
+        # not offered, or not enabled on the server
+        self.assertIsNone(self.answer(upgradeHead(), DeflateOptions())[2])
+        response, _, negotiated = self.answer(data)
+        self.assertIsNone(negotiated)
+        self.assertNotIn(b'Sec-WebSocket-Extensions', response)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+"""
+A handshake counts as completed once its 101 response is sent, upgrades refused
+afterwards (draining, connection limits) aren't.
+
+Run from the websocket-server directory:
+
+    python3 -m unittest discover tests
+"""
+import asyncio
+import os
+import socket
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from wssMetrics import Metrics
+
+UPGRADE = (b'GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n'
+           b'Connection: Upgrade\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+           b'Sec-WebSocket-Version: 13\r\n\r\n')
+
+
+class AsyncHandshakeMetricsTest(unittest.TestCase):
+
+    def handshake(self, draining: bool):
+        from AsyncWebSocketServer import AsyncWebSocketServer
+        metrics = Metrics()
+        wss = AsyncWebSocketServer(0, lambda conn: None, metrics=metrics)
+        wss.draining = draining
+
+        async def run():
+            server, client = socket.socketpair()
+            reader, writer = await asyncio.open_connection(sock=server)
+            client.sendall(UPGRADE)
+            upgraded, _ = await wss._handshake(reader, writer, '127.0.0.1')
+            writer.close()
+            status = client.recv(65536).split(b'\r\n', 1)[0]
+            client.close()
+            return upgraded, status
+
+        upgraded, status = asyncio.run(run())
+        return upgraded, status, metrics.handshakes.value, metrics.handshakesFailed.value
+
+    def test_completed_handshake(self):
+        self.assertEqual(self.handshake(False),
+                         (True, b'HTTP/1.1 101 Switching Protocols', 1, 0))
+
+    def test_draining_refusal_is_not_completed(self):
+        self.assertEqual(self.handshake(True),
+                         (False, b'HTTP/1.1 503 Service Unavailable', 0, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+Token buckets, admission control and the per-IP message rate.
+
+Run from the websocket-server directory:
+
+    python3 -m unittest discover tests
+"""
+import os
+import sys
+import time
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from wssHandshake import SERVICE_UNAVAILABLE, TOO_MANY_REQUESTS
+from wssLimits import Limiter, LimitOptions, TokenBucket, RATE_POLICY_CLOSE
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        now = bucket.updated
+        self.assertEqual(bucket.take(now), 0)
+        self.assertEqual(bucket.take(now), 0)
+        # out of tokens, the next one comes in 1/10 s
+        self.assertAlmostEqual(bucket.take(now), 0.1)
+        # a second later the bucket is full again, not over its burst
+        self.assertEqual(bucket.take(now + 1.1), 0)
+        self.assertAlmostEqual(bucket.tokens, 1)
+
+    def test_full_at(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        now = bucket.updated
+        self.assertEqual(bucket.fullAt(), now)
+        bucket.take(now)
+        bucket.take(now)
+        self.assertAlmostEqual(bucket.fullAt(), now + 0.2)
+
+
+class LimiterTest(unittest.TestCase):
+
+    def test_max_connections(self):
+        limiter = Limiter(LimitOptions(maxConnections=2))
+        self.assertIsNone(limiter.admit('10.0.0.1'))
+        self.assertIsNone(limiter.admit('10.0.0.2'))
+        self.assertEqual(limiter.admit('10.0.0.3'), SERVICE_UNAVAILABLE)
+        limiter.release('10.0.0.1')
+        self.assertIsNone(limiter.admit('10.0.0.3'))
+
+    def test_max_connections_per_ip(self):
+        limiter = Limiter(LimitOptions(maxConnectionsPerIp=1))
+        self.assertIsNone(limiter.admit('10.0.0.1'))
+        self.assertEqual(limiter.admit('10.0.0.1'), TOO_MANY_REQUESTS)
+        self.assertIsNone(limiter.admit('10.0.0.2'))
+        limiter.release('10.0.0.1')
+        limiter.release('10.0.0.2')
+        self.assertEqual(limiter.clients, {})
+
+    def test_no_limit_without_rates(self):
+        limiter = Limiter(LimitOptions(maxConnections=10))
+        limiter.admit('10.0.0.1')
+        self.assertIsNone(limiter.messageLimit('10.0.0.1'))
+
+    def test_ip_bucket_is_shared(self):
+        limiter = Limiter(LimitOptions(ipMessageRate=1, ipMessageBurst=2,
+                                       policy=RATE_POLICY_CLOSE))
+        limits = []
+        for _ in range(2):
+            limiter.admit('10.0.0.1')
+            limits.append(limiter.messageLimit('10.0.0.1'))
+        self.assertTrue(limits[0].closes)
+        self.assertEqual(limits[0].take(), 0)
+        self.assertEqual(limits[1].take(), 0)
+        self.assertGreater(limits[0].take(), 0)
+
+    def test_reconnecting_keeps_the_ip_bucket(self):
+        limiter = Limiter(LimitOptions(ipMessageRate=1, ipMessageBurst=2))
+        limiter.admit('10.0.0.1')
+        limit = limiter.messageLimit('10.0.0.1')
+        limit.take()
+        limit.take()
+        limiter.release('10.0.0.1')
+        limiter.admit('10.0.0.1')
+        self.assertGreater(limiter.messageLimit('10.0.0.1').take(), 0)
+
+    def test_ip_bucket_dropped_once_refilled(self):
+        limiter = Limiter(LimitOptions(ipMessageRate=100, ipMessageBurst=1))
+        limiter.admit('10.0.0.1')
+        limiter.messageLimit('10.0.0.1').take()
+        limiter.release('10.0.0.1')
+        self.assertIn('10.0.0.1', limiter.clients)
+        time.sleep(0.05)
+        limiter.admit('10.0.0.2')
+        self.assertNotIn('10.0.0.1', limiter.clients)
+        self.assertEqual(list(limiter.clients), ['10.0.0.2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+"""
+The send queue gauges count every byte the writer has yet to write, coalescing
+queues waiting for their flush included.
+
+Run from the websocket-server directory:
+
+    python3 -m unittest discover tests
+"""
+import os
+import socket
+import sys
+import time
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from wssWriter import SendQueue, SocketWriter
+
+
+class SendQueueMetricsTest(unittest.TestCase):
+
+    def test_coalesced_bytes_are_counted(self):
+        server, client = socket.socketpair()
+        writer = SocketWriter()
+        queue = SendQueue(server, writer=writer, flushInterval=0.5)
+        self.assertTrue(queue.push(b'x' * 100))
+        for _ in range(2):
+            # registered, then waiting for its flush in the writer thread
+            self.assertEqual(writer.queuedBytes(), 100)
+            self.assertEqual(writer.waitingQueues(), {queue})
+            time.sleep(0.1)
+        client.settimeout(5)
+        self.assertEqual(client.recv(200), b'x' * 100)
+        self.assertEqual(writer.queuedBytes(), 0)
+        self.assertEqual(writer.waitingQueues(), set())
+        server.close()
+        client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+import zlib
+from typing import Dict, List, Optional, Tuple
+# local imports:
+from wssFrame import encodeFrame, RSV1, MessageTooBigError
+
+# -----permessage-deflate (RFC 7692) overview:
+# the client offers the extension in the Sec-WebSocket-Extensions header of the
+# upgrade request, possibly several times with different parameters
+# the server accepts the first offer it supports and echoes the agreed parameters
+# in the same header of the 101 response
+# a compressed message has the RSV1 bit set on its first frame, its payload is
+# raw DEFLATE data with the trailing 0x00 0x00 0xff 0xff of a sync flush removed
+# with context takeover the compressor/decompressor keeps its sliding window
+# from one message to the next, which is what makes small similar messages shrink
+
+EXTENSION_NAME = 'permessage-deflate'
+DEFAULT_MIN_SIZE = 256
+_TAIL = b'\x00\x00\xff\xff'
+
+
+def parseExtensions(header: str) -> List[Tuple[str, Dict[str, Optional[str]]]]:
+    """
+    Parse the value of a Sec-WebSocket-Extensions header into a list of
+    (extension name, parameters) offers, in order of preference. A parameter
+    without a value maps to None
+    """
+    offers = []
+    for offer in header.split(','):
+        parts = [part.strip() for part in offer.split(';')]
+        if not parts[0]:
+            continue
+        params: Dict[str, Optional[str]] = {}
+        for param in parts[1:]:
+            if not param:
+                continue
+            name, sep, value = param.partition('=')
+            params[name.strip().lower()] = value.strip().strip('"') if sep else None
+        offers.append((parts[0].lower(), params))
+    return offers
+
+
+class DeflateOptions:
+    """
+    Server side settings of the permessage-deflate extension, pass an instance to
+    the server to enable the extension.
+
+    minSize: messages smaller than this many bytes are sent uncompressed
+    level, memLevel: zlib compression level and memory level
+    serverNoContextTakeover: reset the compressor after every message, uses less memory
+        per connection and lets broadcasts share compressed frames, at the cost of ratio
+    clientNoContextTakeover: ask clients to reset their compressor after every message
+    serverMaxWindowBits: upper bound on the compressor window (9-15)
+    clientMaxWindowBits: upper bound on the client compressor window (9-15), only
+        sent to clients that announce support for it
+    """
+
+    def __init__(self, minSize: int = DEFAULT_MIN_SIZE, level: int = 6, memLevel: int = 8,
+                 serverNoContextTakeover: bool = False, clientNoContextTakeover: bool = False,
+                 serverMaxWindowBits: int = 15, clientMaxWindowBits: int = 15):
+        assert(9 <= serverMaxWindowBits <= 15 and 9 <= clientMaxWindowBits <= 15)
+        self.minSize = minSize
+        self.level = level
+        self.memLevel = memLevel
+        self.serverNoContextTakeover = serverNoContextTakeover
+        self.clientNoContextTakeover = clientNoContextTakeover
+        self.serverMaxWindowBits = serverMaxWindowBits
+        self.clientMaxWindowBits = clientMaxWindowBits
+
+    def negotiate(self, header: str) -> Optional[Tuple['PerMessageDeflate', str]]:
+        """
+        Pick the first acceptable permessage-deflate offer of a Sec-WebSocket-Extensions
+        header, returns the negotiated state and the value of the response header, or
+        None if no offer was acceptable
+        """
+        for name, params in parseExtensions(header):
+            if name != EXTENSION_NAME:
+                continue
+            accepted = self._accept(params)
+            if accepted:
+                return accepted
+        return None
+
+    def _accept(self, params: Dict[str, Optional[str]]) -> Optional[Tuple['PerMessageDeflate', str]]:
+        """Private method to accept a single offer, returns None if it can't be honoured"""
+        serverNoContextTakeover = self.serverNoContextTakeover
+        clientNoContextTakeover = self.clientNoContextTakeover
+        serverMaxWindowBits = self.serverMaxWindowBits
+        clientMaxWindowBits = None
+        for name, value in params.items():
+            if name == 'server_no_context_takeover':
+                if value is not None:
+                    return None
+                serverNoContextTakeover = True
+            elif name == 'client_no_context_takeover':
+                if value is not None:
+                    return None
+                # the client says it won't use context takeover, nothing to do
+            elif name == 'server_max_window_bits':
+                bits = _windowBits(value)
+                # zlib can't produce raw deflate streams with an 8 bit window
+                if bits is None or bits < 9:
+                    return None
+                serverMaxWindowBits = min(serverMaxWindowBits, bits)
+            elif name == 'client_max_window_bits':
+                if value is not None:
+                    bits = _windowBits(value)
+                    if bits is None:
+                        return None
+                    clientMaxWindowBits = min(self.clientMaxWindowBits, bits)
+                elif self.clientMaxWindowBits < 15:
+                    clientMaxWindowBits = self.clientMaxWindowBits
+            else:
+                # unknown parameter, decline this offer
+                return None
+
+        response = [EXTENSION_NAME]
+        if serverNoContextTakeover:
+            response.append('server_no_context_takeover')
+        if clientNoContextTakeover:
+            response.append('client_no_context_takeover')
+        if serverMaxWindowBits < 15 or 'server_max_window_bits' in params:
+            response.append('server_max_window_bits=%d' % serverMaxWindowBits)
+        if clientMaxWindowBits is not None:
+            response.append('client_max_window_bits=%d' % clientMaxWindowBits)
+        deflate = PerMessageDeflate(self.minSize, self.level, self.memLevel,
+                                    serverNoContextTakeover, serverMaxWindowBits)
+        return deflate, '; '.join(response)
+
+
+class PerMessageDeflate:
+    """
+    Negotiated permessage-deflate state of one connection. The compressor and
+    decompressor are only created once a message needs them, so idle connections
+    don't pay for zlib's buffers
+    """
+
+    def __init__(self, minSize: int = DEFAULT_MIN_SIZE, level: int = 6, memLevel: int = 8,
+                 serverNoContextTakeover: bool = False, serverMaxWindowBits: int = 15):
+        self.minSize = minSize
+        self.level = level
+        self.memLevel = memLevel
+        self.serverNoContextTakeover = serverNoContextTakeover
+        self.serverMaxWindowBits = serverMaxWindowBits
+        self.compressor = None
+        self.decompressor = None
+
+    @property
+    def shareKey(self) -> Optional[tuple]:
+        """Connections with the same non-None key produce identical compressed frames for
+        the same message, only possible without server context takeover"""
+        if not self.serverNoContextTakeover:
+            return None
+        return (self.level, self.memLevel, self.serverMaxWindowBits)
+
+    def compress(self, data) -> bytes:
+        """Compress one whole message"""
+        compressor = self.compressor
+        if compressor is None or self.serverNoContextTakeover:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                          -self.serverMaxWindowBits, self.memLevel)
+            if not self.serverNoContextTakeover:
+                self.compressor = compressor
+        out = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if out.endswith(_TAIL):
+            out = out[:-4]
+        return out
+
+    def decompress(self, data, final: bool = True, maxSize: Optional[int] = None) -> bytes:
+        """Decompress one whole message, or one fragment of a message (final tells if
+        it is the last one), raises MessageTooBigError if it inflates to more than
+        maxSize bytes"""
+        if self.decompressor is None:
+            # a 15 bit window can decode data compressed with any smaller window
+            self.decompressor = zlib.decompressobj(-15)
+        if final:
+            data = bytes(data) + _TAIL
+        if maxSize is None:
+            return self.decompressor.decompress(data)
+        out = self.decompressor.decompress(data, maxSize + 1)
+        if len(out) > maxSize:
+            raise MessageTooBigError('message inflates to more than %d bytes' % maxSize)
+        return out
+
+    def encodeFrame(self, opcode: int, payload) -> bytes:
+        """Returns the bytes of a frame holding the whole message, compressed if it is
+        at least minSize bytes long"""
+        if len(payload) < self.minSize:
+            return encodeFrame(opcode, payload)
+        return encodeFrame(opcode, self.compress(payload), rsv=RSV1)
+
+
+def _windowBits(value: Optional[str]) -> Optional[int]:
+    """Parse a window bits parameter value, returns None if invalid"""
+    if value is None or not value.isdigit():
+        return None
+    bits = int(value)
+    return bits if 8 <= bits <= 15 else None
@@ -0,0 +1,518 @@
+import struct
+import zlib
+from time import perf_counter
+from typing import List, Optional, Tuple
+# local imports:
+from wssUtils import unmask, unmaskInPlace
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+# RSV1 bit as found in the rsv field of a frame, set on compressed messages
+RSV1 = 0x4
+# close status codes
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_INVALID_DATA = 1007
+CLOSE_POLICY_VIOLATION = 1008
+CLOSE_MESSAGE_TOO_BIG = 1009
+
+# default size of the receive buffer of an idle connection, it grows for larger
+# frames and busier reads, and shrinks back once they are consumed
+DEFAULT_BUFFER_SIZE = 4096
+# default largest read, the buffer grows up to this while reads fill it
+DEFAULT_READ_SIZE = 65536
+# default upper bound on the size of a reassembled message
+DEFAULT_MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+# default size of the fragments of streamed messages
+DEFAULT_CHUNK_SIZE = 65536
+# payloads from this size on are sent after their header as a separate buffer
+# instead of being copied into the frame (see encodeFrameParts)
+SCATTER_THRESHOLD = 16384
+
+# largest frame header: 2 bytes, 8 bytes of extended length and the masking key
+MAX_HEADER_SIZE = 14
+
+_U16 = struct.Struct("!H")
+_U64 = struct.Struct("!Q")
+# frame header layouts for each payload length encoding (server frames are never masked)
+_HEADER_SHORT = struct.Struct("!BB")
+_HEADER_MEDIUM = struct.Struct("!BBH")
+_HEADER_LONG = struct.Struct("!BBQ")
+_packShort = _HEADER_SHORT.pack
+_packMedium = _HEADER_MEDIUM.pack
+_packLong = _HEADER_LONG.pack
+
+
+class ProtocolError(Exception):
+    """The peer broke the WebSocket protocol, the connection is closed with the given
+    close status code"""
+
+    def __init__(self, message: str, code: int = CLOSE_PROTOCOL_ERROR):
+        super().__init__(message)
+        self.code = code
+
+
+class MessageTooBigError(ProtocolError):
+    """The peer sent a message larger than the configured maximum"""
+
+    def __init__(self, message: str):
+        super().__init__(message, CLOSE_MESSAGE_TOO_BIG)
+
+
+def checkControlFrame(fin: int, rsv: int, payload):
+    """Raise ProtocolError if a control frame (close, ping, pong) is malformed"""
+    if not fin:
+        raise ProtocolError('fragmented control frame')
+    if rsv:
+        raise ProtocolError('reserved bits set on a control frame')
+    if len(payload) > 125:
+        raise ProtocolError('control frame payload longer than 125 bytes')
+
+
+def iterChunks(source, chunkSize: int = DEFAULT_CHUNK_SIZE):
+    """
+    Generate chunkSize byte chunks (the last one may be shorter) out of a file object
+    opened for reading or an iterable of bytes or str pieces, only one chunk worth of
+    data is held at a time
+    """
+    if hasattr(source, 'read'):
+        source = _readPieces(source, chunkSize)
+    rechunker = Rechunker(chunkSize)
+    for piece in source:
+        yield from rechunker.feed(piece)
+    rest = rechunker.finish()
+    if rest:
+        yield rest
+
+
+def _readPieces(file, chunkSize: int):
+    """Generate pieces read from a file object until end of file"""
+    while True:
+        piece = file.read(chunkSize)
+        if not piece:
+            return
+        yield piece
+
+
+class Rechunker:
+    """Cuts pieces of arbitrary sizes into chunks of a fixed size"""
+
+    def __init__(self, chunkSize: int = DEFAULT_CHUNK_SIZE):
+        assert(chunkSize > 0)
+        self.chunkSize = chunkSize
+        self.buffer = bytearray()
+
+    def feed(self, piece) -> List[bytes]:
+        """Add a piece of data (bytes or str), returns the chunks completed by it"""
+        if type(piece) == str:
+            piece = piece.encode()
+        chunkSize = self.chunkSize
+        view = memoryview(piece)
+        offset = 0
+        chunks = []
+        if self.buffer:
+            # top up the partial chunk left by the previous pieces first
+            offset = chunkSize - len(self.buffer)
+            self.buffer += view[:offset]
+            if len(self.buffer) < chunkSize:
+                return chunks
+            chunks.append(bytes(self.buffer))
+            self.buffer = bytearray()
+        while len(view) - offset >= chunkSize:
+            chunks.append(bytes(view[offset:offset + chunkSize]))
+            offset += chunkSize
+        self.buffer += view[offset:]
+        return chunks
+
+    def finish(self) -> bytes:
+        """Returns the last partial chunk (possibly empty)"""
+        rest = bytes(self.buffer)
+        self.buffer = bytearray()
+        return rest
+
+
+class TextView:
+    """
+    Text message as delivered in zero-copy mode: data is a memoryview over its UTF-8
+    bytes, only decoded (and validated, UnicodeDecodeError if invalid) by str().
+    Valid until the message handler returns, like the memoryview of a binary message.
+    send accepts it as is, relaying the text without decoding and encoding it
+    """
+    __slots__ = ('data', 'text')
+
+    def __init__(self, data: memoryview):
+        self.data = data
+        self.text: Optional[str] = None
+
+    def __str__(self) -> str:
+        if self.text is None:
+            self.text = str(self.data, 'utf-8')
+        return self.text
+
+    def __len__(self) -> int:
+        """Size in bytes"""
+        return len(self.data)
+
+    def tobytes(self) -> bytes:
+        return self.data.tobytes()
+
+
+class MessageAssembler:
+    """
+    Reassembles the data frames of one connection into messages.
+
+    Fragments are accumulated until the final frame of the message and the message is
+    returned whole, decompressed (permessage-deflate) and decoded (text messages). A
+    message growing past maxMessageSize raises MessageTooBigError.
+
+    When streamBinary is set binary messages aren't accumulated: every fragment is
+    returned as it arrives, so large binary transfers never sit whole in memory
+
+    In zeroCopy mode messages are returned as memoryviews (binary) and TextViews
+    (text), over the payload the decoder yielded when the message is a single frame,
+    fragments are copied since the decoder reuses its buffer between reads
+    """
+
+    def __init__(self, maxMessageSize: int = DEFAULT_MAX_MESSAGE_SIZE, deflate=None,
+                 zeroCopy: bool = False):
+        self.maxMessageSize = maxMessageSize
+        # negotiated permessage-deflate state, None if not compressing
+        self.deflate = deflate
+        self.streamBinary = False
+        self.zeroCopy = zeroCopy
+        # state of the message being received
+        self.opcode = None
+        self.compressed = False
+        self.streaming = False
+        self.fragments = []
+        self.size = 0
+
+    def add(self, fin: int, rsv: int, opcode: int, payload) -> Optional[tuple]:
+        """
+        Add a data frame, returns None while the message isn't complete, otherwise an
+        (opcode, data, final, streamed) tuple: for whole messages data is a str (text)
+        or bytes (binary), or a TextView and a memoryview in zeroCopy mode, final is
+        True and streamed False, for streamed binary messages data is the fragment,
+        final tells if it was the last one and streamed is True
+        """
+        if opcode == OP_CONTINUATION:
+            if self.opcode is None:
+                raise ProtocolError('continuation frame without a message to continue')
+            if rsv:
+                raise ProtocolError('reserved bits set on a continuation frame')
+        else:
+            if self.opcode is not None:
+                raise ProtocolError('new message before the previous one was finished')
+            if opcode != OP_TEXT and opcode != OP_BINARY:
+                raise ProtocolError('unknown opcode %d' % opcode)
+            if rsv and (rsv != RSV1 or self.deflate is None):
+                raise ProtocolError('reserved bits set without a negotiated extension')
+            self.opcode = opcode
+            self.compressed = rsv == RSV1
+            self.streaming = self.streamBinary and opcode == OP_BINARY
+        opcode = self.opcode
+
+        if self.compressed:
+            # never inflate more than the message may still hold
+            limit = self.maxMessageSize if self.streaming else self.maxMessageSize - self.size
+            try:
+                payload = self.deflate.decompress(payload, fin, limit)
+            except zlib.error as e:
+                raise ProtocolError('invalid compressed data: %s' % e, CLOSE_INVALID_DATA)
+        if self.streaming:
+            if fin:
+                self._reset()
+            if self.zeroCopy:
+                payload = memoryview(payload)
+            return opcode, payload, bool(fin), True
+
+        self.size += len(payload)
+        if self.size > self.maxMessageSize:
+            raise MessageTooBigError('message larger than %d bytes' % self.maxMessageSize)
+        if not fin:
+            # a view over the decoder's buffer is only valid until its next read
+            self.fragments.append(payload if type(payload) is bytes else bytes(payload))
+            return None
+        if self.fragments:
+            self.fragments.append(payload)
+            payload = b''.join(self.fragments)
+        self._reset()
+        if self.zeroCopy:
+            payload = memoryview(payload)
+            return opcode, TextView(payload) if opcode == OP_TEXT else payload, True, False
+        if opcode == OP_TEXT:
+            try:
+                payload = payload.decode()
+            except UnicodeDecodeError:
+                raise ProtocolError('text message is not valid UTF-8', CLOSE_INVALID_DATA)
+        return opcode, payload, True, False
+
+    def _reset(self):
+        """Private method to get ready for the next message"""
+        self.opcode = None
+        self.compressed = False
+        self.streaming = False
+        self.fragments = []
+        self.size = 0
+
+
+def headerSize(payloadLen: int) -> int:
+    """Returns the size in bytes of an unmasked frame header for the given payload length"""
+    if payloadLen <= 125:
+        return 2
+    elif payloadLen < 65536:
+        return 4
+    return 10
+
+
+def packHeader(buf, offset: int, b0: int, payloadLen: int) -> int:
+    """
+    Write an unmasked frame header into buf at offset, b0 is the first header byte
+    (fin, rsv and opcode bits), returns the offset just past the header
+    """
+    if payloadLen <= 125:
+        _HEADER_SHORT.pack_into(buf, offset, b0, payloadLen)
+        return offset + 2
+    elif payloadLen < 65536:
+        _HEADER_MEDIUM.pack_into(buf, offset, b0, 126, payloadLen)
+        return offset + 4
+    _HEADER_LONG.pack_into(buf, offset, b0, 127, payloadLen)
+    return offset + 10
+
+
+def encodeFrameParts(opcode: int, payload=b'', fin: int = 1, rsv: int = 0):
+    """
+    Returns an unmasked frame as the bytes of encodeFrame, or for payloads of at least
+    SCATTER_THRESHOLD bytes as a (header, payload) pair to write one after the other,
+    the payload (any buffer of bytes) is then never copied into the frame
+    """
+    payloadLen = len(payload)
+    if payloadLen < SCATTER_THRESHOLD:
+        return encodeFrame(opcode, payload, fin, rsv)
+    b0 = (fin << 7) | (rsv << 4) | opcode
+    if payloadLen < 65536:
+        return _packMedium(b0, 126, payloadLen), payload
+    return _packLong(b0, 127, payloadLen), payload
+
+
+def encodeFrame(opcode: int, payload=b'', fin: int = 1, rsv: int = 0) -> bytes:
+    """
+    Returns the bytes of an entire unmasked frame, this is the fast path used when
+    sending, the header is packed in one call and the payload appended with a single copy
+    """
+    payloadLen = len(payload)
+    b0 = (fin << 7) | (rsv << 4) | opcode
+    if payloadLen <= 125:
+        return _packShort(b0, payloadLen) + payload
+    elif payloadLen < 65536:
+        return _packMedium(b0, 126, payloadLen) + payload
+    return _packLong(b0, 127, payloadLen) + payload
+
+
+class FrameDecoder:
+    """
+    Incremental WebSocket frame decoder.
+
+    Bytes are read straight into a reusable receive buffer (recvInto) or copied
+    into it (feed), and complete frames are yielded by iterating over the decoder
+    no matter how the bytes were split across reads. A frame that is still partial
+    stays in the buffer until the rest of it arrives.
+
+    The buffer starts at bufferSize bytes, doubles up to readSize while reads fill
+    it and grows as needed for frames larger than that. It goes back to bufferSize
+    once a large frame is consumed, or once it empties after a small read, so idle
+    connections only hold a small buffer.
+
+    Each frame is yielded as a (fin, rsv, opcode, payload) tuple where payload is
+    the unmasked payload data as bytes. In zeroCopy mode payload is a memoryview
+    over the receive buffer instead (unmasked in place when NumPy is installed,
+    otherwise over the unmasked bytes), only valid until the next read or feed.
+
+    Given a wssMetrics.Metrics, frames and payload bytes are counted per opcode and
+    decode and unmask times are sampled.
+
+    A frame announcing a payload larger than maxFrameSize raises MessageTooBigError as
+    soon as its header is decoded, before any of its payload is buffered, as does a
+    frame that would make its message larger than maxMessageSize (given the
+    MessageAssembler of the connection, the bytes it already holds count too).
+
+    Consult link for more info about WebSocket Frames: https://datatracker.ietf.org/doc/html/rfc6455#section-5
+    """
+
+    def __init__(self, bufferSize: int = DEFAULT_BUFFER_SIZE, metrics=None,
+                 maxFrameSize: Optional[int] = None, zeroCopy: bool = False,
+                 maxMessageSize: Optional[int] = None,
+                 assembler: Optional[MessageAssembler] = None,
+                 readSize: int = DEFAULT_READ_SIZE):
+        self.bufferSize = bufferSize
+        # feed is given at most readSize bytes at once
+        self.readSize = max(readSize, bufferSize)
+        self.metrics = metrics
+        self.maxFrameSize = maxFrameSize
+        self.zeroCopy = zeroCopy
+        self.maxMessageSize = maxMessageSize
+        # tells how much of the message being received was already assembled
+        self.assembler = assembler
+        # the buffer never grows past the largest frame the limits allow and a read,
+        # None if there is no limit
+        limits = [limit for limit in (maxFrameSize, maxMessageSize) if limit is not None]
+        self.maxBufferSize = min(limits) + MAX_HEADER_SIZE + self.readSize if limits else None
+        self.buffer = bytearray(bufferSize)
+        self.view = memoryview(self.buffer)
+        # unconsumed data lives in buffer[start:end]
+        self.start = 0
+        self.end = 0
+        # size of the last read, a small one means the connection isn't busy
+        self.lastRead = 0
+
+    def recvInto(self, socket) -> int:
+        """Read from the socket into the free space at the end of the buffer,
+        returns the number of bytes read (0 when the peer closed the connection)"""
+        if self.end == len(self.buffer):
+            self._reserve(1)
+        nbytes = socket.recv_into(self.view[self.end:])
+        self.end += nbytes
+        self.lastRead = nbytes
+        size = len(self.buffer)
+        if self.end == size and size < self.readSize:
+            # the socket may hold more, read more at once next time
+            self._resize(min(2 * size, self.readSize))
+        return nbytes
+
+    def feed(self, data):
+        """Copy the given bytes into the buffer, for transports that hand over
+        their own chunks (e.g. asyncio streams)"""
+        nbytes = len(data)
+        self._reserve(nbytes)
+        self.buffer[self.end:self.end + nbytes] = data
+        self.end += nbytes
+        self.lastRead = nbytes
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Tuple[int, int, int, bytes]:
+        metrics = self.metrics
+        if metrics is None or not metrics.decodeSeconds.sample():
+            frame = self.nextFrame()
+        else:
+            start = perf_counter()
+            frame = self.nextFrame()
+            if frame is not None:
+                metrics.decodeSeconds.observe(perf_counter() - start)
+        if frame is None:
+            raise StopIteration
+        if metrics is not None:
+            opcode = frame[2]
+            metrics.framesIn.values[opcode] += 1
+            metrics.bytesIn.values[opcode] += len(frame[3])
+        return frame
+
+    def nextFrame(self) -> Optional[Tuple[int, int, int, bytes]]:
+        """Decode the next complete frame in the buffer, returns None if the buffer
+        only holds part of a frame"""
+        buf = self.buffer
+        start = self.start
+        available = self.end - start
+        if available < 2:
+            return None
+        # get data from websocket header
+        b0 = buf[start]
+        b1 = buf[start + 1]
+        payloadLen = b1 & 0x7f
+        headerLen = 2
+        if payloadLen == 126:
+            headerLen = 4
+            if available < headerLen:
+                return None
+            (payloadLen,) = _U16.unpack_from(buf, start + 2)
+        elif payloadLen == 127:
+            headerLen = 10
+            if available < headerLen:
+                return None
+            (payloadLen,) = _U64.unpack_from(buf, start + 2)
+        if self.maxFrameSize is not None and payloadLen > self.maxFrameSize:
+            raise MessageTooBigError('frame larger than %d bytes' % self.maxFrameSize)
+        if self.maxMessageSize is not None:
+            # bytes of the message already assembled, control frames don't add to the
+            # message they may interrupt
+            assembled = 0
+            if self.assembler is not None and not b0 & 0x8:
+                assembled = self.assembler.size
+            if assembled + payloadLen > self.maxMessageSize:
+                raise MessageTooBigError('message larger than %d bytes' % self.maxMessageSize)
+        maskFlag = b1 & 0x80
+        if maskFlag:
+            headerLen += 4
+        frameLen = headerLen + payloadLen
+        if available < frameLen:
+            # make sure the whole frame will fit once the rest arrives
+            if frameLen > len(buf) - start:
+                self._reserve(frameLen - available)
+            return None
+
+        payloadStart = start + headerLen
+        payloadEnd = payloadStart + payloadLen
+        payload = self.view[payloadStart:payloadEnd]
+        if maskFlag:
+            # get the masking key to do unmasking
+            mask = buf[payloadStart - 4:payloadStart]
+            unmaskPayload = unmaskInPlace if self.zeroCopy else unmask
+            if self.metrics is None:
+                payload = unmaskPayload(payload, mask)
+            else:
+                payload = self.metrics.unmaskSeconds.time(unmaskPayload, payload, mask)
+            if self.zeroCopy and type(payload) is bytes:
+                payload = memoryview(payload)
+        elif not self.zeroCopy:
+            payload = bytes(payload)
+        self._consume(frameLen)
+        return ((b0 & 0x80) >> 7, (b0 & 0x70) >> 4, b0 & 0xf, payload)
+
+    def _consume(self, nbytes: int):
+        """Private method to mark bytes at the front of the buffer as decoded"""
+        self.start += nbytes
+        live = self.end - self.start
+        if not live:
+            # buffer is empty, rewind instead of moving anything around
+            self.start = self.end = 0
+        size = len(self.buffer)
+        if size > self.bufferSize and live <= self.bufferSize \
+                and (size > self.readSize or (not live and self.lastRead <= self.bufferSize)):
+            # give back the memory taken by a large frame, or by busy reads once the
+            # connection calms down
+            self._resize(self.bufferSize)
+
+    def _reserve(self, nbytes: int):
+        """Private method to make room for at least nbytes more at the end of the buffer,
+        first by moving the unconsumed bytes to the front then by growing the buffer"""
+        if len(self.buffer) - self.end >= nbytes:
+            return
+        live = self.end - self.start
+        if live + nbytes <= len(self.buffer):
+            if live:
+                self.buffer[:live] = bytes(self.view[self.start:self.end])
+            self.start = 0
+            self.end = live
+            return
+        size = max(live + nbytes, 2 * len(self.buffer))
+        if self.maxBufferSize is not None:
+            if live + nbytes > self.maxBufferSize:
+                raise MessageTooBigError('frame larger than %d bytes' % self.maxBufferSize)
+            size = min(size, self.maxBufferSize)
+        self._resize(size)
+
+    def _resize(self, size: int):
+        """Private method to move the unconsumed bytes into a new buffer of the given size"""
+        live = self.end - self.start
+        newBuffer = bytearray(size)
+        newBuffer[:live] = self.view[self.start:self.end]
+        self.buffer = newBuffer
+        self.view = memoryview(newBuffer)
+        self.start = 0
+        self.end = live
@@ -0,0 +1,182 @@
+import base64
+import binascii
+import socket as sockets
+import socketserver
+from hashlib import sha1
+from typing import Dict, Optional, Tuple
+# local imports:
+from wssDeflate import DeflateOptions, PerMessageDeflate
+
+# -----Handshake overview:
+# the client sends an HTTP GET with Upgrade: websocket, the head of the request
+# usually arrives in a single read
+# only the request line and the few headers the handshake needs are decoded,
+# every other header is skipped after comparing its name
+# header names, the Upgrade and Connection tokens are case insensitive, and
+# Connection is a comma separated list (browsers send "keep-alive, Upgrade")
+# the 101 response is a prebuilt template, only the accept token (and the
+# negotiated extension) are appended to it
+# both engines share this module, they only differ in how they read and write
+
+GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+# upper bound on the size of the head of the HTTP upgrade request
+MAX_HANDSHAKE_SIZE = 16384
+# how long a client may take to send its upgrade request
+HANDSHAKE_TIMEOUT = 10
+
+# lowercase header name -> key in HandshakeRequest.headers, the only headers decoded
+_HEADERS = {b'upgrade': 'upgrade', b'connection': 'connection',
+            b'sec-websocket-key': 'key', b'sec-websocket-version': 'version',
+            b'sec-websocket-extensions': 'extensions'}
+
+_SWITCHING_PROTOCOLS = (b'HTTP/1.1 101 Switching Protocols\r\n'
+                        b'Upgrade: websocket\r\n'
+                        b'Connection: Upgrade\r\n'
+                        b'Sec-WebSocket-Accept: ')
+BAD_REQUEST = (b'HTTP/1.1 400 Bad Request\r\n'
+               b'Connection: close\r\n'
+               b'Content-Length: 0\r\n\r\n')
+# refusals of the admission control (see wssLimits)
+SERVICE_UNAVAILABLE = (b'HTTP/1.1 503 Service Unavailable\r\n'
+                       b'Retry-After: 1\r\n'
+                       b'Connection: close\r\n'
+                       b'Content-Length: 0\r\n\r\n')
+TOO_MANY_REQUESTS = (b'HTTP/1.1 429 Too Many Requests\r\n'
+                     b'Retry-After: 1\r\n'
+                     b'Connection: close\r\n'
+                     b'Content-Length: 0\r\n\r\n')
+# the only version this server speaks, sent back to clients asking for another one
+UPGRADE_REQUIRED = (b'HTTP/1.1 426 Upgrade Required\r\n'
+                    b'Sec-WebSocket-Version: 13\r\n'
+                    b'Connection: close\r\n'
+                    b'Content-Length: 0\r\n\r\n')
+
+
+def acceptToken(sec: str) -> str:
+    """Compute the Sec-WebSocket-Accept value for the given Sec-WebSocket-Key,
+    part of the protocol, add the global value to the nonce and hash it, the
+    client will verify it"""
+    hash = sha1(sec.encode() + GUID).digest()
+    return base64.b64encode(hash).decode()
+
+
+class HandshakeRequest:
+    """Request line and handshake headers of an upgrade request, headers maps upgrade,
+    connection, key, version and extensions to their value when present (repeated
+    headers are joined with commas)"""
+    __slots__ = ('method', 'path', 'headers')
+
+    def __init__(self, method: str, path: str, headers: Dict[str, str]):
+        self.method = method
+        self.path = path
+        self.headers = headers
+
+
+def parseRequest(head: bytes) -> Optional[HandshakeRequest]:
+    """Parse the head of an HTTP request (without the blank line ending it), None if
+    the request line is malformed"""
+    lines = head.split(b'\r\n')
+    requestLine = lines[0].split(b' ')
+    if len(requestLine) != 3 or not requestLine[2].startswith(b'HTTP/'):
+        return None
+    headers: Dict[str, str] = {}
+    for line in lines[1:]:
+        name, colon, value = line.partition(b':')
+        key = _HEADERS.get(name.strip().lower())
+        if key is None or not colon:
+            continue
+        value = value.strip().decode('latin-1')
+        headers[key] = value if key not in headers else headers[key] + ', ' + value
+    return HandshakeRequest(requestLine[0].decode('latin-1'),
+                            requestLine[1].decode('latin-1'), headers)
+
+
+def hasToken(value: Optional[str], token: str) -> bool:
+    """Whether the comma separated header value holds the given lowercase token, in
+    any case"""
+    if not value:
+        return False
+    return any(part.strip().lower() == token for part in value.split(','))
+
+
+def validKey(key: Optional[str]) -> bool:
+    """A Sec-WebSocket-Key is the base64 of 16 bytes"""
+    if not key or len(key) != 24:
+        return False
+    try:
+        return len(base64.b64decode(key, validate=True)) == 16
+    except binascii.Error:
+        return False
+
+
+def answerHandshake(request: Optional[HandshakeRequest], deflate: Optional[DeflateOptions],
+                    metrics=None, metricsPath: Optional[str] = None
+                    ) -> Tuple[bytes, bool, Optional[PerMessageDeflate]]:
+    """Decide what to answer the given request (None if it couldn't be parsed), returns
+    the response bytes, whether the connection is upgraded and the negotiated
+    compression. Plain GETs of metricsPath get the metrics of the given registry,
+    rejected requests are counted there, the caller counts the handshake once the
+    101 response is sent"""
+    if request is None:
+        return BAD_REQUEST, False, None
+    headers = request.headers
+    upgrade = headers.get('upgrade')
+    if request.method == 'GET' and not upgrade and metrics is not None and metricsPath \
+            and request.path.split('?', 1)[0] == metricsPath:
+        return metricsResponse(metrics), False, None
+    key = headers.get('key')
+    if request.method != 'GET' or not hasToken(upgrade, 'websocket') \
+            or not hasToken(headers.get('connection'), 'upgrade') or not validKey(key):
+        if metrics is not None:
+            metrics.handshakesFailed.inc()
+        return BAD_REQUEST, False, None
+    if headers.get('version') != '13':
+        if metrics is not None:
+            metrics.handshakesFailed.inc()
+        return UPGRADE_REQUIRED, False, None
+
+    response = _SWITCHING_PROTOCOLS + acceptToken(key).encode()
+    # accept compression if the client offers it and the server allows it
+    negotiated = None
+    extensions = headers.get('extensions')
+    if deflate and extensions:
+        negotiated = deflate.negotiate(extensions)
+        if negotiated:
+            response += b'\r\nSec-WebSocket-Extensions: ' + negotiated[1].encode()
+    return response + b'\r\n\r\n', True, negotiated[0] if negotiated else None
+
+
+def metricsResponse(metrics) -> bytes:
+    """200 response with the plain text exposition of the metrics"""
+    body = metrics.exposition().encode()
+    return (b'HTTP/1.1 200 OK\r\n'
+            b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            b'Connection: close\r\n'
+            b'Content-Length: %d\r\n\r\n' % len(body)) + body
+
+
+def recvRequest(socket) -> Tuple[Optional[bytes], bytes]:
+    """Read the head of an HTTP request from a blocking socket, returns it without the
+    blank line ending it (None if the client went away or sent too much) and the
+    bytes read past it, which belong to the websocket connection"""
+    data = b''
+    while True:
+        chunk = socket.recv(MAX_HANDSHAKE_SIZE)
+        if not chunk:
+            return None, b''
+        # the blank line may straddle two reads
+        start = max(0, len(data) - 3)
+        data += chunk
+        end = data.find(b'\r\n\r\n', start)
+        if end >= 0:
+            return data[:end], data[end + 4:]
+        if len(data) >= MAX_HANDSHAKE_SIZE:
+            return None, b''
+
+
+class HandshakeServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """TCP server running the handler of every connection on its own thread, with a
+    listen backlog sized for bursts of reconnecting clients"""
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = sockets.SOMAXCONN
@@ -0,0 +1,199 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+# local imports:
+from wssHandshake import SERVICE_UNAVAILABLE, TOO_MANY_REQUESTS
+
+# -----Limits overview:
+# admission control happens once the upgrade request is parsed, before the 101 is
+# sent: past maxConnections the client gets a 503, past maxConnectionsPerIp a 429
+# message rates are token buckets, one per connection and one per client IP shared
+# by every connection from that IP, a message (or ping) takes a token from both
+# an IP's bucket outlives its connections until it has refilled, so reconnecting
+# doesn't hand a client a fresh burst
+# a connection out of tokens is either slowed down (its reader waits until the
+# debt is paid, so TCP pushes back on the client) or closed with 1008
+# everything is per process, with workers every worker enforces its own limits
+# the size of a frame is checked by the frame decoder as soon as its header is
+# decoded, before its payload is buffered (see wssFrame.FrameDecoder)
+
+# what to do with a connection sending faster than its rate
+RATE_POLICY_DELAY = 'delay'
+RATE_POLICY_CLOSE = 'close'
+RATE_POLICIES = (RATE_POLICY_DELAY, RATE_POLICY_CLOSE)
+
+
+class LimitOptions:
+    """
+    Admission control and rate limit settings, pass an instance to the server to
+    enable them, None disables a limit.
+
+    maxConnections: open connections of the process, more are refused with 503
+    maxConnectionsPerIp: open connections from a single client IP, more are refused
+        with 429
+    messageRate, messageBurst: messages (and pings) per second a connection may send,
+        and how many it may send at once (defaults to one second worth)
+    ipMessageRate, ipMessageBurst: same, for all the connections of a client IP together
+    policy: RATE_POLICY_DELAY stops reading from a connection over its rate until it is
+        back under it, RATE_POLICY_CLOSE closes it with 1008
+    """
+
+    def __init__(self, maxConnections: Optional[int] = None,
+                 maxConnectionsPerIp: Optional[int] = None,
+                 messageRate: Optional[float] = None, messageBurst: Optional[float] = None,
+                 ipMessageRate: Optional[float] = None, ipMessageBurst: Optional[float] = None,
+                 policy: str = RATE_POLICY_DELAY):
+        assert(policy in RATE_POLICIES)
+        self.maxConnections = maxConnections
+        self.maxConnectionsPerIp = maxConnectionsPerIp
+        self.messageRate = messageRate
+        self.messageBurst = messageBurst if messageBurst else max(1, messageRate or 0)
+        self.ipMessageRate = ipMessageRate
+        self.ipMessageBurst = ipMessageBurst if ipMessageBurst else max(1, ipMessageRate or 0)
+        self.policy = policy
+
+
+class TokenBucket:
+    """Refills rate tokens per second up to burst, starts full. Not thread safe"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> float:
+        """Take a token, returns 0 if there was one, otherwise how many seconds until the
+        bucket is out of debt (the token is taken anyway)"""
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - 1
+        self.tokens = tokens
+        self.updated = now
+        return 0.0 if tokens >= 0 else -tokens / self.rate
+
+    def fullAt(self) -> float:
+        """When the bucket is full again, it can be dropped from then on since a new
+        bucket starts full"""
+        return self.updated + (self.burst - self.tokens) / self.rate
+
+
+class _Client:
+    """Open connections and shared bucket of a client IP"""
+    __slots__ = ('connections', 'bucket')
+
+    def __init__(self, bucket: Optional[TokenBucket]):
+        self.connections = 0
+        self.bucket = bucket
+
+
+class MessageLimit:
+    """Rate limit of a connection, its own bucket and the one of its IP"""
+    __slots__ = ('bucket', 'ipBucket', 'lock', 'closes', 'metrics')
+
+    def __init__(self, bucket: Optional[TokenBucket], ipBucket: Optional[TokenBucket],
+                 lock: threading.Lock, closes: bool, metrics=None):
+        self.bucket = bucket
+        # shared with the other connections of the IP, only touched under lock
+        self.ipBucket = ipBucket
+        self.lock = lock
+        # close the connection instead of slowing it down
+        self.closes = closes
+        self.metrics = metrics
+
+    def take(self) -> float:
+        """Account for a message, returns 0 if the connection is within its limits,
+        otherwise how many seconds it should wait"""
+        now = time.monotonic()
+        wait = self.bucket.take(now) if self.bucket is not None else 0.0
+        if self.ipBucket is not None:
+            with self.lock:
+                wait = max(wait, self.ipBucket.take(now))
+        if wait and self.metrics is not None:
+            self.metrics.messagesLimited.inc()
+        return wait
+
+
+class Limiter:
+    """Enforces the given LimitOptions for every connection of a server, thread safe"""
+
+    def __init__(self, options: LimitOptions, metrics=None):
+        self.options = options
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.connections = 0
+        # client IP -> its connections and bucket, IPs with open connections and
+        # those whose bucket is still refilling
+        self.clients: Dict[str, _Client] = {}
+        # client IP -> when its bucket is full again, of the IPs without connections,
+        # in the order they were released
+        self.idle: 'OrderedDict[str, float]' = OrderedDict()
+
+    def admit(self, address: str) -> Optional[bytes]:
+        """Count a new connection from the given IP, returns None if it is admitted,
+        otherwise the response refusing it. Admitted connections must be released"""
+        options = self.options
+        with self.lock:
+            self._expire(time.monotonic())
+            if options.maxConnections is not None and self.connections >= options.maxConnections:
+                refusal = SERVICE_UNAVAILABLE
+            else:
+                client = self.clients.get(address)
+                if client is None:
+                    bucket = None
+                    if options.ipMessageRate:
+                        bucket = TokenBucket(options.ipMessageRate, options.ipMessageBurst)
+                    client = self.clients[address] = _Client(bucket)
+                if options.maxConnectionsPerIp is not None \
+                        and client.connections >= options.maxConnectionsPerIp:
+                    refusal = TOO_MANY_REQUESTS
+                else:
+                    if not client.connections:
+                        self.idle.pop(address, None)
+                    client.connections += 1
+                    self.connections += 1
+                    return None
+                if not client.connections and address not in self.idle:
+                    del self.clients[address]
+        if self.metrics is not None:
+            self.metrics.connectionsRefused.inc()
+        return refusal
+
+    def release(self, address: str):
+        """An admitted connection from the given IP closed"""
+        with self.lock:
+            now = time.monotonic()
+            self._expire(now)
+            self.connections -= 1
+            client = self.clients[address]
+            client.connections -= 1
+            if not client.connections:
+                if client.bucket is not None and client.bucket.fullAt() > now:
+                    # keep the bucket until it refilled
+                    self.idle[address] = client.bucket.fullAt()
+                else:
+                    del self.clients[address]
+
+    def _expire(self, now: float):
+        """Private method to drop the clients without connections whose bucket
+        refilled, must hold the lock"""
+        idle = self.idle
+        while idle:
+            address, fullAt = next(iter(idle.items()))
+            if fullAt > now:
+                break
+            del idle[address]
+            del self.clients[address]
+
+    def messageLimit(self, address: str) -> Optional[MessageLimit]:
+        """Rate limit of a new admitted connection from the given IP, None if messages
+        aren't limited"""
+        options = self.options
+        with self.lock:
+            ipBucket = self.clients[address].bucket
+        if not options.messageRate and ipBucket is None:
+            return None
+        bucket = TokenBucket(options.messageRate, options.messageBurst) \
+            if options.messageRate else None
+        return MessageLimit(bucket, ipBucket, self.lock,
+                            options.policy == RATE_POLICY_CLOSE, self.metrics)
@@ -0,0 +1,231 @@
+import threading
+from bisect import bisect_left
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+# -----Metrics overview:
+# one registry per process (getMetrics), the servers record into it unless given
+# metrics=None, read it with snapshot() (pull API) or exposition() (plain text in
+# the Prometheus format, also served by the servers on metricsPath)
+# hot path updates are plain integer increments, no lock is taken: under heavy
+# thread contention an increment can very rarely be lost, which is fine for
+# monitoring and keeps recording at a few tens of nanoseconds
+# timings are only measured on one operation out of sampleInterval, so the clock
+# reads and histogram updates don't show up in the throughput
+# NOTE: every worker process (see wssWorkers) has its own registry
+
+DEFAULT_SAMPLE_INTERVAL = 64
+# histogram bounds for the timings, in seconds (1us to 100ms)
+TIMING_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+                  1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 1e-1)
+
+OPCODE_NAMES = {0x0: 'continuation', 0x1: 'text', 0x2: 'binary',
+                0x8: 'close', 0x9: 'ping', 0xa: 'pong'}
+
+
+class Counter:
+    """A value that only goes up"""
+    __slots__ = ('name', 'help', 'value')
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def samples(self) -> List[Tuple[str, float]]:
+        return [(self.name, self.value)]
+
+
+class OpcodeCounter:
+    """A counter per frame opcode, the values list is indexed by opcode so the hot path
+    can do values[opcode] += n"""
+    __slots__ = ('name', 'help', 'values')
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values = [0] * 16
+
+    def inc(self, opcode: int, amount: int = 1):
+        self.values[opcode] += amount
+
+    def samples(self) -> List[Tuple[str, float]]:
+        return [('%s{opcode="%s"}' % (self.name, OPCODE_NAMES.get(opcode, opcode)), value)
+                for opcode, value in enumerate(self.values) if value]
+
+
+class Gauge:
+    """A value that goes up and down, or is read from a function when collected"""
+    __slots__ = ('name', 'help', 'value', 'function')
+
+    def __init__(self, name: str, help: str, function: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = function
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def dec(self, amount: int = 1):
+        self.value -= amount
+
+    def samples(self) -> List[Tuple[str, float]]:
+        return [(self.name, self.function() if self.function else self.value)]
+
+
+class Histogram:
+    """
+    Distribution of observed values over fixed buckets (upper bounds). Call sample()
+    to decide whether to measure the current operation, it is True once every
+    sampleInterval calls
+    """
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'sum', 'count', 'sampleInterval', 'skip')
+
+    def __init__(self, name: str, help: str, bounds=TIMING_BUCKETS,
+                 sampleInterval: int = DEFAULT_SAMPLE_INTERVAL):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(bounds)
+        # the last count is for values above every bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.sampleInterval = sampleInterval
+        self.skip = sampleInterval
+
+    def sample(self) -> bool:
+        self.skip -= 1
+        if self.skip > 0:
+            return False
+        self.skip = self.sampleInterval
+        return True
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self, function, *args):
+        """Call function, measuring it if sampled, returns its result"""
+        if not self.sample():
+            return function(*args)
+        start = perf_counter()
+        result = function(*args)
+        self.observe(perf_counter() - start)
+        return result
+
+    def samples(self) -> List[Tuple[str, float]]:
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            samples.append(('%s_bucket{le="%g"}' % (self.name, bound), cumulative))
+        samples.append(('%s_bucket{le="+Inf"}' % self.name, self.count))
+        samples.append(('%s_sum' % self.name, self.sum))
+        samples.append(('%s_count' % self.name, self.count))
+        return samples
+
+
+class Metrics:
+    """
+    Registry of the metrics of a process, the instruments used by the servers are
+    attributes so the hot path doesn't look anything up
+    """
+
+    def __init__(self, sampleInterval: int = DEFAULT_SAMPLE_INTERVAL):
+        self.lock = threading.Lock()
+        self.instruments: Dict[str, object] = {}
+        self.connectionsOpen = self.register(Gauge(
+            'wss_connections_open', 'Open websocket connections'))
+        self.handshakes = self.register(Counter(
+            'wss_handshakes_total', 'Completed websocket handshakes'))
+        self.handshakesFailed = self.register(Counter(
+            'wss_handshakes_failed_total', 'Rejected upgrade requests'))
+        self.connectionsRefused = self.register(Counter(
+            'wss_connections_refused_total', 'Upgrades refused by the connection limits'))
+        self.messagesLimited = self.register(Counter(
+            'wss_messages_rate_limited_total', 'Messages received over the rate limits'))
+        self.framesIn = self.register(OpcodeCounter(
+            'wss_frames_received_total', 'Frames received'))
+        self.bytesIn = self.register(OpcodeCounter(
+            'wss_payload_bytes_received_total', 'Payload bytes received'))
+        self.framesOut = self.register(OpcodeCounter(
+            'wss_frames_sent_total', 'Frames sent'))
+        self.bytesOut = self.register(OpcodeCounter(
+            'wss_frame_bytes_sent_total', 'Frame bytes (header included) sent'))
+        self.socketWrites = self.register(Counter(
+            'wss_socket_writes_total', 'send/sendmsg calls of the threaded engine'))
+        self.decodeSeconds = self.register(Histogram(
+            'wss_frame_decode_seconds', 'Time to decode a frame, unmasking included',
+            sampleInterval=sampleInterval))
+        self.unmaskSeconds = self.register(Histogram(
+            'wss_unmask_seconds', 'Time to unmask a frame payload',
+            sampleInterval=sampleInterval))
+        self.encodeSeconds = self.register(Histogram(
+            'wss_frame_encode_seconds', 'Time to encode an outgoing message',
+            sampleInterval=sampleInterval))
+
+    def register(self, instrument):
+        """Add an instrument (Counter, OpcodeCounter, Gauge, Histogram or anything with
+        name, help and samples()) to the registry, returns it"""
+        with self.lock:
+            self.instruments[instrument.name] = instrument
+        return instrument
+
+    def gauge(self, name: str, help: str, function: Callable[[], float]) -> Gauge:
+        """Add (or replace) a gauge whose value is read from function when collected"""
+        return self.register(Gauge(name, help, function))
+
+    def frameOut(self, frame):
+        """Count an outgoing frame, given its encoded bytes or its (header, payload)
+        parts"""
+        if type(frame) is tuple:
+            opcode = frame[0][0] & 0xf
+            size = sum(len(part) for part in frame)
+        else:
+            opcode = frame[0] & 0xf
+            size = len(frame)
+        self.framesOut.values[opcode] += 1
+        self.bytesOut.values[opcode] += size
+
+    def snapshot(self) -> Dict[str, float]:
+        """Pull API, returns every sample as name (with labels) -> value"""
+        with self.lock:
+            instruments = list(self.instruments.values())
+        snapshot = {}
+        for instrument in instruments:
+            snapshot.update(instrument.samples())
+        return snapshot
+
+    def exposition(self) -> str:
+        """Every metric in the plain text exposition format of Prometheus"""
+        with self.lock:
+            instruments = list(self.instruments.values())
+        lines = []
+        for instrument in instruments:
+            kind = {Counter: 'counter', OpcodeCounter: 'counter', Gauge: 'gauge',
+                    Histogram: 'histogram'}.get(type(instrument), 'untyped')
+            lines.append('# HELP %s %s' % (instrument.name, instrument.help))
+            lines.append('# TYPE %s %s' % (instrument.name, kind))
+            for name, value in instrument.samples():
+                lines.append('%s %s' % (name, _formatValue(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _formatValue(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+# the registry shared by every server of the process
+_metrics = Metrics()
+
+
+def getMetrics() -> Metrics:
+    """Returns the registry shared by every server of the process"""
+    return _metrics
@@ -0,0 +1,385 @@
+import multiprocessing
+import os
+import selectors
+import socket as sockets
+import stat
+import struct
+import sys
+import threading
+from collections import deque
+from typing import Callable, Dict, List, Optional, Set
+
+# -----Pub/sub overview:
+# a PubSub delivers the messages published on a channel to every callback
+# subscribed to it, messages are bytes and are never looked at
+# LocalPubSub only reaches the subscribers of its own process, BrokerPubSub also
+# reaches every other process connected to the same Broker over a unix socket
+# (the worker processes of wssWorkers, or separate servers on one machine)
+#
+# -----Broker protocol:
+# a stream of records, each a header (kind, channel length, payload length)
+# followed by the channel and the payload
+# clients send SUBSCRIBE and UNSUBSCRIBE for the channels they have subscribers
+# for, and PUBLISH records the broker forwards as is to every other client
+# subscribed to the channel: a message is encoded once by the publisher and the
+# same bytes go out to every subscriber
+# clients write the records published while their previous write was in progress
+# in a single write, the broker forwards everything it read at once with a
+# single write per subscriber
+
+SUBSCRIBE = 1
+UNSUBSCRIBE = 2
+PUBLISH = 3
+
+_HEADER = struct.Struct('!BHI')
+READ_SIZE = 65536
+# a broker client with more than this many bytes waiting is dropped
+MAX_PENDING = 64 * 1024 * 1024
+
+Callback = Callable[[str, bytes], None]
+LostCallback = Callable[['BrokerPubSub'], None]
+
+
+def encodeRecord(kind: int, channel: str, payload: bytes = b'') -> bytes:
+    """Returns the bytes of a broker protocol record"""
+    channel = channel.encode()
+    return _HEADER.pack(kind, len(channel), len(payload)) + channel + payload
+
+
+def decodeRecords(buffer: bytearray) -> List[tuple]:
+    """Remove the complete records from the start of the buffer, returns them as
+    (kind, channel bytes, payload bytes, record bytes) tuples"""
+    records = []
+    offset = 0
+    headerSize = _HEADER.size
+    while len(buffer) - offset >= headerSize:
+        kind, channelLength, payloadLength = _HEADER.unpack_from(buffer, offset)
+        start = offset + headerSize
+        end = start + channelLength + payloadLength
+        if end > len(buffer):
+            break
+        record = bytes(buffer[offset:end])
+        records.append((kind, record[headerSize:headerSize + channelLength],
+                        record[headerSize + channelLength:], record))
+        offset = end
+    del buffer[:offset]
+    return records
+
+
+class PubSub:
+    """
+    Interface of the pub/sub backends. Callbacks are given the channel and the
+    message, they may be called from any thread (a background thread for messages
+    coming from other processes), asyncio code should hand the message over to its
+    loop with loop.call_soon_threadsafe
+    """
+
+    def subscribe(self, channel: str, callback: Callback):
+        """Call callback for every message published on channel from now on"""
+        raise NotImplementedError
+
+    def unsubscribe(self, channel: str, callback: Callback):
+        """Stop calling callback for the messages of channel"""
+        raise NotImplementedError
+
+    def publish(self, channel: str, message: bytes):
+        """Deliver message to every subscriber of channel, in this process included"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class LocalPubSub(PubSub):
+    """Pub/sub between the threads of a single process, messages are delivered
+    synchronously by publish"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers: Dict[str, List[Callback]] = {}
+
+    def subscribe(self, channel: str, callback: Callback):
+        with self.lock:
+            # copy on write, deliveries iterate without the lock
+            self.subscribers[channel] = self.subscribers.get(channel, []) + [callback]
+
+    def unsubscribe(self, channel: str, callback: Callback):
+        with self.lock:
+            callbacks = [other for other in self.subscribers.get(channel, ())
+                         if other is not callback]
+            if callbacks:
+                self.subscribers[channel] = callbacks
+            else:
+                self.subscribers.pop(channel, None)
+
+    def publish(self, channel: str, message: bytes):
+        self._deliver(channel, message)
+
+    def _deliver(self, channel: str, message: bytes):
+        """Private method to call the subscribers of this process"""
+        for callback in self.subscribers.get(channel, ()):
+            callback(channel, message)
+
+
+class BrokerPubSub(LocalPubSub):
+    """
+    Pub/sub across processes through the Broker listening on the given unix socket
+    path. Publishing never waits for the broker, records are queued and written by
+    a background thread, batchInterval (seconds) makes it wait that long for more
+    records before each write.
+    If the broker goes away messages only reach this process from then on,
+    connected turns False and onLost is called with the instance (on a background
+    thread)
+    """
+
+    def __init__(self, path: str, batchInterval: float = 0,
+                 onLost: Optional[LostCallback] = None):
+        super().__init__()
+        self.path = path
+        self.batchInterval = batchInterval
+        self.onLost = onLost
+        # False once the broker went away (or the instance was closed)
+        self.connected = True
+        self.socket = sockets.socket(sockets.AF_UNIX, sockets.SOCK_STREAM)
+        self.socket.connect(path)
+        self.outgoing: List[bytes] = []
+        self.outgoingLock = threading.Lock()
+        self.ready = threading.Condition(self.outgoingLock)
+        self.closed = False
+        threading.Thread(target=self._writeLoop, daemon=True).start()
+        threading.Thread(target=self._readLoop, daemon=True).start()
+
+    def subscribe(self, channel: str, callback: Callback):
+        with self.lock:
+            first = channel not in self.subscribers
+            self.subscribers[channel] = self.subscribers.get(channel, []) + [callback]
+            # the broker only needs to know about the channel once, queued under the
+            # lock so subscribe and unsubscribe records go out in order
+            if first:
+                self._send(encodeRecord(SUBSCRIBE, channel))
+
+    def unsubscribe(self, channel: str, callback: Callback):
+        with self.lock:
+            callbacks = [other for other in self.subscribers.get(channel, ())
+                         if other is not callback]
+            if callbacks:
+                self.subscribers[channel] = callbacks
+            elif self.subscribers.pop(channel, None) is not None:
+                self._send(encodeRecord(UNSUBSCRIBE, channel))
+
+    def publish(self, channel: str, message: bytes):
+        self._send(encodeRecord(PUBLISH, channel, message))
+        self._deliver(channel, message)
+
+    def close(self):
+        with self.outgoingLock:
+            self.closed = True
+            self.connected = False
+            self.ready.notify()
+        try:
+            self.socket.shutdown(sockets.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _send(self, record: bytes):
+        """Private method to queue a record for the writer thread"""
+        with self.outgoingLock:
+            if self.closed:
+                return
+            self.outgoing.append(record)
+            if len(self.outgoing) == 1:
+                self.ready.notify()
+
+    def _writeLoop(self):
+        """Writer thread main loop, writes every queued record at once"""
+        while True:
+            with self.outgoingLock:
+                self.ready.wait_for(lambda: self.outgoing or self.closed)
+                if self.closed:
+                    return
+                if self.batchInterval:
+                    self.ready.wait(self.batchInterval)
+                batch, self.outgoing = self.outgoing, []
+            try:
+                self.socket.sendall(b''.join(batch))
+            except OSError:
+                self._lost()
+                return
+
+    def _readLoop(self):
+        """Reader thread main loop, delivers the messages of the other processes"""
+        buffer = bytearray()
+        while True:
+            try:
+                data = self.socket.recv(READ_SIZE)
+            except OSError:
+                data = b''
+            if not data:
+                self._lost()
+                return
+            buffer += data
+            for kind, channel, payload, record in decodeRecords(buffer):
+                if kind == PUBLISH:
+                    self._deliver(channel.decode(), payload)
+
+    def _lost(self):
+        """Private method, the broker went away, only this process is reached from
+        now on"""
+        with self.outgoingLock:
+            if self.closed:
+                return
+            self.closed = True
+            self.connected = False
+            self.outgoing = []
+            self.ready.notify()
+        if self.onLost is not None:
+            self.onLost(self)
+
+
+class _Peer:
+    """A process connected to the broker"""
+    __slots__ = ('socket', 'buffer', 'out', 'pending', 'channels', 'writing')
+
+    def __init__(self, socket):
+        self.socket = socket
+        self.buffer = bytearray()
+        self.out = deque()
+        self.pending = 0
+        self.channels: Set[bytes] = set()
+        # registered for write events
+        self.writing = False
+
+
+class Broker:
+    """
+    Forwards the messages published by its clients (BrokerPubSub) to the other
+    clients subscribed to the channel, listens on the given unix socket path.
+    The socket is bound when created, serveForever runs the broker on the calling
+    thread
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # a socket file left by a previous broker
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        self.listener = sockets.socket(sockets.AF_UNIX, sockets.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(sockets.SOMAXCONN)
+        self.listener.setblocking(False)
+        self.selector = None
+        # channel -> peers subscribed to it
+        self.channels: Dict[bytes, Set[_Peer]] = {}
+
+    def serveForever(self):
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        while True:
+            for key, events in self.selector.select():
+                if key.fileobj is self.listener:
+                    self._accept()
+                    continue
+                peer: _Peer = key.data
+                if events & selectors.EVENT_WRITE:
+                    self._flush(peer)
+                if events & selectors.EVENT_READ:
+                    self._read(peer)
+
+    def _accept(self):
+        try:
+            socket, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+        socket.setblocking(False)
+        peer = _Peer(socket)
+        self.selector.register(socket, selectors.EVENT_READ, peer)
+
+    def _read(self, peer: _Peer):
+        """Private method to handle everything a peer sent, the messages are forwarded
+        with one write per subscriber"""
+        try:
+            data = peer.socket.recv(READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(peer)
+            return
+        peer.buffer += data
+        touched = set()
+        for kind, channel, payload, record in decodeRecords(peer.buffer):
+            if kind == PUBLISH:
+                for subscriber in self.channels.get(channel, ()):
+                    if subscriber is not peer:
+                        subscriber.out.append(record)
+                        subscriber.pending += len(record)
+                        touched.add(subscriber)
+            elif kind == SUBSCRIBE:
+                self.channels.setdefault(channel, set()).add(peer)
+                peer.channels.add(channel)
+            elif kind == UNSUBSCRIBE:
+                self._unsubscribe(peer, channel)
+        for subscriber in touched:
+            self._flush(subscriber)
+
+    def _flush(self, peer: _Peer):
+        """Private method to write what the peer's socket takes without blocking"""
+        if peer.out:
+            data = b''.join(peer.out)
+            peer.out.clear()
+            try:
+                sent = peer.socket.send(data)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self._drop(peer)
+                return
+            if sent < len(data):
+                peer.out.append(memoryview(data)[sent:])
+            peer.pending = len(data) - sent
+        if peer.pending > MAX_PENDING:
+            # a client that stopped reading, don't hold everything for it
+            self._drop(peer)
+            return
+        writing = bool(peer.out)
+        if writing != peer.writing:
+            peer.writing = writing
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+            self.selector.modify(peer.socket, events, peer)
+
+    def _unsubscribe(self, peer: _Peer, channel: bytes):
+        peer.channels.discard(channel)
+        subscribers = self.channels.get(channel)
+        if subscribers is not None:
+            subscribers.discard(peer)
+            if not subscribers:
+                del self.channels[channel]
+
+    def _drop(self, peer: _Peer):
+        """Private method to forget a peer that went away"""
+        for channel in list(peer.channels):
+            self._unsubscribe(peer, channel)
+        try:
+            self.selector.unregister(peer.socket)
+        except (KeyError, ValueError):
+            pass
+        peer.socket.close()
+        peer.out.clear()
+
+
+def startBroker(path: str) -> multiprocessing.Process:
+    """Bind a broker on the given unix socket path and serve it from a new process,
+    once this returns clients can connect"""
+    broker = Broker(path)
+    # not a daemon, like the workers it outlives the main thread of the parent
+    process = multiprocessing.Process(target=broker.serveForever)
+    process.start()
+    # the broker process holds the socket now
+    broker.listener.close()
+    return process
+
+
+if __name__ == '__main__':
+    # standalone broker, for servers started separately
+    Broker(sys.argv[1]).serveForever()
@@ -0,0 +1,151 @@
+import array
+import os
+import random
+import socket as sockets
+import stat
+import threading
+from typing import Callable, List, Optional, Tuple
+
+# -----Shutdown overview:
+# draining: the server stops accepting (upgrades still in their handshake get a
+# 503), sends every connection a close frame with 1001 (going away), spread at
+# random over the jitter window so the clients don't all reconnect at the same
+# moment, waits for the clients to answer up to the drain timeout, drops whatever
+# is left and exits
+# SIGTERM drains the workers, sent to the parent it is forwarded to them, so a
+# process manager stopping the server gets a graceful shutdown
+#
+# -----Hot handoff:
+# a server started with a handoff path listens on that unix socket, a new server
+# started with the same path connects to it and receives the listening sockets
+# (SCM_RIGHTS) instead of binding the port, once its workers are started the old
+# server drains and the new one takes over the handoff path
+# connections waiting in the accept queue belong to the socket, not the process,
+# so none is refused during the restart
+# servers with a handoff path bind with SO_REUSEPORT whatever their number of
+# workers, so a new server with more workers binds the missing sockets next to
+# the handed over ones, one with fewer workers closes the sockets it has no
+# worker for (the connections in their accept queue are reset)
+
+DEFAULT_DRAIN_TIMEOUT = 10
+# upper bound on the listening sockets handed over
+MAX_LISTENERS = 256
+
+_READY = b'1'
+
+
+class DrainOptions:
+    """
+    Graceful shutdown settings, in seconds.
+
+    timeout: how long the clients get to answer the close frames, from the start of
+        the drain, connections still open then are dropped
+    jitter: close frames are sent at random times over this window, so clients
+        reconnecting right away spread their reconnects over it too
+    """
+
+    def __init__(self, timeout: float = DEFAULT_DRAIN_TIMEOUT, jitter: float = 0):
+        assert(0 <= jitter <= timeout)
+        self.timeout = timeout
+        self.jitter = jitter
+
+
+DEFAULT_DRAIN = DrainOptions()
+
+
+def closeSchedule(connections, jitter: float) -> List[Tuple[float, object]]:
+    """(delay, connection) pairs ordered by delay, the delays spread at random over
+    jitter seconds"""
+    if not jitter:
+        return [(0.0, conn) for conn in connections]
+    return sorted(((random.uniform(0, jitter), conn) for conn in connections),
+                  key=lambda pair: pair[0])
+
+
+def takeListeners(path: str, count: int) -> Optional[Tuple[List[sockets.socket], sockets.socket]]:
+    """Receive the listening sockets of the server running on the handoff path,
+    returns at most count of them (the others are closed) and the connection to
+    confirm the handoff on (see confirmHandoff), None if no server runs there.
+    Raises OSError if fewer than count were received and the missing ones can't be
+    bound next to them (bound without SO_REUSEPORT), the running server keeps serving"""
+    connection = sockets.socket(sockets.AF_UNIX, sockets.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        connection.close()
+        return None
+    fds = array.array('i')
+    _, ancdata, _, _ = connection.recvmsg(16, sockets.CMSG_LEN(MAX_LISTENERS * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == sockets.SOL_SOCKET and kind == sockets.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    if not fds:
+        connection.close()
+        raise OSError('no listening socket received from %s' % path)
+    listeners = [sockets.socket(fileno=fd) for fd in fds]
+    for listener in listeners[count:]:
+        listener.close()
+    listeners = listeners[:count]
+    if len(listeners) < count and not all(_reusesPort(listener) for listener in listeners):
+        for listener in listeners:
+            listener.close()
+        connection.close()
+        raise OSError('the server on %s serves %d listening socket(s) bound without '
+                      'SO_REUSEPORT, can\'t add more to run %d workers, start this '
+                      'server with workers=%d' % (path, len(listeners), count, len(listeners)))
+    return listeners, connection
+
+
+def _reusesPort(listener: sockets.socket) -> bool:
+    """Whether the socket was bound with SO_REUSEPORT"""
+    if not hasattr(sockets, 'SO_REUSEPORT'):
+        return False
+    return bool(listener.getsockopt(sockets.SOL_SOCKET, sockets.SO_REUSEPORT))
+
+
+def confirmHandoff(connection: sockets.socket):
+    """Tell the previous server the new one serves the sockets, it then drains. Returns
+    once it stopped listening on the handoff path"""
+    connection.sendall(_READY)
+    connection.recv(1)
+    connection.close()
+
+
+class HandoffListener:
+    """
+    Hands the given listening sockets over to the next server started with the same
+    handoff path, onHandoff is called (on a background thread) once that server
+    confirmed it serves them
+    """
+
+    def __init__(self, path: str, listeners: List[sockets.socket], onHandoff: Callable[[], None]):
+        self.path = path
+        self.listeners = listeners
+        self.onHandoff = onHandoff
+        # the previous server let go of the path, or a stale socket file
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        self.socket = sockets.socket(sockets.AF_UNIX, sockets.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen(1)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        """Private method, wait for the next server"""
+        while True:
+            connection, _ = self.socket.accept()
+            try:
+                fds = array.array('i', [listener.fileno() for listener in self.listeners])
+                connection.sendmsg([b'%d' % len(fds)],
+                                   [(sockets.SOL_SOCKET, sockets.SCM_RIGHTS, fds)])
+                ready = connection.recv(1) == _READY
+            except OSError:
+                ready = False
+            if ready:
+                break
+            # the new server gave up, keep serving
+            connection.close()
+        # stop listening before the new server takes the path over
+        self.socket.close()
+        connection.close()
+        self.onHandoff()
@@ -0,0 +1,229 @@
+import math
+import os
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+# -----Timer overview:
+# every connection has at most one timer, in a timer wheel shared by every
+# connection of the process (or of the event loop for the asyncio engine)
+# the wheel is an array of slots, each covering tick seconds, a timer sits in the
+# slot of its deadline, advancing the wheel only looks at the slots whose time
+# has passed, so the cost doesn't depend on the number of far away timers
+# receiving data only stores a timestamp on the connection, the timer callback
+# compares timestamps when it fires and returns when it wants to fire next
+# (see Keepalive), so busy connections never touch the wheel
+
+DEFAULT_TICK = 0.25
+DEFAULT_SLOTS = 1024
+
+# what a connection should do when its keepalive timer fires (see Keepalive.check)
+ACTION_PING = 'ping'
+ACTION_ABORT = 'abort'
+ACTION_IDLE = 'idle'
+
+
+class Timer:
+    """A scheduled callback, the callback is given the current time and returns the
+    time to be called again, or None"""
+    __slots__ = ('deadline', 'callback', 'cancelled')
+
+    def __init__(self, deadline: float, callback: Callable[[float], Optional[float]]):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        """The callback won't be called anymore, the wheel forgets the timer the next
+        time it looks at its slot"""
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel, deadlines are time.monotonic() values and are honoured to
+    within one tick. Either run its own thread with start() or call advance()
+    periodically from an event loop
+    """
+
+    def __init__(self, tick: float = DEFAULT_TICK, slots: int = DEFAULT_SLOTS):
+        self.tick = tick
+        self.slots: List[List[Timer]] = [[] for _ in range(slots)]
+        self.lock = threading.Lock()
+        # last tick the wheel advanced to
+        self.current = int(time.monotonic() / tick)
+        self.pid = None
+
+    def schedule(self, deadline: float, callback: Callable[[float], Optional[float]]) -> Timer:
+        """Call callback(now) once the deadline passed, the callback returns the next
+        deadline to be called again, or None"""
+        timer = Timer(deadline, callback)
+        self._add(timer)
+        return timer
+
+    def advance(self, now: Optional[float] = None):
+        """Fire every timer whose deadline passed, from the calling thread"""
+        if now is None:
+            now = time.monotonic()
+        target = int(now / self.tick)
+        due: List[Timer] = []
+        with self.lock:
+            slots = self.slots
+            count = len(slots)
+            # past a full turn every slot is looked at once
+            first = max(self.current + 1, target - count + 1)
+            for tick in range(first, target + 1):
+                slot = slots[tick % count]
+                if not slot:
+                    continue
+                keep = []
+                for timer in slot:
+                    if timer.cancelled:
+                        continue
+                    if timer.deadline <= now:
+                        due.append(timer)
+                    else:
+                        # deadline a turn (or more) away
+                        keep.append(timer)
+                slots[tick % count] = keep
+            self.current = max(self.current, target)
+        for timer in due:
+            if timer.cancelled:
+                continue
+            deadline = timer.callback(now)
+            if deadline is not None and not timer.cancelled:
+                timer.deadline = deadline
+                self._add(timer)
+
+    def start(self):
+        """Run the wheel on a background thread, once per process"""
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # first use in this process (the server runs in a forked process)
+            self.pid = os.getpid()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _add(self, timer: Timer):
+        """Private method to put a timer in the slot of its deadline"""
+        # the first tick at or after the deadline, so the timer is due by the time the
+        # wheel reaches its slot
+        tick = math.ceil(timer.deadline / self.tick)
+        with self.lock:
+            tick = max(tick, self.current + 1)
+            self.slots[tick % len(self.slots)].append(timer)
+
+    def _run(self):
+        """Background thread main loop"""
+        while True:
+            time.sleep(self.tick)
+            self.advance()
+
+
+# the wheel shared by every threaded connection of the process
+_wheel = TimerWheel()
+
+
+def getTimerWheel() -> TimerWheel:
+    """Returns the running wheel shared by every connection of the process"""
+    _wheel.start()
+    return _wheel
+
+
+class KeepaliveOptions:
+    """
+    Timeouts of a connection, in seconds, None disables each of them.
+
+    pingInterval: send a ping once nothing was received for this long
+    pongTimeout: drop the connection if nothing is received this long after a ping
+    idleTimeout: close the connection (1001) once no message was received for this
+        long, pings and pongs don't count
+    closeTimeout: drop the connection if the client doesn't answer a close frame
+        within this time
+    """
+
+    def __init__(self, pingInterval: Optional[float] = 20, pongTimeout: Optional[float] = 20,
+                 idleTimeout: Optional[float] = None, closeTimeout: Optional[float] = 5):
+        assert(pingInterval is None or pongTimeout is not None)
+        self.pingInterval = pingInterval
+        self.pongTimeout = pongTimeout
+        self.idleTimeout = idleTimeout
+        self.closeTimeout = closeTimeout
+
+
+DEFAULT_KEEPALIVE = KeepaliveOptions()
+
+
+class Keepalive:
+    """
+    Keepalive state of one connection, the connection updates lastReceived on every
+    read and lastMessage on every message, check() decides what to do about it
+    """
+    __slots__ = ('options', 'lastReceived', 'lastMessage', 'pingSent', 'closeSent',
+                 'closeDeadline')
+
+    def __init__(self, options: KeepaliveOptions, now: Optional[float] = None):
+        if now is None:
+            now = time.monotonic()
+        self.options = options
+        self.lastReceived = now
+        self.lastMessage = now
+        # when the unanswered ping was sent
+        self.pingSent: Optional[float] = None
+        # set once a close frame is sent, nothing is pinged from then on
+        self.closeSent = False
+        # when to give up on the close handshake, set once a close frame is sent
+        self.closeDeadline: Optional[float] = None
+
+    def closing(self, now: float) -> Optional[float]:
+        """A close frame was sent, returns the deadline for the answer (None without a
+        close timeout, there is nothing left to watch then)"""
+        self.closeSent = True
+        if self.options.closeTimeout is not None:
+            self.closeDeadline = now + self.options.closeTimeout
+        return self.closeDeadline
+
+    def firstDeadline(self) -> Optional[float]:
+        """When check() first needs to be called"""
+        options = self.options
+        deadlines = [self.lastReceived + options.pingInterval if options.pingInterval else None,
+                     self.lastMessage + options.idleTimeout if options.idleTimeout else None]
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    def check(self, now: float) -> Tuple[Optional[str], Optional[float]]:
+        """Returns what the connection should do now (an ACTION_* or None) and when to
+        check again (None once there is nothing left to watch)"""
+        options = self.options
+        if self.closeSent:
+            if self.closeDeadline is None:
+                return None, None
+            if now >= self.closeDeadline:
+                return ACTION_ABORT, None
+            return None, self.closeDeadline
+        action = None
+        deadlines = []
+        if options.idleTimeout is not None:
+            due = self.lastMessage + options.idleTimeout
+            if now >= due:
+                # the connection closes, the close timeout takes over
+                return ACTION_IDLE, None
+            deadlines.append(due)
+        if options.pingInterval is not None:
+            if self.pingSent is not None:
+                if self.lastReceived >= self.pingSent:
+                    # the client answered, or sent anything else
+                    self.pingSent = None
+                elif now - self.pingSent >= options.pongTimeout:
+                    return ACTION_ABORT, None
+                else:
+                    deadlines.append(self.pingSent + options.pongTimeout)
+            if self.pingSent is None:
+                due = self.lastReceived + options.pingInterval
+                if now >= due:
+                    action = ACTION_PING
+                    self.pingSent = now
+                    deadlines.append(now + options.pongTimeout)
+                else:
+                    deadlines.append(due)
+        return action, min(deadlines) if deadlines else None
@@ -1,3 +1,11 @@
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# payload size from which unmask hands the work to NumPy (if installed)
+NUMPY_UNMASK_THRESHOLD = 4096
+
 def s2bs(s: str) -> str:
   """
   String -> BitString
@@ -31,4 +39,55 @@ def bs2b(s:str, endian='big') -> bytes:
     res = int(s, 2).to_bytes(max(len(s)//8, 1), endian)
   except:
     res = int(s, 2).to_bytes(max(len(s)//8+1, 1), endian)
-  return res
\ No newline at end of file
+  return res
+
+def unmask(data, mask: bytes) -> bytes:
+  """
+  Returns the given payload XORed with the repeating 4 byte masking key.
+  The whole payload is XORed at once, as one big integer (or as a NumPy array
+  when NumPy is installed and the payload is large enough to be worth it)
+  """
+  n = len(data)
+  if n == 0:
+    return b''
+  if numpy is not None and n >= NUMPY_UNMASK_THRESHOLD:
+    return _unmaskNumpy(data, mask, n)
+  # repeat the key to the payload length, then XOR both as little endian integers
+  key = (mask * ((n >> 2) + 1))[:n]
+  return (int.from_bytes(data, 'little') ^ int.from_bytes(key, 'little')).to_bytes(n, 'little')
+
+def _unmaskNumpy(data, mask: bytes, n: int) -> bytes:
+  """
+  NumPy version of unmask, XORs 4 bytes at a time and the leftover tail byte by byte
+  """
+  words = n >> 2
+  out = numpy.frombuffer(data, dtype=numpy.uint8).copy()
+  if words:
+    out[:words << 2].view(numpy.uint32)[:] ^= numpy.frombuffer(mask, dtype=numpy.uint32)[0]
+  for i in range(words << 2, n):
+    out[i] ^= mask[i & 3]
+  return out.tobytes()
+
+def unmaskInPlace(view: memoryview, mask: bytes):
+  """
+  Unmask a payload held in a writable buffer, returns a buffer holding the unmasked
+  payload: the given view itself when NumPy unmasks it in place (installed and large
+  enough payload), otherwise the bytes returned by unmask
+  """
+  n = len(view)
+  if numpy is None or n < NUMPY_UNMASK_THRESHOLD:
+    return unmask(view, mask)
+  words = n >> 2
+  array = numpy.frombuffer(view, dtype=numpy.uint8)
+  if words:
+    array[:words << 2].view(numpy.uint32)[:] ^= numpy.frombuffer(mask, dtype=numpy.uint32)[0]
+  for i in range(words << 2, n):
+    array[i] ^= mask[i & 3]
+  return view
+
+def unmaskBytewise(data, mask: bytes) -> bytes:
+  """
+  Reference version of unmask that XORs one byte at a time, only kept for
+  testing and benchmarking the fast version
+  """
+  return bytes(b ^ mask[i & 3] for i, b in enumerate(data))
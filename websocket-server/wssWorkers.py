@@ -0,0 +1,71 @@
+import multiprocessing
+import os
+import socket as sockets
+from typing import Callable, List, Optional
+# local imports:
+from wssHandshake import HandshakeServer
+
+# -----Worker mode overview:
+# the parent process binds one listening socket per worker, all on the same port
+# with SO_REUSEPORT, then forks the workers
+# each worker serves only its own socket, the kernel spreads new connections
+# across the sockets so every worker (and its GIL) gets a share of the clients
+# a connection stays in the worker that accepted it for its whole life
+#
+# -----Application state across workers:
+# workers are forked, module level state created before the server is copied into
+# every worker and from then on each worker changes its own copy: state is
+# partitioned by connection, a worker only ever sees the clients it accepted
+# (currentWorker() tells which worker the code runs in)
+# state every worker must see has to live outside the workers, created before the
+# server starts so it is inherited, e.g. a multiprocessing.Manager dict or Value,
+# or an external store
+# connections can't be shared, reaching a client of another worker means relaying
+# the message to that worker which then sends it (see wssPubSub)
+
+
+# id of the worker the process runs, None outside of worker processes
+_workerId: Optional[int] = None
+
+
+def currentWorker() -> Optional[int]:
+    """Id of the worker process the calling code runs in (0 to workers - 1), None
+    in processes not started by startWorkers"""
+    return _workerId
+
+
+def reusePortSupported() -> bool:
+    """Whether the platform can bind several listening sockets to the same port"""
+    return hasattr(sockets, 'SO_REUSEPORT')
+
+
+def defaultWorkers() -> int:
+    """One worker per core"""
+    return os.cpu_count() or 1
+
+
+class ReusePortServer(HandshakeServer):
+    """HandshakeServer whose listening socket shares its port with the sockets of
+    the other workers"""
+
+    def server_bind(self):
+        self.socket.setsockopt(sockets.SOL_SOCKET, sockets.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+def startWorkers(target: Callable[[int], None], workers: int) -> List[multiprocessing.Process]:
+    """Fork the given number of worker processes, each calls target with its worker
+    id (0 to workers - 1)"""
+    processes = []
+    for workerId in range(workers):
+        process = multiprocessing.Process(target=_runWorker, args=(target, workerId))
+        process.start()
+        processes.append(process)
+    return processes
+
+
+def _runWorker(target: Callable[[int], None], workerId: int):
+    """Private function, entry point of a worker process"""
+    global _workerId
+    _workerId = workerId
+    target(workerId)
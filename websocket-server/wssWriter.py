@@ -0,0 +1,389 @@
+import heapq
+import itertools
+import os
+import selectors
+import socket as sockets
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Set, Tuple
+
+# -----Outbound data flow:
+# WebSocketConnection.send encodes a frame and pushes it on the connection's SendQueue
+# if nothing is queued the queue tries a non-blocking write straight away
+# whatever the socket doesn't take is queued and the queue is handed to the
+# SocketWriter, a single thread per process that waits for sockets to become
+# writable and drains their queues
+# a connection whose queue grows past its high watermark is a slow consumer and is
+# handled by its policy until the queue drains back below the low watermark
+#
+# -----Write coalescing:
+# with a flush interval, frames are never written straight away: they are queued
+# and the writer thread flushes the queue flushInterval seconds after its first
+# frame (0 to flush as soon as the writer gets to it), every frame gathered in the
+# meantime goes out in a single sendmsg, without being joined into one buffer
+# this trades a little latency for far fewer syscalls when a connection gets
+# bursts of small frames (chat broadcasts)
+#
+# -----Large payloads:
+# frames with a large payload are pushed as (header, payload) parts and written
+# with a single sendmsg, the payload is never copied into the frame
+# the payload may be a view over a buffer the caller reuses (zero-copy relays), so
+# only the part of it the socket didn't take is copied into the queue
+
+# what to do with a slow consumer (see SendQueue)
+POLICY_DROP = 'drop'
+POLICY_DISCONNECT = 'disconnect'
+POLICY_BLOCK = 'block'
+POLICIES = (POLICY_DROP, POLICY_DISCONNECT, POLICY_BLOCK)
+
+DEFAULT_HIGH_WATERMARK = 1024 * 1024
+DEFAULT_LOW_WATERMARK = 256 * 1024
+
+# non-blocking send on a blocking socket, the listen loop keeps its blocking reads
+MSG_DONTWAIT = getattr(sockets, 'MSG_DONTWAIT', 0)
+# scatter/gather writes, where available
+HAS_SENDMSG = hasattr(sockets.socket, 'sendmsg')
+# most buffers handed to a single sendmsg
+IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024) if hasattr(os, 'sysconf') else 16
+
+
+def setNoDelay(socket):
+    """Disable Nagle's algorithm on the socket, frames are written whole (or
+    coalesced on purpose) so they should go out right away"""
+    try:
+        socket.setsockopt(sockets.IPPROTO_TCP, sockets.TCP_NODELAY, 1)
+    except (OSError, AttributeError):
+        # not a TCP socket
+        pass
+
+
+class SendQueue:
+    """
+    Bounded outbound queue of one connection.
+
+    Once more than highWatermark bytes are queued the connection is congested until
+    the queue drains back to lowWatermark bytes, while congested new messages are
+    handled depending on the policy:
+    - drop: the message is discarded (and counted in droppedMessages)
+    - disconnect: the connection is shut down, its listen loop will close it
+    - block: the sending thread waits until the queue drains
+
+    With a flushInterval (seconds) frames are coalesced, see the overview above.
+    """
+
+    def __init__(self, socket, highWatermark: int = DEFAULT_HIGH_WATERMARK,
+                 lowWatermark: int = DEFAULT_LOW_WATERMARK, policy: str = POLICY_DISCONNECT,
+                 writer: 'SocketWriter' = None, metrics=None,
+                 flushInterval: Optional[float] = None):
+        assert(policy in POLICIES)
+        assert(0 <= lowWatermark <= highWatermark)
+        assert(flushInterval is None or flushInterval >= 0)
+        self.socket = socket
+        self.fd = socket.fileno()
+        self.highWatermark = highWatermark
+        self.lowWatermark = lowWatermark
+        self.policy = policy
+        self.writer = writer or getWriter()
+        # wssMetrics.Metrics counting the frames sent, None if not recording
+        self.metrics = metrics
+        # None writes frames straight away, see SendQueue
+        self.flushInterval = flushInterval
+        self.buffers = deque()
+        self.lock = threading.Lock()
+        self.drained = threading.Condition(self.lock)
+        self.registered = False
+        self.congested = False
+        self.closed = False
+        # metrics
+        self.queuedBytes = 0
+        self.droppedMessages = 0
+
+    def push(self, payload, force: bool = False) -> bool:
+        """Send or queue the given bytes, returns False if they were dropped.
+        payload may also be a tuple of buffers written one after the other (a frame
+        header and its payload), or a callable returning the bytes, it is only called
+        once the message is accepted, under the queue lock (used for stateful
+        compression). force bypasses the slow consumer policy (used for control frames)"""
+        with self.lock:
+            if self.closed:
+                return False
+            if self.congested and not force:
+                if self.policy == POLICY_DROP:
+                    self.droppedMessages += 1
+                    return False
+                elif self.policy == POLICY_DISCONNECT:
+                    self._disconnect()
+                    return False
+                self.drained.wait_for(lambda: not self.congested or self.closed)
+                if self.closed:
+                    return False
+            if callable(payload):
+                payload = payload()
+            metrics = self.metrics
+            if metrics is not None:
+                metrics.frameOut(payload)
+            if type(payload) is tuple:
+                return self._pushParts(payload)
+            if not self.buffers and self.flushInterval is None:
+                # nothing queued, try to write straight to the socket
+                try:
+                    sent = self.socket.send(payload, MSG_DONTWAIT)
+                except BlockingIOError:
+                    sent = 0
+                except OSError:
+                    self._disconnect()
+                    return False
+                if metrics is not None:
+                    metrics.socketWrites.inc()
+                if sent == len(payload):
+                    return True
+                payload = memoryview(payload)[sent:]
+            self._queue(payload)
+            return True
+
+    def _pushParts(self, parts) -> bool:
+        """Private method to send or queue the buffers of a frame, must hold the lock.
+        Nothing but the unwritten part of buffers that aren't bytes is copied, so the
+        caller may reuse them once push returns"""
+        sent = 0
+        if not self.buffers and self.flushInterval is None:
+            try:
+                if HAS_SENDMSG:
+                    sent = self.socket.sendmsg(parts, (), MSG_DONTWAIT)
+                else:
+                    sent = self.socket.send(b''.join(parts), MSG_DONTWAIT)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self._disconnect()
+                return False
+            if self.metrics is not None:
+                self.metrics.socketWrites.inc()
+        for part in parts:
+            size = len(part)
+            if sent >= size:
+                sent -= size
+                continue
+            if type(part) is not bytes:
+                part = bytes(memoryview(part)[sent:])
+            elif sent:
+                part = memoryview(part)[sent:]
+            sent = 0
+            self._queue(part)
+        return True
+
+    def _queue(self, payload):
+        """Private method to queue bytes for the writer thread, must hold the lock"""
+        self.buffers.append(payload)
+        self.queuedBytes += len(payload)
+        if self.queuedBytes > self.highWatermark:
+            self.congested = True
+        if not self.registered:
+            self.registered = True
+            # coalescing, the writer flushes the queue once the interval is over
+            self.writer.register(self, self.flushInterval)
+
+    def flush(self) -> bool:
+        """Write as much of the queue as the socket takes without blocking, called by
+        the writer thread, returns True once there is nothing left to write"""
+        with self.lock:
+            buffers = self.buffers
+            while buffers and not self.closed:
+                try:
+                    if len(buffers) > 1 and HAS_SENDMSG:
+                        # every queued frame in one syscall, no copy
+                        batch = list(itertools.islice(buffers, IOV_MAX))
+                        sent = self.socket.sendmsg(batch, (), MSG_DONTWAIT)
+                    else:
+                        batch = (buffers[0],)
+                        sent = self.socket.send(buffers[0], MSG_DONTWAIT)
+                except BlockingIOError:
+                    break
+                except OSError:
+                    self._disconnect()
+                    break
+                if self.metrics is not None:
+                    self.metrics.socketWrites.inc()
+                self.queuedBytes -= sent
+                # drop the buffers written, keep what's left of a partially written one
+                for head in batch:
+                    if sent < len(head):
+                        break
+                    sent -= len(head)
+                    buffers.popleft()
+                else:
+                    continue
+                if sent:
+                    buffers[0] = memoryview(head)[sent:]
+                # the socket didn't take everything
+                break
+            if self.congested and self.queuedBytes <= self.lowWatermark:
+                self.congested = False
+                self.drained.notify_all()
+            if buffers and not self.closed:
+                return False
+            self.registered = False
+            return True
+
+    def waitForDrain(self) -> bool:
+        """Block while the queue is congested, returns False if the queue closed"""
+        with self.lock:
+            self.drained.wait_for(lambda: not self.congested or self.closed)
+            return not self.closed
+
+    def close(self):
+        """Discard anything still queued and release blocked senders"""
+        with self.lock:
+            self.closed = True
+            self.buffers.clear()
+            self.queuedBytes = 0
+            self.drained.notify_all()
+            if self.registered:
+                # let the writer forget about this socket
+                self.registered = False
+                self.writer.register(self)
+
+    def _disconnect(self):
+        """Private method to give up on the connection, must hold the lock. Shutting
+        the socket down wakes the listen loop which then closes the connection"""
+        self.closed = True
+        self.buffers.clear()
+        self.queuedBytes = 0
+        self.drained.notify_all()
+        try:
+            self.socket.shutdown(sockets.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class SocketWriter:
+    """
+    Drains the send queues of every connection of the process from a single thread,
+    queues register themselves when the socket didn't take all their data and are
+    dropped once empty
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending: List[SendQueue] = []
+        # (flush time, tie breaker, queue) heap of the coalescing queues
+        self.delayed: List[Tuple[float, int, SendQueue]] = []
+        self.counter = itertools.count()
+        # fd -> queue, of every queue waiting for its socket to be writable
+        self.queues: Dict[int, SendQueue] = {}
+        self.pid = None
+        self.selector = None
+        self.wakeupRecv = self.wakeupSend = None
+
+    def register(self, queue: SendQueue, delay: Optional[float] = None):
+        """Hand a queue with pending data to the writer thread, which waits for its
+        socket to be writable, or flushes it after delay seconds if given"""
+        with self.lock:
+            if self.pid != os.getpid():
+                # first use in this process (the server runs in a forked process)
+                self._start()
+            # the writer is already awake if something was waiting for it
+            wakeup = not self.pending
+            self.pending.append((queue, None if delay is None else time.monotonic() + delay))
+        if not wakeup:
+            return
+        try:
+            self.wakeupSend.send(b'\0', MSG_DONTWAIT)
+        except BlockingIOError:
+            # the writer already has wakeups to process
+            pass
+
+    def waitingQueues(self) -> Set[SendQueue]:
+        """Queues with data the writer has yet to write, those waiting for their socket
+        and the coalescing ones waiting for their flush"""
+        with self.lock:
+            queues = {queue for queue, _ in self.pending}
+        queues.update(entry[2] for entry in list(self.delayed))
+        queues.update(list(self.queues.values()))
+        return {queue for queue in queues if queue.queuedBytes}
+
+    def queuedBytes(self) -> int:
+        """Total number of bytes waiting in the send queues"""
+        return sum(queue.queuedBytes for queue in self.waitingQueues())
+
+    def _start(self):
+        """Private method to create the selector and start the writer thread"""
+        self.pid = os.getpid()
+        self.queues = {}
+        self.delayed = []
+        self.selector = selectors.DefaultSelector()
+        self.wakeupRecv, self.wakeupSend = sockets.socketpair()
+        self.wakeupRecv.setblocking(False)
+        self.selector.register(self.wakeupRecv, selectors.EVENT_READ)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        """Writer thread main loop"""
+        selector = self.selector
+        delayed = self.delayed
+        while True:
+            timeout = max(0.0, delayed[0][0] - time.monotonic()) if delayed else None
+            for key, _ in selector.select(timeout):
+                if key.fileobj is self.wakeupRecv:
+                    try:
+                        while self.wakeupRecv.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                queue: SendQueue = key.data
+                if queue.flush():
+                    self._unregister(queue)
+            # flush the coalescing queues whose interval is over, those the socket
+            # doesn't take entirely wait for it to be writable
+            now = time.monotonic()
+            while delayed and delayed[0][0] <= now:
+                queue = heapq.heappop(delayed)[2]
+                if not queue.flush():
+                    self._register(queue)
+            # register new queues only after flushing, so a queue that emptied and
+            # was refilled in the meantime is registered again
+            with self.lock:
+                pending, self.pending = self.pending, []
+            for queue, deadline in pending:
+                if deadline is None or queue.closed:
+                    self._register(queue)
+                else:
+                    heapq.heappush(delayed, (deadline, next(self.counter), queue))
+
+    def _register(self, queue: SendQueue):
+        """Private method to start watching the socket of a queue"""
+        if queue.closed:
+            self._unregister(queue)
+            return
+        current = self.queues.get(queue.fd)
+        if current is queue:
+            return
+        if current is not None:
+            # stale entry left by a closed socket whose fd got reused
+            self._unregister(current)
+        try:
+            self.selector.register(queue.fd, selectors.EVENT_WRITE, queue)
+        except (ValueError, OSError):
+            return
+        self.queues[queue.fd] = queue
+
+    def _unregister(self, queue: SendQueue):
+        """Private method to stop watching the socket of a queue"""
+        if self.queues.get(queue.fd) is not queue:
+            return
+        del self.queues[queue.fd]
+        try:
+            self.selector.unregister(queue.fd)
+        except (KeyError, ValueError):
+            pass
+
+
+# the writer shared by every connection of the process
+_writer = SocketWriter()
+
+
+def getWriter() -> SocketWriter:
+    """Returns the writer shared by every connection of the process"""
+    return _writer